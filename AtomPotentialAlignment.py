@@ -7,9 +7,12 @@ Modified by Suzanne K. Wallace (with permission) for incorporation into DefectCo
 """
 
 import numpy as np
-from PoissonSolver import atomic_3d, atomic_3d_interstitial   # SKW edits: after updating coffee_poisson_solver_ko conda pkg
 import logging
-import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import DefectSupercellAnalyses as dsa
+import PlanarAverage as pa
+import ParsedDataCache as pdc
 logger = logging.getLogger()
 
 
@@ -24,224 +27,189 @@ def read_free_atom_pot(planar_pot_file: str) -> float:
 
     Returns: 
         Free atom potential from top line of 'plane_average_realspace_ESP.out' FHI-aims output file
+        (the file is read once with the planar average, see 'PlanarAverage.read_planar_pot')
     '''
     try:
-        with open(planar_pot_file, 'r') as f:
-            for line in f:
-                if re.search('#Numerical', line):
-                    words = line.split()
-                    free_atom_pot = float(words[7])
-                    if line == None:
-                        logger.info('Warning! - No average free-atom electrostatic potential found in '+str(planar_pot_file))
+        return pa.read_planar_pot(planar_pot_file).free_atom_pot
     except IOError:
         logger.info("Could not open "+str(planar_pot_file))
-    return free_atom_pot 
+        raise
     
 
+def _parse_atom_pot(atom_pot_file: str) -> dict:
+    with open(atom_pot_file, 'r') as f:
+        f.readline() # Skip header of file
+        # Whole file is split and converted in one go, columns are: species, potential
+        return {'atom_pots': np.array(f.read().split()).reshape(-1,2)[:,1].astype(np.float64)}
+
+
+def read_atom_pot(atom_pot_file: str, atom_num: int = None, skip_mask: np.ndarray = None) -> np.ndarray:
+    '''
+    Args: 
+        atom_pot_file: on-site electrostatic potential file from FHI-aims calculation (On-site_ESP.dat)
+        atom_num: (optional) number of atoms in the corresponding geometry.in, used to validate the number of rows in the file
+        skip_mask: (optional) boolean numpy array over atoms, True for atoms to skip (e.g. SiteMap.host_site_mask or SiteMap.defect_site_mask)
+
+    Returns: 
+        Numpy array of the on-site electrostatic potential (eV) of each atom, in the same order as geometry.in, with skipped atoms removed
+        (parsed arrays are stored in the on-disk cache from 'ParsedDataCache', if configured)
+    '''
+    atom_pots = pdc.cached_parse(atom_pot_file, 'atom_pot', _parse_atom_pot)['atom_pots']
+    if atom_num is not None and len(atom_pots) != atom_num:
+        raise ValueError(str(atom_pot_file)+' contains '+str(len(atom_pots))+' atom potentials, but the geometry has '+str(atom_num)+' atoms')
+    if skip_mask is not None:
+        atom_pots = atom_pots[~np.asarray(skip_mask, dtype=bool)]
+    return atom_pots
+
+
+def read_atom_pots(atom_pot_files: list, atom_nums: list = None, skip_masks: list = None, max_workers: int = None) -> list:
+    ''' Loads several On-site_ESP.dat files concurrently (e.g. host and charged/neutral defect supercells), see 'read_atom_pot'
+
+    Args: 
+        atom_pot_files: list of On-site_ESP.dat files
+        atom_nums: (optional) list of number of atoms for each file, for validation
+        skip_masks: (optional) list of boolean skip masks for each file (entries may be None)
+        max_workers: maximum number of files read at the same time (default of concurrent.futures.ThreadPoolExecutor if None)
+
+    Returns: 
+        List of numpy arrays of atom potentials, in the same order as atom_pot_files
+    '''
+    atom_nums = atom_nums if atom_nums is not None else [None]*len(atom_pot_files)
+    skip_masks = skip_masks if skip_masks is not None else [None]*len(atom_pot_files)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(read_atom_pot, atom_pot_files, atom_nums, skip_masks))
+
+
 def host_coords_skip_defect(defect_type: str, defect_line: int, host_atom_num: int, lattice_vec_array: tuple, host_coords_array: list, defect_coords_array: tuple) -> tuple:
     '''
     Args: 
         defect_type: parameter from notebook workflow with default names (obtained from DefectSupercellAnalysis.find_defect_type)
         defect_line: parameter from notebook workflow with default names (obtained from DefectSupercellAnalysis.antisite/vacancy/interstitial_coords)
     - host_coords_array and defect_coords_array are numpy arrays for fractional coordinates obtained e.g. with 'host_coords_array = dsa.coords_to_array(host_coords_frac)'
-    Returns: coordinates of atoms in host supercell relative to defect position, skipping coordinates of defect in the case of antisite or vacancy
+    Returns: minimum-image distances of atoms in host supercell from the defect position, skipping coordinates of defect in the case of antisite or vacancy
     '''
-    if (defect_type == 'interstitial'):
-        distance = np.zeros([host_atom_num]) # All host atoms plotted for interstitials
-        rel_defect_corr = np.zeros([host_atom_num,3])
-    else:
-        distance = np.zeros([host_atom_num-1]) # For antisite or vacancy, atom corresponding to defect is not plotted
-        rel_defect_corr = np.zeros([host_atom_num-1,3])
-
+    host_coords_array = np.asarray(host_coords_array)[:host_atom_num]
     if (defect_type == 'interstitial'): # All host coordinates are plotted, relative to defect location in defect supercell
-        for i in range(host_atom_num):
-            rel_defect_corr[i,:] = host_coords_array[i,:] - defect_coords_array[defect_line,:]
-            a = rel_defect_corr[i,0]*lattice_vec_array[0,:] + rel_defect_corr[i,1]*lattice_vec_array[1,:] +rel_defect_corr[i,2]*lattice_vec_array[2,:]
-            distance[i] = np.linalg.norm(a)
-
-    if (defect_type == 'antisite' or defect_type == 'vacancy'): # Defect is skipped in host supercell and all other atoms coordinates are plotted relative to defect position
-        if (defect_line == 0):
-            for i in range(1,host_atom_num): # Omit first set of coordinates for defect 
-                rel_defect_corr[i-1,:] = host_coords_array[i,:] - host_coords_array[defect_line,:]
-        elif (defect_line > 0 and defect_line < host_atom_num-1): # Omit defect_line
-            for i in range(0,defect_line): 
-                rel_defect_corr[i,:] = host_coords_array[i,:] - host_coords_array[defect_line,:]
-            for i in range(defect_line+1,host_atom_num):
-                rel_defect_corr[i-1,:] = host_coords_array[i,:] - host_coords_array[defect_line,:]
-        else: # Defect line is final line of host supercell
-            for i in range(0,host_atom_num-1): # Omit final set of coordinates for defect 
-                rel_defect_corr[i,:] = host_coords_array[i,:] - host_coords_array[defect_line,:] 
-        
-        for i in range(host_atom_num-1): 
-            #adding this iteration by considering the effects from other defect images.   
-            for k in range(3): 
-                if rel_defect_corr[i,k] > 0.5: 
-                    rel_defect_corr[i,k] -= 1
-                if rel_defect_corr[i,k] < -0.5: 
-                    rel_defect_corr[i,k] += 1 
-            a = rel_defect_corr[i,0]*lattice_vec_array[0,:] + rel_defect_corr[i,1]*lattice_vec_array[1,:] +rel_defect_corr[i,2]*lattice_vec_array[2,:]
-            distance[i] = np.linalg.norm(a)
-    return distance
+        return dsa.minimum_image_distances(host_coords_array, np.asarray(defect_coords_array)[defect_line], lattice_vec_array)
+    # Defect is skipped in host supercell and all other atoms coordinates are plotted relative to defect position
+    return dsa.minimum_image_distances(np.delete(host_coords_array, defect_line, axis=0), host_coords_array[defect_line], lattice_vec_array)
+
+
+def _site_distances(site_map, lattice_vec_array, host_coords_array, defect_coords_array) -> np.ndarray:
+    ''' Minimum-image distances from the defect of every atom paired between host and defect supercells, using defect supercell coordinates
+    (TZ: the distances are based on the defect coordinates as the defect cell has been relaxed)
+    '''
+    return dsa.minimum_image_distances(site_map.paired_coords(defect_coords_array), site_map.defect_position(host_coords_array, defect_coords_array), lattice_vec_array)
 
 
 # Compute the atomic potentials for the CoFFEE charge model   
-def model_atomic_pot(defect_type,host_atom_num,defect_line,grid,lattice_vec_array,host_coords_array,defect_coords_array,V_G,sigma,G1,G2,G3):
+def model_atomic_pot(defect_type,host_atom_num,defect_line,grid,lattice_vec_array,host_coords_array,defect_coords_array,V_G,sigma,G1,G2,G3,site_map=None):
     '''
     Args:
+        Parameters from notebook workflow with default names, host_coords_array and defect_coords_array are fractional coordinates
+        site_map: (optional) SiteMap from 'DefectSupercellAnalyses.build_site_map', built from defect_type and defect_line if not given
      
     Returns:
+        Numpy array with distance of each atom from the defect (Angstroms) and model potential at each atom site
     '''
+    # PoissonSolver (CoFFEE) is only needed for the model potentials, so is imported here rather than with the module
+    from PoissonSolver import atomic_3d, atomic_3d_interstitial   # SKW edits: after updating coffee_poisson_solver_ko conda pkg
     bohr = 1.8897259886 
     lattice_vec_array = lattice_vec_array*bohr 
-    # TZ: after thinking this question deeply, I think the plot shoulde be  based on the defect coordinates for the reason that we relaxed the cell.
-    # A simple trick to fix this problem but not changing too much the code, is just replacing the atomic coordinates in the host_corrds here within the
-    # defect_coords, So it will output the model potential based on the defect coords and the distance based on the defect coords, but without any effects
-    # to other part of the code. 
-    if (defect_type == 'interstitial' or defect_type == 'antisite'): 
-        host_coords_array = defect_coords_array 
-    if (defect_type == 'vacancy'): 
-        if (defect_line == 0):
-            for i in range(1,host_atom_num): # Omit first set of coordinates for defect 
-                host_coords_array[i,:] = defect_coords_array[i-1,:]
-        elif (defect_line > 0 and defect_line < host_atom_num-1): # Omit defect_line
-            for i in range(0,defect_line): 
-                host_coords_array[i,:] = defect_coords_array[i,:]
-            for i in range(defect_line+1,host_atom_num):
-                host_coords_array[i,:] = defect_coords_array[i-1,:]
-        else: # Defect line is final line of host supercell
-            for i in range(0,host_atom_num-1): # Omit final set of coordinates for defect 
-                host_coords_array[i,:] = defect_coords_array[i,:]
-    # Calculate coordinates of atoms in host lattice relative to defect coordinates, but omitting coordinates of defect
-    distance = host_coords_skip_defect(defect_type, defect_line, host_atom_num, lattice_vec_array, host_coords_array, defect_coords_array)
-    # SKW: New atomic_3d functions need testing!!
+    if site_map is None:
+        site_map = dsa.build_site_map(defect_type, defect_line, host_atom_num, len(defect_coords_array))
+    # TZ: the model potential is sampled at the atom positions in the defect supercell, as the cell has been relaxed.
+    # Host atoms are moved to the positions of their partners in the defect supercell (the input arrays are not modified).
+    distance = _site_distances(site_map, lattice_vec_array, host_coords_array, defect_coords_array)
     if (defect_type == 'interstitial'):
-        V_atomic = atomic_3d_interstitial(defect_line,host_atom_num,sigma,grid,lattice_vec_array,host_coords_array,V_G,G1,G2,G3)
+        # Interstitial is placed after all atoms paired with the host, so the first host_atom_num sites are sampled
+        sampling_coords = np.concatenate([site_map.paired_coords(defect_coords_array), defect_coords_array[[defect_line]]])
+        V_atomic = atomic_3d_interstitial(host_atom_num,host_atom_num,sigma,grid,lattice_vec_array,sampling_coords,V_G,G1,G2,G3)
     else: # Use function for antisites or vacancies that skip defect in host supercell
-        V_atomic = atomic_3d(defect_line,host_atom_num,sigma,grid,lattice_vec_array,host_coords_array,V_G,G1,G2,G3)
-    if (defect_type == 'interstitial'): # All atoms included when calculating 'distance' above
-        model_atom_pots = np.zeros([host_atom_num,2])
-    else: # Defect species skipped when calculating 'distance' above for antisites or vacancies
-        model_atom_pots = np.zeros([host_atom_num-1,2])
-    model_atom_pots[:,0] = distance/bohr
-    model_atom_pots[:,1] = V_atomic 
-
-    return model_atom_pots
+        sampling_coords = site_map.sampling_coords(host_coords_array, defect_coords_array)
+        V_atomic = atomic_3d(defect_line,host_atom_num,sigma,grid,lattice_vec_array,sampling_coords,V_G,G1,G2,G3)
+    return np.column_stack([distance/bohr, V_atomic])
 
 
 # Obtain the atomic potential from outputs of FHI-aims calculations  
-def fhiaims_atomic_pot(defect_type, host_atom_num,defect_atom_num,defect_line,lattice_vec_array,host_coords_array, defect_coords_array, host_atom_pot,defect_atom_pot,shift_H,shift_D): 
+def fhiaims_atomic_pot(defect_type, host_atom_num,defect_atom_num,defect_line,lattice_vec_array,host_coords_array, defect_coords_array, host_atom_pot,defect_atom_pot,shift_H,shift_D,site_map=None): 
     '''
     Args:
+        Parameters from notebook workflow with default names, host_coords_array and defect_coords_array are fractional coordinates
+        host_atom_pot, defect_atom_pot: On-site_ESP.dat files from FHI-aims for host and defect supercells
+        shift_H, shift_D: free atom potentials from 'read_free_atom_pot' for host and defect supercells
+        site_map: (optional) SiteMap from 'DefectSupercellAnalyses.build_site_map', built from defect_type and defect_line if not given
 
     Returns:
+        Numpy array with distance of each atom from the defect (Angstroms) and difference in atom potentials between defect and host
     '''
-    # Data for atom potentials from FHI-aims outputs
-    host_pot = open(host_atom_pot,'r')
-    host_pot.readline() # Used to skip header of file
-    defect_pot = open(defect_atom_pot,'r')
-    defect_pot.readline() # Used to skip header of file
-    if (defect_type == 'antisite' or defect_type == 'vacancy'):
-        h_pot = np.zeros([host_atom_num-1]) # subtract 1 because of skipping defect line
-        D_pot = np.zeros([host_atom_num-1])
-        Final = np.zeros([host_atom_num-1,2])
-    if (defect_type == 'interstitial'): # no need to subtract 1 as line to skip is additional in defect supercell
-        h_pot = np.zeros([host_atom_num])
-        D_pot = np.zeros([host_atom_num])
-        Final = np.zeros([host_atom_num,2])
-    # Read in potentials from FHI-aims output for perfect host supercell and skip reading in defect_line
-    if (defect_type == 'interstitial'): # Read all lines for atom potentials in host
-        for i in range(0,host_atom_num):
-            res = host_pot.readline().split()
-            h_pot[i] = float(res[1])
-    if (defect_type == 'vacancy' or defect_type == 'antisite'): # Skip the line in the host that corresponds to the defect
-        if (defect_line == 0):
-            host_pot.readline() # Skip first line
-            for i in range(0,host_atom_num-1): 
-                res = host_pot.readline().split()
-                h_pot[i] = float(res[1]) 
-        elif (defect_line == host_atom_num -1): 
-            for i in range(0,host_atom_num-1): # Skip last line 
-                res = host_pot.readline().split()
-                h_pot[i] = float(res[1])
-        else:
-            for i in range(0,defect_line): 
-                res = host_pot.readline().split()
-                h_pot[i] = float(res[1])
-            host_pot.readline() # Skip defect_line   
-            for i in range(defect_line,host_atom_num-1): 
-                res = host_pot.readline().split()
-                h_pot[i] = float(res[1])          
-    # Read in potentials from FHI-aims output for defect supercell and skip reading in defect_line
-    if (defect_type == 'vacancy'): # Read all atom potentials from defect supercell
-        for i in range(0,host_atom_num-1): 
-            res2 = defect_pot.readline().split()
-            D_pot[i] = float(res2[1])
-    if (defect_type == 'antisite'): # Read all atom potentials, but skip line for the defect
-        if (defect_line == 0):
-            defect_pot.readline() # Skip first line
-            for i in range(0,host_atom_num-1): 
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1]) 
-        elif (defect_line == host_atom_num -1): 
-            for i in range(0,host_atom_num-1): # Skip last line
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1])
-        else:
-            for i in range(0,defect_line): 
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1])
-            defect_pot.readline() # Skip defect_line
-            for i in range(defect_line,host_atom_num-1): 
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1])
-    if (defect_type == 'interstitial'): # Read all atom potentials, but skip line for the defect
-        if (defect_line == 0):
-            defect_pot.readline() # Skip first line
-            for i in range(0,host_atom_num): 
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1]) 
-        elif (defect_line > 0 and defect_line < defect_atom_num-1):
-            for i in range(0,defect_line): 
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1])
-            defect_pot.readline() # Skip defect_line
-            for i in range(defect_line,host_atom_num): 
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1])
-        else: # Interstitial is final line of defect supercell file, so only last line needs to be skipped
-            for i in range(0,host_atom_num-1): # Skip last line
-                res2 = defect_pot.readline().split()
-                D_pot[i] = float(res2[1])
-                        
-    # Preparing pa plot with potentials read in above and free atom potential shifts read in from planar average FHI-aims output file
-    result = D_pot -shift_D -(h_pot - shift_H)  
-    # Calculate coordinates of atoms in host lattice relative to defect coordinates, but omitting coordinates of defect
-    # TZ: same trick as that in the "model potential output", changing the distance to that in the defect coordinates.    
-    if (defect_type == 'interstitial' or defect_type == 'antisite'): 
-        host_coords_array = defect_coords_array 
-    if (defect_type == 'vacancy'): 
-        if (defect_line == 0):
-            for i in range(1,host_atom_num): # Omit first set of coordinates for defect 
-                host_coords_array[i,:] = defect_coords_array[i-1,:]
-        elif (defect_line > 0 and defect_line < host_atom_num-1): # Omit defect_line
-            for i in range(0,defect_line): 
-                host_coords_array[i,:] = defect_coords_array[i,:]
-            for i in range(defect_line+1,host_atom_num):
-                host_coords_array[i,:] = defect_coords_array[i-1,:]
-        else: # Defect line is final line of host supercell
-            for i in range(0,host_atom_num-1): # Omit final set of coordinates for defect 
-                host_coords_array[i,:] = defect_coords_array[i,:]
-    distance = host_coords_skip_defect(defect_type, defect_line, host_atom_num, lattice_vec_array, host_coords_array, defect_coords_array)
+    if site_map is None:
+        site_map = dsa.build_site_map(defect_type, defect_line, host_atom_num, defect_atom_num)
+    # Data for atom potentials from FHI-aims outputs, skipping the defect site in each supercell
+    h_pot, D_pot = read_atom_pots([host_atom_pot, defect_atom_pot], [host_atom_num, defect_atom_num], [site_map.host_site_mask, site_map.defect_site_mask])
+    # Potential differences of paired atoms with free atom potential shifts read in from planar average FHI-aims output file
+    result = D_pot -shift_D -(h_pot - shift_H)
+    # Calculate coordinates of atoms relative to defect coordinates, but omitting coordinates of defect
+    distance = _site_distances(site_map, lattice_vec_array, host_coords_array, defect_coords_array)
+    return np.column_stack([distance, result])
 
-    if (defect_type == 'interstitial'): # All host coordinates are plotted, relative to defect location in defect supercell
-        Final = np.zeros([host_atom_num,2])
-        for i in range(0,host_atom_num): 
-            Final[i,0] =  distance[i]
-            Final[i,1] = result[i]    
-            
-    if (defect_type == 'antisite' or defect_type == 'vacancy'): # Defect was skipped in host supercell and all other atoms coordinates are plotted relative to defect position
-        Final = np.zeros([host_atom_num-1,2])
-        for i in range(0,host_atom_num-1): 
-            Final[i,0] =  distance[i]
-            Final[i,1] = result[i]
-    return Final
+
+# Potential alignment from the atoms in the sampling region of Kumagai and Oba (doi: 10.1103/PhysRevB.89.195205), between the
+# radius of the sphere with the supercell volume (Rws) and half the length of a1+a2+a3 (Rwl) from the defect: mean, standard
+# deviation and number of the sampled potential differences. The alignment term for a defect with charge q is -q*mean.
+AtomAlignment = namedtuple('AtomAlignment', ['mean', 'std', 'count', 'Rws', 'Rwl'])
+
+
+def sampling_radii(lattice_vec_arrays) -> tuple:
+    '''
+    Args:
+        lattice_vec_arrays: lattice vectors as rows (Angstroms) of one supercell (3x3) or a set of supercells (Dx3x3)
+
+    Returns:
+        Numpy arrays of Rws and Rwl (Angstroms) for each supercell
+    '''
+    lattices = np.asarray(lattice_vec_arrays, dtype=np.float64).reshape(-1,3,3)
+    volumes = np.abs(np.einsum('di,di->d', lattices[:,0], np.cross(lattices[:,1], lattices[:,2])))
+    Rws = (volumes*3.0/(4.0*np.pi))**(1.0/3.0)
+    Rwl = 0.5*np.linalg.norm(lattices.sum(axis=1), axis=1)
+    return Rws, Rwl
+
+
+def atom_alignments(lattice_vec_arrays, atom_pots: list, model_pots: list = None) -> list:
+    '''
+    Potential alignment with atom potentials for a set of defects, with all defects sampled together (no plotting)
+
+    Args:
+        lattice_vec_arrays: lattice vectors as rows (Angstroms) of each defect supercell (Dx3x3), or one 3x3 array for all defects
+        atom_pots: for each defect, Nx2 array of the distance of each atom from the defect and its potential difference
+            (as from 'fhiaims_atomic_pot')
+        model_pots: (optional) for each defect, Nx2 array of the distance and potential of the charge model at the same atoms
+            (as from 'model_atomic_pot'), then atom_pots - model_pots is sampled, with the model distances
+
+    Returns:
+        List of AtomAlignment for each defect (floats, mean and std are nan if no atoms are in the sampling region)
+    '''
+    num_defects = len(atom_pots)
+    Rws, Rwl = [np.broadcast_to(radii, (num_defects,)) for radii in sampling_radii(lattice_vec_arrays)]
+    # Atoms of all defects are padded to the same number, padding is nan so is never in the sampling region
+    num_atoms = max([len(pots) for pots in atom_pots] + [0])
+    distances = np.full((num_defects, num_atoms), np.nan)
+    values = np.full((num_defects, num_atoms), np.nan)
+    for i, pots in enumerate(atom_pots):
+        pots = np.asarray(pots, dtype=np.float64)
+        distances[i,:len(pots)] = pots[:,0]
+        values[i,:len(pots)] = pots[:,1]
+        if model_pots is not None:
+            distances[i,:len(pots)] = model_pots[i][:,0]
+            values[i,:len(pots)] -= model_pots[i][:,1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        in_region = (distances > Rws[:,None]) & (distances < Rwl[:,None])
+        count = in_region.sum(axis=1)
+        mean = np.where(in_region, values, 0.0).sum(axis=1)/count
+        std = np.sqrt(np.where(in_region, (values - mean[:,None])**2, 0.0).sum(axis=1)/count)
+    return [AtomAlignment(float(mean[i]), float(std[i]), int(count[i]), float(Rws[i]), float(Rwl[i])) for i in range(num_defects)]
+
+
+def atom_alignment(lattice_vec_array: np.ndarray, atom_pots: np.ndarray, model_pots: np.ndarray = None) -> AtomAlignment:
+    ''' AtomAlignment of one defect, see 'atom_alignments' '''
+    return atom_alignments(lattice_vec_array, [atom_pots], None if model_pots is None else [model_pots])[0]
@@ -1,6 +1,46 @@
 import subprocess
 import os
-from DefectSupercellAnalyses import read_lattice_vectors, logger
+import io
+import tempfile
+import contextlib
+import shutil
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from DefectSupercellAnalyses import read_lattice_vectors, max_sigma, logger
+import ParsedDataCache as pdc
+
+# Rydberg in eV, as used by coffee.py to convert V_r to eV
+ryd = 13.605698066
+bohr = 0.52917721092
+
+# Rough cost model for the CoFFEE solver used by estimate_charge_model: number of complex grids of the full FFT size held
+# at once during a solve, and seconds per N*log2(N) for a grid of N points (on one core)
+SOLVER_ARRAYS_IN_MEMORY = 12
+SOLVER_SECONDS_PER_POINT_LOG_POINT = 2.0e-7
+
+
+# Grids written by the CoFFEE solver into its working directory, used by the atom centred potential alignment
+SOLVER_GRID_FILES = ("G1.npy", "G2.npy", "G3.npy", "V_G-model.npy")
+# Supercell multiples in order of increasing volume for extrapolate_charge_model with a tolerance. Convergence of E_iso is only
+# checked from the third charge model on, so with the 1x1x1, 2x2x2 and 3x3x3 supercells alone all of them are always solved,
+# while this ladder can stop well before the 3x3x3 supercell
+CONVERGENCE_MULTIPLES = ((1, 1, 1), (1, 1, 2), (1, 2, 2), (2, 2, 2), (2, 2, 3), (2, 3, 3), (3, 3, 3))
+
+# Result of solving the Poisson equation for the Gaussian charge model: energy is E_q^per,m in eV (None if not found),
+# V_r the potential on the real space grid in eV (as saved to V_r.npy by coffee.py), sigma_too_large is True if CoFFEE
+# warned that sigma is too large for the cell and solver_output is the text printed by the solver
+ChargeModelSolution = namedtuple('ChargeModelSolution', ['energy', 'V_r', 'sigma_too_large', 'solver_output'])
+
+# Result of extrapolating charge model energies to an isolated defect: E_iso and its standard error (nan if the fit is exact),
+# fit coefficients (f_1, f_2, f_3) of E = f_1/L + f_2/L^3 + f_3, and the supercell multiples solved with their 1/L (1/Angstrom),
+# energies and solutions. converged is True if the change in E_iso on adding the last multiple was within the tolerance
+Extrapolation = namedtuple('Extrapolation', ['E_iso', 'E_iso_error', 'coefficients', 'multiples', 'inverse_lengths', 'energies', 'solutions', 'converged'])
+
+# Pre-flight estimate for a charge model solve: FFT grid (2*imax+1, 2*jmax+1, 2*kmax+1), number of grid points,
+# peak memory (bytes), runtime (seconds) and whether sigma is small enough for the defect supercell
+ChargeModelEstimate = namedtuple('ChargeModelEstimate', ['grid', 'grid_points', 'memory_bytes', 'runtime_seconds', 'sigma_ok'])
+
 
 def run_CoFFEE_solver(coffee_exe, defect_outputs_dir, super_x, super_y, super_z, defect_geom, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz):
     '''
@@ -24,54 +64,452 @@ def run_CoFFEE_solver(coffee_exe, defect_outputs_dir, super_x, super_y, super_z,
         logger.info(err.output)  # pylint: disable=no-member
 
 
+def coffee_input_text(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz) -> str:
+    '''
+    Arguments: lattice vectors of the defect supercell (x_vecs, y_vecs, z_vecs as from read_lattice_vectors) and then parameters for the defect
+    from the 'user inputs cell' or generated by the notebook workflow with their default names
+    Returns: contents of the 'in' file for coffee.py to solve the Poisson equation for the Gaussian charge model
+    '''
+    x_vecs, y_vecs, z_vecs = lattice_vecs
+    lines = []
+    # CELL PARAMS
+    lines.append("&CELL_PARAMETERS\n")
+    lines.append("\n")
+    lines.append("Lattice_Vectors(normalized):\n")
+    # Normalize lattice vectors for CoFFEE
+    a1_tot = x_vecs[0] + y_vecs[0] + z_vecs[0]
+    a2_tot = x_vecs[1] + y_vecs[1] + z_vecs[1]
+    a3_tot = x_vecs[2] + y_vecs[2] + z_vecs[2]
+    lines.append(str(x_vecs[0] / a1_tot) + "   " + str(y_vecs[0] / a1_tot) + "   " + str(z_vecs[0] / a1_tot) + "\n")
+    lines.append(str(x_vecs[1] / a2_tot) + "   " + str(y_vecs[1] / a2_tot) + "   " + str(z_vecs[1] / a2_tot) + "\n")
+    lines.append(str(x_vecs[2] / a3_tot) + "   " + str(y_vecs[2] / a3_tot) + "   " + str(z_vecs[2] / a3_tot) + "\n")
+    lines.append("\n")
+    lines.append("Cell_dimensions angstrom\n")
+    lines.append(str(a1_tot * super_x) + "  " + str(a2_tot * super_y) + "   " + str(a3_tot * super_z) + "\n")
+    lines.append("\n")
+    lines.append("Ecut=" + str(cutoff) + " Hartree\n")
+    lines.append("/\n")
+    lines.append("\n")
+    # DIELECTRIC PARAMS
+    lines.append("&DIELECTRIC_PARAMETERS Bulk\n")
+    lines.append("Epsilon1_a1 = " + str(dielectric_xx) + "\n")
+    lines.append("Epsilon1_a2 = " + str(dielectric_yy) + "\n")
+    lines.append("Epsilon1_a3 = " + str(dielectric_zz) + "\n")
+    lines.append("/\n")
+    lines.append("\n")
+    # GAUSSIAN PARAMS (used for charge model)
+    lines.append("&GAUSSIAN_PARAMETERS:\n")
+    lines.append("Total_charge = " + str(defect_charge) + "\n")
+    lines.append("Sigma = " + str(sigma) + "\n")
+    # Centre of Gaussian is set as defect location
+    lines.append("Centre_a1 = " + str(defect_x / a1_tot) + "\n")
+    lines.append("Centre_a2 = " + str(defect_y / a2_tot) + "\n")
+    lines.append("Centre_a3 = " + str(defect_z / a3_tot) + "\n")
+    lines.append("/\n")
+    return ''.join(lines)
+
+
 def write_CoFFEE_in_file(defect_outputs_dir, super_x, super_y, super_z, geom_file, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz):
     '''
     Arguments: parameters for the defect from the 'user inputs cell' or generated by the notebook workflow with their default names
     Returns: 'in' file for coffee.py to solve the Poisson equation for the Gaussian charge model
     '''
+    # Read in lattice vectors from geometry.in for the 'in' file for CoFFEE
     with open(os.path.join(defect_outputs_dir, f"cm_{super_x}x{super_y}x{super_z}_in"), "w") as coffee_in:
-        # CELL PARAMS
-        coffee_in.write("&CELL_PARAMETERS\n")
-        coffee_in.write("\n")
-        coffee_in.write("Lattice_Vectors(normalized):\n")
-        # Read in lattice vectors from geometry.in, normalize and write to 'in' file for CoFFEE
-        x_vecs, y_vecs, z_vecs = read_lattice_vectors(geom_file)
-        a1_tot = x_vecs[0] + y_vecs[0] + z_vecs[0]
-        a2_tot = x_vecs[1] + y_vecs[1] + z_vecs[1]
-        a3_tot = x_vecs[2] + y_vecs[2] + z_vecs[2]
-        coffee_in.write(str(x_vecs[0] / a1_tot) + "   " + str(y_vecs[0] / a1_tot) + "   " + str(z_vecs[0] / a1_tot) + "\n")
-        coffee_in.write(str(x_vecs[1] / a2_tot) + "   " + str(y_vecs[1] / a2_tot) + "   " + str(z_vecs[1] / a2_tot) + "\n")
-        coffee_in.write(str(x_vecs[2] / a3_tot) + "   " + str(y_vecs[2] / a3_tot) + "   " + str(z_vecs[2] / a3_tot) + "\n")
-        coffee_in.write("\n")
-        coffee_in.write("Cell_dimensions angstrom\n")
-        coffee_in.write(str(a1_tot * super_x) + "  " + str(a2_tot * super_y) + "   " + str(a3_tot * super_z) + "\n")
-        coffee_in.write("\n")
-        coffee_in.write("Ecut=" + str(cutoff) + " Hartree\n")
-        coffee_in.write("/\n")
-        coffee_in.write("\n")
-        # DIELECTRIC PARAMS
-        coffee_in.write("&DIELECTRIC_PARAMETERS Bulk\n")
-        coffee_in.write("Epsilon1_a1 = " + str(dielectric_xx) + "\n")
-        coffee_in.write("Epsilon1_a2 = " + str(dielectric_yy) + "\n")
-        coffee_in.write("Epsilon1_a3 = " + str(dielectric_zz) + "\n")
-        coffee_in.write("/\n")
-        coffee_in.write("\n")
-        # GAUSSIAN PARAMS (used for charge model)
-        coffee_in.write("&GAUSSIAN_PARAMETERS:\n")
-        coffee_in.write("Total_charge = " + str(defect_charge) + "\n")
-        coffee_in.write("Sigma = " + str(sigma) + "\n")
-        # Centre of Gaussian is set as defect location
-        coffee_in.write("Centre_a1 = " + str(defect_x / a1_tot) + "\n")
-        coffee_in.write("Centre_a2 = " + str(defect_y / a2_tot) + "\n")
-        coffee_in.write("Centre_a3 = " + str(defect_z / a3_tot) + "\n")
-        coffee_in.write("/\n")
-
-def write_CoFFEE_in_V_file(super_z):
+        coffee_in.write(coffee_input_text(read_lattice_vectors(geom_file), super_x, super_y, super_z, sigma, cutoff, defect_charge,
+                                          defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz))
+
+
+def _parse_solver_output(solver_output: str):
+    ''' Total energy (eV) and whether sigma was too large, from the lines starting with '!' printed by the CoFFEE solver '''
+    energy = None
+    sigma_too_large = False
+    for line in solver_output.splitlines():
+        if '!' not in line:
+            continue
+        words = line.split()
+        if words[3:6] == ['Sigma', 'too', 'large,']:
+            sigma_too_large = True
+        if words[1:4] == ['Total', 'Energy', '(eV):']:
+            energy = float(words[4])
+    return energy, sigma_too_large
+
+
+def estimate_charge_model(lattice_vecs, super_x, super_y, super_z, sigma, cutoff) -> ChargeModelEstimate:
+    ''' Pre-flight estimate of the size and cost of solving a charge model, without running the solver
+
+    Args:
+        lattice_vecs: lattice vectors of the defect supercell (x_vecs, y_vecs, z_vecs as from read_lattice_vectors, Angstroms)
+        super_x, super_y, super_z: multiples of the defect supercell used for the charge model
+        sigma: width of the Gaussian charge model (Angstroms)
+        cutoff: plane wave cutoff for the solver (Hartree)
+
+    Returns:
+        ChargeModelEstimate(grid, grid_points, memory_bytes, runtime_seconds, sigma_ok). Memory and runtime use the rough
+        cost model in SOLVER_ARRAYS_IN_MEMORY and SOLVER_SECONDS_PER_POINT_LOG_POINT
+    '''
+    # Rows of lattice_vecs are the x, y and z components, so the lattice vectors are its columns
+    lattice_vec_array = np.asarray(lattice_vecs, dtype=float).T
+    lengths = np.linalg.norm(lattice_vec_array, axis=1)
+    cell_lengths = lengths*np.array([super_x, super_y, super_z])
+    # Plane waves with |G| <= sqrt(2*Ecut) (Hartree atomic units), giving imax, jmax, kmax G-vectors along each lattice vector
+    G_max = np.sqrt(2.0*cutoff)
+    max_indices = np.ceil(G_max*(cell_lengths/bohr)/(2.0*np.pi)).astype(int)
+    grid = tuple(int(n) for n in 2*max_indices+1)
+    grid_points = int(np.prod(grid))
+    memory_bytes = SOLVER_ARRAYS_IN_MEMORY*16*grid_points
+    runtime_seconds = float(SOLVER_SECONDS_PER_POINT_LOG_POINT*grid_points*np.log2(grid_points))
+    # Same limit as used to set sigma for a dataset (see DefectSupercellAnalyses.dataset_sigma)
+    sigma_ok = bool(sigma <= max_sigma(lattice_vec_array))
+    return ChargeModelEstimate(grid, grid_points, memory_bytes, runtime_seconds, sigma_ok)
+
+
+def multiples_within_budget(lattice_vecs, sigma, cutoff, multiples, memory_budget: float, workers: int = 1) -> list:
+    ''' Supercell multiples whose charge model solves fit in a memory budget
+
+    Args:
+        lattice_vecs, sigma, cutoff: as for estimate_charge_model
+        multiples: supercell multiples (N_1, N_2, N_3) requested
+        memory_budget: memory available for the solves (bytes)
+        workers: number of solves running at the same time, the largest of which must fit in the budget together
+
+    Returns:
+        Multiples (in order of increasing volume) that can be solved within the budget
+    '''
+    multiples = sorted((tuple(multiple) for multiple in multiples), key=np.prod)
+    memory = [estimate_charge_model(lattice_vecs, *multiple, sigma, cutoff).memory_bytes for multiple in multiples]
+    allowed = []
+    for i, multiple in enumerate(multiples):
+        # Memory of this solve and the next largest ones that would be running alongside it
+        concurrent = sum(memory[max(0, i-workers+1):i+1])
+        if concurrent > memory_budget:
+            logger.info("Charge model "+"x".join(str(n) for n in multiple)+" needs an estimated "+str(round(concurrent/1024**3, 2))
+                        +" GB, over the memory budget of "+str(round(memory_budget/1024**3, 2))+" GB")
+            break
+        allowed.append(multiple)
+    return allowed
+
+
+def solve_charge_model(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z,
+                       dielectric_xx, dielectric_yy, dielectric_zz, artifacts_dir: str = None, grids_dir: str = None) -> ChargeModelSolution:
+    ''' Solves the Poisson equation for the Gaussian charge model with the CoFFEE solver in the current process,
+    doing the same steps as coffee.py without starting a new interpreter for each supercell size.
+    The solver writes G1-3.npy and V_G-model.npy to its working directory, so it is run in a temporary directory
+    (changing the working directory of the process while it runs) and the grids are moved to grids_dir or discarded.
+
+    Args:
+        lattice_vecs: lattice vectors of the defect supercell (x_vecs, y_vecs, z_vecs as from read_lattice_vectors)
+        super_x, super_y, super_z: multiples of the defect supercell used for the charge model (e.g. 2, 2, 2)
+        sigma: width of the Gaussian charge model (Angstroms)
+        cutoff: plane wave cutoff for the solver (Hartree)
+        defect_charge: charge of the Gaussian
+        defect_x, defect_y, defect_z: cartesian coordinates of the defect, used as the centre of the Gaussian (Angstroms)
+        dielectric_xx, dielectric_yy, dielectric_zz: diagonal of the dielectric tensor
+        artifacts_dir: (optional) directory to write cm_NxNxN_in and cm_NxNxN.out files to, as when running coffee.py
+        grids_dir: (optional) directory to move the G1-3.npy and V_G-model.npy files written by the solver to
+
+    Returns:
+        ChargeModelSolution(energy, V_r, sigma_too_large, solver_output)
+    '''
+    # Imported here so that the rest of this module can be used without CoFFEE and mpi4py installed
+    import PoissonSolver as ps
+    from mpi4py import MPI
+
+    input_text = coffee_input_text(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge,
+                                   defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz)
+    cm_name = f"cm_{super_x}x{super_y}x{super_z}"
+    # Made next to where the grids are kept, so that they are moved rather than copied between file systems
+    work_dir = tempfile.mkdtemp(dir=grids_dir, prefix=".solve_"+cm_name+"_")
+    # CoFFEE's parameter classes read from a file, so the 'in' file is always written (to the temporary directory unless kept)
+    file_in = os.path.join(artifacts_dir if artifacts_dir is not None else work_dir, cm_name+"_in")
+    with open(file_in, "w") as coffee_in:
+        coffee_in.write(input_text)
+    file_in = os.path.abspath(file_in)
+
+    comm = MPI.COMM_WORLD
+    V_r = None
+    solver_output = io.StringIO()
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        with contextlib.redirect_stdout(solver_output):
+            ps.display_init()
+            c = ps.cell()
+            c.read_params(file_in)
+            c.disp_params()
+            eps = ps.diel_profile()
+            eps.read_params(file_in)
+            charge = ps.gaussian()
+            charge.read_params(file_in)
+            charge.disp_params()
+            imax, jmax, kmax = c.init_calc()
+            ps.construct_eps(c, eps, imax, jmax, kmax)
+            eps.disp_params()
+            print("Grid: %d, %d, %d" % (2*imax + 1, 2*jmax + 1, 2*kmax + 1))
+            ps.GlobalValues.c_g = c
+            ps.GlobalValues.kmax = kmax
+            ps.GlobalValues.lmax = imax
+            ps.GlobalValues.mmax = jmax
+            ps.GlobalValues.eps_g = eps
+            V_r = ps.Solver(c, charge, eps, imax, jmax, kmax, comm)
+            ps.ComputeEnergy(V_r, charge.rho_r, imax, jmax, kmax, c)
+        if grids_dir is not None:
+            for output_name in SOLVER_GRID_FILES:
+                if os.path.exists(output_name):
+                    os.replace(output_name, os.path.join(grids_dir, output_name))
+    except SystemExit:
+        # CoFFEE exits on invalid parameters (e.g. sigma too large), the reason is in the solver output
+        logger.info("CoFFEE solver stopped early for "+cm_name+", see solver output")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    solver_output = solver_output.getvalue()
+    if artifacts_dir is not None:
+        with open(os.path.join(artifacts_dir, cm_name+".out"), "w") as coffee_out:
+            coffee_out.write(solver_output)
+    energy, sigma_too_large = _parse_solver_output(solver_output)
+    if V_r is not None:
+        V_r = V_r*2.*ryd
+    return ChargeModelSolution(energy, V_r, sigma_too_large, solver_output)
+
+
+def scale_charge_model(solution: ChargeModelSolution, charge, unit_charge=1) -> ChargeModelSolution:
+    ''' Charge model solution for another charge at the same site, using that the energy of the Gaussian charge model scales as q^2
+    and the potential as q (the Poisson equation is linear in the charge)
+
+    Args:
+        solution: ChargeModelSolution for unit_charge
+        charge: charge to scale the solution to
+
+    Returns:
+        ChargeModelSolution for charge, with a line giving the scaled energy added to the solver output
+    '''
+    ratio = float(charge)/float(unit_charge)
+    energy = None if solution.energy is None else solution.energy*ratio**2
+    V_r = None if solution.V_r is None else np.asarray(solution.V_r)*ratio
+    solver_output = solution.solver_output+"Charge model solved for Total_charge = "+str(unit_charge)+", scaled to Total_charge = "+str(charge)+"\n"
+    if energy is not None:
+        solver_output += "! Total Energy (eV): "+str(energy)+"\n"
+    return ChargeModelSolution(energy, V_r, solution.sigma_too_large, solver_output)
+
+
+def charge_model_key(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z,
+                     dielectric_xx, dielectric_yy, dielectric_zz, with_grids: bool = False) -> str:
+    ''' Cache key for a charge model: canonical hash of the parameters written to the 'in' file for coffee.py '''
+    kind = 'charge_model_grids' if with_grids else 'charge_model'
+    params = [float(value) for value in (super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z,
+                                         dielectric_xx, dielectric_yy, dielectric_zz)]
+    return kind+'-'+pdc.hash_key(kind, np.asarray(lattice_vecs, dtype=float).tolist(), params)
+
+
+def cached_solve_charge_model(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z,
+                              dielectric_xx, dielectric_yy, dielectric_zz, artifacts_dir: str = None, grids_dir: str = None,
+                              charge_ladder: bool = False) -> ChargeModelSolution:
+    ''' solve_charge_model, with results stored in the cache from ParsedDataCache (if configured) so that a charge model is
+    only solved again when its parameters change. Hits and misses are reported in the log.
+
+    Args:
+        lattice_vecs, ..., dielectric_zz: as for solve_charge_model
+        artifacts_dir: (optional) directory to write cm_NxNxN_in and cm_NxNxN.out files to
+        grids_dir: (optional) directory to write V_r.npy, G1-3.npy and V_G-model.npy to. The grids are then cached along with the energy,
+            otherwise only the energy is cached and V_r is not returned on a cache hit
+        charge_ladder: if True, the charge model is solved (and cached) for unit charge and scaled to defect_charge,
+            so that only one solve is needed for all charge states of a defect at the same site. The grids written to grids_dir are
+            then those of the unit charge (only the returned V_r is scaled), and are scaled by defect_charge where they are used
+
+    Returns:
+        ChargeModelSolution(energy, V_r, sigma_too_large, solver_output)
+    '''
+    params = (lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz)
+    cm_name = f"cm_{super_x}x{super_y}x{super_z}"
+    if charge_ladder and defect_charge not in (0, 1):
+        unit_solution = cached_solve_charge_model(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, 1, defect_x, defect_y, defect_z,
+                                                  dielectric_xx, dielectric_yy, dielectric_zz, grids_dir=grids_dir)
+        logger.info("Charge model "+cm_name+" scaled from unit charge to charge "+str(defect_charge))
+        solution = scale_charge_model(unit_solution, defect_charge)
+        if artifacts_dir is not None:
+            with open(os.path.join(artifacts_dir, cm_name+"_in"), "w") as coffee_in:
+                coffee_in.write(coffee_input_text(*params))
+            with open(os.path.join(artifacts_dir, cm_name+".out"), "w") as coffee_out:
+                coffee_out.write(solution.solver_output)
+        return solution
+    key = charge_model_key(*params, with_grids=grids_dir is not None)
+    arrays = pdc.load_entry(key)
+    if arrays is not None:
+        logger.info("Charge model cache hit for "+cm_name+" ("+key+")")
+        solution = ChargeModelSolution(float(arrays['energy']), arrays.get('V_r'), bool(arrays['sigma_too_large']), str(arrays['solver_output'][()]))
+        if artifacts_dir is not None:
+            with open(os.path.join(artifacts_dir, cm_name+"_in"), "w") as coffee_in:
+                coffee_in.write(coffee_input_text(*params))
+            with open(os.path.join(artifacts_dir, cm_name+".out"), "w") as coffee_out:
+                coffee_out.write(solution.solver_output)
+        if grids_dir is not None:
+            for output_name in ("V_r.npy",) + SOLVER_GRID_FILES:
+                if output_name[:-4] in arrays:
+                    np.save(os.path.join(grids_dir, output_name), arrays[output_name[:-4]])
+        return solution
+
+    if pdc.get_cache_dir() is not None:
+        logger.info("Charge model cache miss for "+cm_name+", solving")
+    solution = solve_charge_model(*params, artifacts_dir=artifacts_dir, grids_dir=grids_dir)
+    arrays = {'energy': np.array(np.nan if solution.energy is None else solution.energy),
+              'sigma_too_large': np.array(solution.sigma_too_large),
+              'solver_output': np.array(solution.solver_output)}
+    if grids_dir is not None:
+        if solution.V_r is not None:
+            np.save(os.path.join(grids_dir, "V_r.npy"), solution.V_r)
+            arrays['V_r'] = solution.V_r
+        if pdc.get_cache_dir() is not None:
+            for output_name in SOLVER_GRID_FILES:
+                if os.path.exists(os.path.join(grids_dir, output_name)):
+                    arrays[output_name[:-4]] = np.load(os.path.join(grids_dir, output_name))
+    # Failed solves are not cached, so they are tried again next time
+    if solution.energy is not None:
+        pdc.store_entry(key, arrays)
+    return solution
+
+
+def _as_multiple(multiple) -> tuple:
+    ''' Supercell multiple (N_1, N_2, N_3) from a tuple or from N for an NxNxN charge model '''
+    return tuple(int(n) for n in multiple) if np.iterable(multiple) else (int(multiple),)*3
+
+
+def _solve_charge_model_job(multiple, keep_grids, defect_outputs_dir, lattice_vecs, solver_args, cache_settings, charge_ladder=False):
+    ''' Runs cached_solve_charge_model for a charge model of the given multiple in a worker process (solve_charge_model runs the solver
+    in its own temporary directory, so grids are not overwritten by other charge models running at the same time).
+    If keep_grids is True, V_r.npy and the solver grids are written to defect_outputs_dir, otherwise they are discarded
+    (V_r is then not returned either, to avoid sending large grids back between processes).
+    '''
+    # Worker processes do not necessarily inherit the cache configuration
+    pdc.configure_cache(*cache_settings)
+    solution = cached_solve_charge_model(lattice_vecs, *_as_multiple(multiple), *solver_args, artifacts_dir=defect_outputs_dir,
+                                         grids_dir=defect_outputs_dir if keep_grids else None, charge_ladder=charge_ladder)
+    if keep_grids and solution.V_r is not None:
+        solution = solution._replace(V_r=np.array(solution.V_r))
+    else:
+        solution = solution._replace(V_r=None)
+    return multiple, solution
+
+
+def solve_charge_models(lattice_vecs, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz,
+                        defect_outputs_dir: str, multiples=(1, 2, 3), keep_grids_for=1, max_workers: int = None,
+                        charge_ladder: bool = False) -> dict:
+    ''' Solves the Gaussian charge model for several supercell multiples at once with a process pool,
+    each in its own temporary directory. The cost is then roughly that of the largest (3x3x3) solve rather than the sum of all of them.
+    Charge models already in the cache (see cached_solve_charge_model) are not solved again.
+
+    Args:
+        lattice_vecs, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz: as for solve_charge_model
+        defect_outputs_dir: directory the cm_<multiple>_in/.out files, V_r.npy and solver grids are written to
+        multiples: supercell multiples to solve for, either N for an NxNxN charge model or (N_1, N_2, N_3) for anisotropic ones
+        keep_grids_for: multiple whose V_r.npy, G1-3.npy and V_G-model.npy are kept (the same size as the DFT supercell by default)
+        max_workers: (optional) number of processes, one per charge model if not set
+        charge_ladder: solve for unit charge and scale to defect_charge (see cached_solve_charge_model)
+
+    Returns:
+        Dict of ChargeModelSolution keyed by each multiple, as given in multiples
+    '''
+    defect_outputs_dir = os.path.abspath(defect_outputs_dir)
+    solver_args = (sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz)
+    keep_grids_for = _as_multiple(keep_grids_for)
+    solutions = {}
+    with ProcessPoolExecutor(max_workers=max_workers or len(multiples)) as executor:
+        # Largest charge models are submitted first as they take the longest
+        futures = [executor.submit(_solve_charge_model_job, multiple, _as_multiple(multiple) == keep_grids_for, defect_outputs_dir, lattice_vecs,
+                                   solver_args, (pdc.get_cache_dir(), pdc.get_max_bytes()), charge_ladder)
+                   for multiple in sorted(multiples, key=lambda multiple: np.prod(_as_multiple(multiple)), reverse=True)]
+        for future in as_completed(futures):
+            multiple, solution = future.result()
+            logger.info("Charge model "+"x".join(str(n) for n in _as_multiple(multiple))+" finished, E_q^per = "+str(solution.energy))
+            solutions[multiple] = solution
+    return solutions
+
+
+def fit_isolated_energy(inverse_lengths, energies):
+    ''' Least squares fit of E = f_1/L + f_2/L^3 + f_3 to charge model energies, where 1/L = Omega^(-1/3) for each supercell.
+    With fewer than three supercells, the 1/L^3 (and then 1/L) terms are left out.
+
+    Args:
+        inverse_lengths: 1/L for each supercell
+        energies: charge model energies E_q^per for each supercell
+
+    Returns:
+        Fit coefficients (f_1, f_2, f_3) as for PlottingFunctions.compute_fit, where f_3 is E_iso,
+        and the standard error of f_3 (nan if there are not more supercells than fit coefficients)
+    '''
+    inverse_lengths = np.asarray(inverse_lengths, dtype=float)
+    energies = np.asarray(energies, dtype=float)
+    num_terms = min(len(energies), 3)
+    A = np.column_stack([inverse_lengths, inverse_lengths**3, np.ones_like(inverse_lengths)])
+    # Columns used for the number of supercells available, constant term is always last
+    columns = [[2], [0, 2], [0, 1, 2]][num_terms-1]
+    A = A[:, columns]
+    fit, residuals, rank, _ = np.linalg.lstsq(A, energies, rcond=None)
+    coefficients = np.zeros(3)
+    coefficients[columns] = fit
+    E_iso_error = np.nan
+    dof = len(energies) - num_terms
+    if dof > 0 and rank == num_terms:
+        residual_variance = np.sum((energies - A.dot(fit))**2)/dof
+        E_iso_error = np.sqrt(residual_variance*np.linalg.inv(A.T.dot(A))[-1, -1])
+    return coefficients, E_iso_error
+
+
+def extrapolate_charge_model(lattice_vecs, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z, dielectric_xx, dielectric_yy, dielectric_zz,
+                             multiples=((1, 1, 1), (2, 2, 2), (3, 3, 3)), tolerance: float = None, artifacts_dir: str = None,
+                             grids_dir: str = None, charge_ladder: bool = False) -> Extrapolation:
+    ''' Solves charge models for supercell multiples in order of increasing volume, only adding larger supercells until E_iso
+    from fit_isolated_energy changes by less than tolerance. Multiples can be anisotropic (e.g. (1, 1, 2)), which are cheaper than the next cubic multiple.
+
+    Args:
+        lattice_vecs, ..., dielectric_zz: as for solve_charge_model
+        multiples: supercell multiples (N_1, N_2, N_3) to use, should include (1, 1, 1) for E_q^per,m of the DFT supercell
+        tolerance: (optional) stop once E_iso changes by less than this (eV) on adding a supercell (from three supercells on, so with
+            three multiples or fewer all of them are solved; see CONVERGENCE_MULTIPLES). All multiples are solved if not set
+        artifacts_dir, grids_dir, charge_ladder: as for cached_solve_charge_model (grids are only written for (1, 1, 1))
+
+    Returns:
+        Extrapolation for the supercells solved
+    '''
+    # Length scale for 1/L as used in the notebook (supercell volume^(1/3), in Angstrom)
+    alat = abs(np.linalg.det(np.asarray(lattice_vecs, dtype=float)))**(1/3.)
+    multiples = sorted((tuple(multiple) for multiple in multiples), key=np.prod)
+    if tolerance is not None and len(multiples) <= 3:
+        logger.info("Warning! - E_iso convergence is only checked from the third charge model on, so all of "+str(multiples)
+                    +" are solved. Use more (e.g. anisotropic) multiples, such as CONVERGENCE_MULTIPLES, to stop early")
+    solved, inverse_lengths, energies, solutions = [], [], [], []
+    E_iso, E_iso_error, coefficients = np.nan, np.nan, np.zeros(3)
+    converged = False
+    for multiple in multiples:
+        super_x, super_y, super_z = multiple
+        solution = cached_solve_charge_model(lattice_vecs, super_x, super_y, super_z, sigma, cutoff, defect_charge, defect_x, defect_y, defect_z,
+                                             dielectric_xx, dielectric_yy, dielectric_zz, artifacts_dir=artifacts_dir,
+                                             grids_dir=grids_dir if multiple == (1, 1, 1) else None, charge_ladder=charge_ladder)
+        if solution.energy is None:
+            logger.info("No energy for charge model "+"x".join(str(n) for n in multiple)+", leaving it out of the extrapolation")
+            continue
+        solved.append(multiple)
+        inverse_lengths.append(np.prod(multiple)**(-1/3.)/alat)
+        energies.append(solution.energy)
+        solutions.append(solution)
+        previous_E_iso = E_iso
+        coefficients, E_iso_error = fit_isolated_energy(inverse_lengths, energies)
+        E_iso = coefficients[2]
+        logger.info("E_iso from "+str(len(energies))+" charge models = "+str(E_iso))
+        if tolerance is not None and len(energies) >= 3 and abs(E_iso - previous_E_iso) < tolerance:
+            converged = True
+            break
+    return Extrapolation(E_iso, E_iso_error, coefficients, solved, np.array(inverse_lengths), np.array(energies), solutions, converged)
+
+
+def write_CoFFEE_in_V_file(super_z, outputs_dir="."):
     '''
     Arguments: z-dimension of the host supercell (extracted in the notebook workflow, with the default name from the notebook)
+    and (optionally) the directory containing V_r.npy, where the in_V file is written
     Returns: 'in_V' file used by the adapted 'plavg.py' from CoFFEE_1.1 to generate the planar average of the Gaussian charge model
     '''
-    with open("in_V", "w") as in_V:
+    with open(os.path.join(outputs_dir, "in_V"), "w") as in_V:
         in_V.write("&plavg\n")
         in_V.write("file_name = V_r.npy\n")
         in_V.write("file_type = python\n")
@@ -0,0 +1,132 @@
+'''
+Runs DefectCorrectionsNotebook.ipynb for a set of charged defects at the same time, with a process pool.
+
+Each defect is run in its own working directory (ProcessedDefects/.work/<defect_outputs_dir>), so that files the notebook
+writes to its working directory (e.g. solver grids, plavg_a3.plot and the output notebook) never collide between defects.
+Outputs for each defect are written to ProcessedDefects/<defect_outputs_dir> as before, and whether each defect
+succeeded or failed is collected into ProcessedDefects/dataset_summary.dat.
+
+With notebook=False, the analysis is run with DefectCorrectionsPipeline.run_pipeline in each worker process instead of
+starting a Jupyter kernel for each defect (no output notebook is written).
+
+To use, the following lines must be added to the code (see DefectCorrectionsDataset.py):
+    import DatasetRunner as dr
+    results = dr.run_dataset(global_configuration, configurations, workers=4)
+'''
+
+import os
+import sys
+import shutil
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+NOTEBOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DefectCorrectionsNotebook.ipynb")
+OUTPUT_NOTEBOOK = "output_DefectCorrectionsNotebook.ipynb"
+# Notebook parameters that are paths, made absolute as each defect is run from its own working directory
+PATH_PARAMETERS = ("path_to_all_defects", "path_to_host", "path_to_defect", "path_to_neutral")
+
+# Outcome of running the notebook for one defect: name (defect_outputs_dir), success, error message (None on success),
+# wall time (seconds) and directory with the outputs for the defect
+JobResult = namedtuple('JobResult', ['name', 'success', 'error', 'runtime_seconds', 'outputs_dir'])
+
+
+def _absolute_paths(parameters: dict) -> dict:
+    parameters = dict(parameters)
+    for key in PATH_PARAMETERS:
+        if parameters.get(key) is not None:
+            parameters[key] = os.path.abspath(parameters[key])
+    return parameters
+
+
+def run_defect(parameters: dict, processed_defects_dir: str = "ProcessedDefects", timeout: int = 1200, notebook: bool = True) -> JobResult:
+    ''' Runs the notebook for one defect in its own working directory
+
+    Args:
+        parameters: notebook parameters for the defect (global and defect specific), including defect_outputs_dir
+        processed_defects_dir: directory containing outputs for all defects
+        timeout: maximum time for each notebook cell (seconds)
+        notebook: if False, the analysis is run in this process with DefectCorrectionsPipeline.run_pipeline (timeout is not used)
+
+    Returns:
+        JobResult for the defect. The working directory is removed if the notebook ran successfully
+    '''
+    name = parameters["defect_outputs_dir"]
+    processed_defects_dir = os.path.abspath(processed_defects_dir)
+    outputs_dir = os.path.join(processed_defects_dir, name)
+    work_dir = os.path.join(processed_defects_dir, ".work", name)
+    os.makedirs(work_dir, exist_ok=True)
+    parameters = _absolute_paths(parameters)
+    parameters["processed_defects_dir"] = processed_defects_dir
+    # Workflow modules are imported by the notebook kernel, which does not run from this directory
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    python_path = os.environ.get("PYTHONPATH", "")
+    if module_dir not in python_path.split(os.pathsep):
+        os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [module_dir, python_path]))
+
+    start_time = time.time()
+    cwd = os.getcwd()
+    error = None
+    try:
+        os.chdir(work_dir)
+        if notebook:
+            # Imported here so that the rest of this module can be used without NotebookScripter installed
+            from NotebookScripter import run_notebook_in_jupyter
+            run_notebook_in_jupyter(NOTEBOOK, **parameters, timeout=timeout)("defect_outputs_dir", save_output_notebook=OUTPUT_NOTEBOOK)
+            os.makedirs(outputs_dir, exist_ok=True)
+            shutil.move(OUTPUT_NOTEBOOK, os.path.join(outputs_dir, OUTPUT_NOTEBOOK))
+        else:
+            import DefectCorrectionsPipeline as dcp
+            dcp.run_pipeline(parameters)
+    except Exception as err:
+        error = "{0}: {1}".format(type(err).__name__, err)
+    finally:
+        os.chdir(cwd)
+    if error is None:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return JobResult(name, error is None, error, time.time()-start_time, outputs_dir)
+
+
+def write_summary(results: list, summary_file: str):
+    ''' Writes one line per defect with whether it succeeded, its wall time and any error message '''
+    with open(summary_file, "w") as summary:
+        summary.write("Defect, status, wall time (s), error\n")
+        for result in results:
+            status = "OK" if result.success else "FAILED"
+            summary.write("{0}, {1}, {2:.1f}, {3}\n".format(result.name, status, result.runtime_seconds, result.error or ""))
+
+
+def run_dataset(global_configuration: dict, configurations: list, workers: int = 1, processed_defects_dir: str = "ProcessedDefects",
+                timeout: int = 1200, summary_file: str = None, notebook: bool = True) -> list:
+    ''' Runs the notebook for each defect, up to workers at the same time
+
+    Args:
+        global_configuration: notebook parameters shared by all defects
+        configurations: list of notebook parameters for each defect (each with a unique defect_outputs_dir)
+        workers: number of defects processed at the same time
+        processed_defects_dir: directory containing outputs for all defects
+        timeout: maximum time for each notebook cell (seconds)
+        summary_file: (optional) file for the summary of all defects, processed_defects_dir/dataset_summary.dat by default
+        notebook: if False, run DefectCorrectionsPipeline.run_pipeline for each defect rather than the notebook
+
+    Returns:
+        List of JobResult, in the same order as configurations
+    '''
+    os.makedirs(processed_defects_dir, exist_ok=True)
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_defect, dict(global_configuration, **config), processed_defects_dir, timeout, notebook): config["defect_outputs_dir"]
+                   for config in configurations}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as err:
+                # Worker process failed outside of the notebook (e.g. killed for running out of memory)
+                result = JobResult(name, False, "{0}: {1}".format(type(err).__name__, err), 0.0, os.path.join(processed_defects_dir, name))
+            results[name] = result
+            print("{0}: {1}".format(name, "finished" if result.success else "FAILED ("+str(result.error)+")"))
+            sys.stdout.flush()
+    results = [results[config["defect_outputs_dir"]] for config in configurations]
+    write_summary(results, summary_file or os.path.join(processed_defects_dir, "dataset_summary.dat"))
+    return results
@@ -0,0 +1,237 @@
+'''
+Command line driver for processing a set of charged defects, reading the defects from a dataset file and the inputs from
+the 'User inputs' cell of the notebook from a parameter file, rather than from DefectCorrectionsDataset.py
+(see sample_data/dataset/dataset.in and sample_data/dataset/input_para.in for the format of these files).
+
+All input paths are checked before any defect is processed, so a batch fails straight away if an FHI-aims output is missing.
+Defects are then run with DatasetRunner.py, up to --workers at the same time.
+
+Usage, from the directory containing the notebook file:
+    python DefectCorrectionsCLI.py sample_data/dataset/dataset.in sample_data/dataset/input_para.in --workers 4
+    python DefectCorrectionsCLI.py dataset.in input_para.in --only GaAs_m1 GaAs_m2 --dry-run
+'''
+
+import os
+import sys
+import argparse
+from ast import literal_eval
+import numpy as np
+import DefectSupercellAnalyses as dsa
+import CoffeeConvenienceFunctions as ccf
+import DefectCorrectionsPipeline as dcp
+import DatasetRunner as dr
+
+# Parameters that can be set in the parameter file: those in the 'User inputs' cell of the notebook that apply to all defects
+GLOBAL_PARAMETERS = tuple(key for key in dcp.REQUIRED_CONFIG if key not in ("defect_outputs_dir", "path_to_defect", "path_to_neutral", "defect_charge")) \
+    + tuple(key for key in dcp.DEFAULT_CONFIG if key != "processed_defects_dir")
+
+
+def read_dataset_file(dataset_file: str) -> dict:
+    ''' Defects listed in a dataset file, one per line: output dir, neutral defect dir, charged defect dir and charge state
+    (lines starting with # are comments)
+
+    Returns:
+        Dictionary keyed by output dir of [neutral_dir, charge_dir, charge_state], as defect_dataset in DefectCorrectionsDataset.py
+    '''
+    defect_dataset = {}
+    with open(dataset_file, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+            if len(words) != 4:
+                raise ValueError("Expected output dir, neutral dir, charged dir and charge state on line "+str(line_num)+" of "+str(dataset_file))
+            name, neutral_dir, charge_dir, charge_state = words
+            if name in defect_dataset:
+                raise ValueError("Output dir "+str(name)+" is used more than once in "+str(dataset_file))
+            defect_dataset[name] = [neutral_dir, charge_dir, int(charge_state)]
+    return defect_dataset
+
+
+def read_parameter_file(parameter_file: str) -> dict:
+    ''' Parameters in a parameter file, one per line as the parameter name followed by its value written as in python
+    (lines starting with # are comments)
+
+    Returns:
+        Dictionary of parameters, as global_configuration in DefectCorrectionsDataset.py
+    '''
+    parameters = {}
+    with open(parameter_file, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            words = line.split('#')[0].split(None, 1)
+            if not words:
+                continue
+            if len(words) != 2:
+                raise ValueError("Expected a parameter name and value on line "+str(line_num)+" of "+str(parameter_file))
+            key, value = words[0], words[1].strip()
+            if key not in GLOBAL_PARAMETERS:
+                raise ValueError("Unknown parameter "+str(key)+" on line "+str(line_num)+" of "+str(parameter_file))
+            try:
+                parameters[key] = literal_eval(value)
+            except (ValueError, SyntaxError):
+                raise ValueError("Could not read value of "+str(key)+" on line "+str(line_num)+" of "+str(parameter_file))
+    # IC = False is used in parameter files for no pre-computed LZ image-charge correction
+    if parameters.get("IC") is False:
+        parameters["IC"] = None
+    return parameters
+
+
+def defect_configurations(global_configuration: dict, defect_dataset: dict) -> list:
+    ''' Notebook parameters for each defect, with the defect directories joined to path_to_all_defects '''
+    base_dir = global_configuration["path_to_all_defects"]
+    return [{"defect_outputs_dir": name, "path_to_defect": os.path.join(base_dir, charge_dir), "path_to_neutral": os.path.join(base_dir, neutral_dir),
+             "defect_charge": charge_state} for name, (neutral_dir, charge_dir, charge_state) in defect_dataset.items()]
+
+
+def check_inputs(global_configuration: dict, configurations: list) -> list:
+    ''' Checks that every input needed for the requested correction schemes exists, before any defect is processed
+
+    Returns:
+        List of problems found (empty if all inputs are present)
+    '''
+    problems = ["Missing parameter "+str(key) for key in GLOBAL_PARAMETERS if key in dcp.REQUIRED_CONFIG and key not in global_configuration]
+    if problems:
+        return problems
+    config = dict(dcp.DEFAULT_CONFIG, **global_configuration)
+    required = ["geometry.in"]
+    if config["atom_centered_pa"] == True:
+        # Free atom potentials for the alignment are read from the planar average outputs
+        required += ["On-site_ESP.dat", "plane_average_realspace_ESP.out"]
+    if config["planar_av_pa"] == True:
+        required += ["plane_average_realspace_ESP.out"]
+    if not os.path.isdir(config["path_to_all_defects"]):
+        problems.append("Directory with all defects not found: "+str(config["path_to_all_defects"]))
+    checked = set()
+    for directory in [config["path_to_host"]] + [path for defect in configurations for path in (defect["path_to_neutral"], defect["path_to_defect"])]:
+        if directory in checked:
+            continue
+        checked.add(directory)
+        if not os.path.isdir(directory):
+            problems.append("Directory not found: "+str(directory))
+            continue
+        for filename in sorted(set(required)):
+            if not os.path.isfile(os.path.join(directory, filename)):
+                problems.append("FHI-aims output not found: "+str(os.path.join(directory, filename)))
+    return problems
+
+
+def planned_jobs(global_configuration: dict, configurations: list, sigma: float, cutoff: float) -> list:
+    ''' Charge model solves for each defect with their estimated sizes (see 'CoffeeConvenienceFunctions.estimate_charge_model')
+
+    Returns:
+        List of (defect_outputs_dir, supercell multiple, ChargeModelEstimate)
+    '''
+    multiples = global_configuration.get("charge_model_multiples", dcp.DEFAULT_CONFIG["charge_model_multiples"])
+    jobs = []
+    for config in configurations:
+        lattice_vecs = dsa.read_lattice_vectors(os.path.join(config["path_to_defect"], "geometry.in"))
+        for multiple in config.get("charge_model_multiples", multiples):
+            jobs.append((config["defect_outputs_dir"], tuple(multiple), ccf.estimate_charge_model(lattice_vecs, *multiple, sigma, cutoff)))
+    return jobs
+
+
+def fnv_sigma_and_cutoff(global_configuration: dict, manifest_file: str = None) -> tuple:
+    ''' Sigma and cutoff used for the charge models of all defects, as set by the notebook '''
+    sigma = global_configuration.get("manual_sigma")
+    if sigma is None:
+        sigma = dsa.dataset_sigma(global_configuration["path_to_all_defects"], os.path.join(global_configuration["path_to_host"], "geometry.in"),
+                                  manifest_file=manifest_file).sigma
+    cutoff = global_configuration.get("manual_cutoff")
+    if cutoff is None:
+        cutoff = (20.0/1.4)/sigma
+    return sigma, cutoff
+
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Finite-size corrections for a set of charged defect supercells from FHI-aims")
+    parser.add_argument("dataset_file", help="file listing output dir, neutral dir, charged dir and charge state of each defect (e.g. dataset.in)")
+    parser.add_argument("parameter_file", help="file with the inputs from the 'User inputs' cell of the notebook (e.g. input_para.in)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of defects processed at the same time (default: 1)")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only process these defects (output dirs in the dataset file)")
+    parser.add_argument("--skip", nargs="+", metavar="NAME", help="do not process these defects")
+    parser.add_argument("--dry-run", action="store_true", help="check inputs and print the planned charge model solves and their estimated sizes, without processing any defects")
+    parser.add_argument("--memory-budget", type=float, metavar="GB", help="memory available for the charge model solves of each defect (GB), larger supercells are dropped to fit")
+    parser.add_argument("--processed-defects-dir", default="ProcessedDefects", help="directory for the outputs of all defects (default: ProcessedDefects)")
+    parser.add_argument("--pipeline", action="store_true", help="run DefectCorrectionsPipeline.py for each defect instead of the notebook")
+    parser.add_argument("--timeout", type=int, default=1200, help="maximum time for each notebook cell in seconds (default: 1200)")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None) -> int:
+    args = parse_args(argv)
+    try:
+        defect_dataset = read_dataset_file(args.dataset_file)
+        global_configuration = read_parameter_file(args.parameter_file)
+    except (IOError, ValueError) as err:
+        print("Error: "+str(err))
+        return 2
+
+    unknown = [name for name in (args.only or []) + (args.skip or []) if name not in defect_dataset]
+    if unknown:
+        print("Error: defects not in "+str(args.dataset_file)+": "+", ".join(unknown))
+        return 2
+    defect_dataset = {name: defect for name, defect in defect_dataset.items()
+                      if (args.only is None or name in args.only) and name not in (args.skip or [])}
+    configurations = defect_configurations(global_configuration, defect_dataset)
+
+    problems = check_inputs(global_configuration, configurations)
+    if problems:
+        print("Error: inputs are missing, no defects have been processed")
+        for problem in problems:
+            print("  "+problem)
+        return 2
+
+    if global_configuration.get("FNV", dcp.DEFAULT_CONFIG["FNV"]) == True:
+        # Sigma depends on every defect in the dataset, so it is found once here before any defects are processed
+        manifest_file = None
+        if not args.dry_run:
+            os.makedirs(args.processed_defects_dir, exist_ok=True)
+            manifest_file = os.path.join(args.processed_defects_dir, "dataset_sigma.json")
+        sigma, cutoff = fnv_sigma_and_cutoff(global_configuration, manifest_file)
+        print("Sigma for Gaussian charge model of dataset = {0}, plane wave cutoff = {1}".format(sigma, cutoff))
+        if args.memory_budget is not None:
+            multiples = global_configuration.get("charge_model_multiples", dcp.DEFAULT_CONFIG["charge_model_multiples"])
+            for config in list(configurations):
+                lattice_vecs = dsa.read_lattice_vectors(os.path.join(config["path_to_defect"], "geometry.in"))
+                allowed = ccf.multiples_within_budget(lattice_vecs, sigma, cutoff, multiples, args.memory_budget*1024**3,
+                                                      workers=global_configuration.get("charge_model_workers", 1))
+                if len(allowed) < 2:
+                    print("Skipping {0}: charge models do not fit in the memory budget of {1} GB".format(config["defect_outputs_dir"], args.memory_budget))
+                    configurations.remove(config)
+                elif len(allowed) < len(multiples):
+                    config["charge_model_multiples"] = [list(multiple) for multiple in allowed]
+        jobs = planned_jobs(global_configuration, configurations, sigma, cutoff)
+        if args.dry_run:
+            print("Planned charge model solves:")
+            for name, multiple, estimate in jobs:
+                print("  {0} {1}: grid {2}, memory {3:.2f} GB, runtime {4:.0f} s{5}".format(
+                    name, "x".join(str(n) for n in multiple), "x".join(str(n) for n in estimate.grid), estimate.memory_bytes/1024**3,
+                    estimate.runtime_seconds, "" if estimate.sigma_ok else " (sigma looks too large)"))
+            print("Total estimated runtime for {0} solves: {1:.0f} s".format(len(jobs), sum(estimate.runtime_seconds for _, _, estimate in jobs)))
+
+    if args.dry_run:
+        print("Dry run: {0} defects would be processed with {1} workers: {2}".format(
+            len(configurations), args.workers, ", ".join(config["defect_outputs_dir"] for config in configurations)))
+        return 0
+
+    if global_configuration.get("LZ", dcp.DEFAULT_CONFIG["LZ"]) == True and global_configuration.get("IC") is None:
+        # LZ image-charge correction for every charge state in the dataset at once, the unit-charge terms are only computed for the host lattice once
+        import PyladaDefectsImageCharge as pdic
+        lattice_vec_array = dsa.lattice_vectors_array(os.path.join(global_configuration["path_to_host"], "geometry.in"))
+        dielectric_av = (global_configuration["dielectric_xx"]+global_configuration["dielectric_yy"]+global_configuration["dielectric_zz"])/3.0
+        precomputed_IC = pdic.image_charge_corrections(np.transpose(lattice_vec_array), set(config["defect_charge"] for config in configurations), dielectric_av, cutoff=50.)
+        for config in configurations:
+            config["IC"] = precomputed_IC[config["defect_charge"]]
+
+    results = dr.run_dataset(global_configuration, configurations, workers=args.workers, processed_defects_dir=args.processed_defects_dir,
+                             timeout=args.timeout, notebook=not args.pipeline)
+    failed = [result.name for result in results if not result.success]
+    print("See "+os.path.join(args.processed_defects_dir, "dataset_summary.dat")+" for the status of every defect.")
+    if failed:
+        print("Processing failed for: "+", ".join(failed))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,33 +9,31 @@ After making these modification, run this script from command line using 'python
 
 '''
 
-from NotebookScripter import run_notebook_in_jupyter
 import os
-import shutil
 from ast import literal_eval
 import PyladaDefectsImageCharge as pdic
+import DefectSupercellAnalyses as dsa
+import CoffeeConvenienceFunctions as ccf
+import DatasetRunner as dr
 import numpy as np
 
 ############## USER INPUTS START BELOW HERE #################
 
 # Option to speed up analysis when calculating LZ image-charge corrections for dataset.
-# The term can be pre-computed if you have several defects in your dataset with the same charge state.
-# If you would like to do this, set 'precompute_LZ' to True, uncomment the next set of lines adding in your dielectric constants, lattice vectors and list of defect charge states.
+# If set to True, the term is computed once here for every charge state in the dataset (from the lattice vectors of the
+# host supercell and the dielectric constants below) and passed to the notebook for each defect as IC.
 precompute_LZ = False
-'''
-dielectric_xx = 7.49
-dielectric_yy = 6.92
-dielectric_zz = 7.19
-latt_vecs = np.array([[1.48588928e+01, -9.37860000e-04, -6.44980000e-04], [4.60260000e-04, 1.29147523e+01, -1.08640000e-03], [-1.05560000e-04, -2.17860000e-04, 1.23346688e+01]])
-dielectric_av = (dielectric_xx+dielectric_yy+dielectric_zz)/3.0
-charge_list = [-2, -1, 1, 2]
-precomputed_IC = []
-for precompute in charge_list:
-    # Using modified function from pylada-defects to compute LZ image charge correction
-    Madelung_energy, ThirdOrder, csh, scaling_f, E_corr_LZ = pdic.get_imagecharge(np.transpose(latt_vecs), charge=precompute, epsilon=dielectric_av,cutoff=50.)
-    precomputed_IC.append(E_corr_LZ)
-assert (len(charge_list) == len(precomputed_IC)), 'Error pre-computing LZ IC term.'
-'''
+
+# Memory available for FNV charge model solves of each defect (in GB), or None for no limit.
+# Jobs are run with fewer (smaller) supercells for the E_q^{iso,m} extrapolation if the 3x3x3 charge model would not fit, or skipped if less than two fit.
+memory_budget_GB = None
+
+# Number of defects processed at the same time (each in its own working directory)
+workers = 1
+
+# Set to False to run the analysis for each defect with DefectCorrectionsPipeline.py rather than the notebook.
+# This avoids starting a Jupyter kernel for each defect, but no output notebook is written.
+use_notebook = True
 
 # Define directory containing all defects data
 base_dir = "./sample_data/relaxed_defects/Cu3AsS4"
@@ -49,7 +47,14 @@ global_configuration = {
     "LZ": False,
     "FNV": True,
     "atom_centered_pa": True,
-    "planar_av_pa": False
+    "planar_av_pa": False,
+    # Set to override the values determined from the dataset (Angstroms and Hartree respectively)
+    "manual_sigma": None,
+    "manual_cutoff": None,
+    # Set to 3 to solve the three FNV charge models for each defect at the same time
+    "charge_model_workers": 1,
+    # Solve FNV charge models once at unit charge for each defect site and scale them for every charge state
+    "charge_ladder": True
 }
 
 # Dictionary storing location of data for each charged defect to be analysed 
@@ -74,46 +79,74 @@ defect_dataset = {
 ################# END OF USER INPUTS #####################
 
 
-# Notebook parameters for specific charged defect to be processed
-configurations = []
-for name, (neutral_dir, charge_dir, charge_state) in defect_dataset.items():
-    # make sure required inputs exists
-    path_to_defect = os.path.join(base_dir, charge_dir)
-    path_to_neutral = os.path.join(base_dir, neutral_dir)  
-    assert os.path.isdir(path_to_defect), 'required input directory is missing {0}'.format(path_to_defect)
-    assert os.path.isdir(path_to_neutral), 'required input directory is missing {0}'.format(path_to_neutral)
-    if (precompute_LZ == True):
-        for i in charge_list:
-            if (charge_state == charge_list[i]):
-                precomputed_val = precomputed_IC[i]
-        config = {
-            "defect_outputs_dir": name,
-            "path_to_defect": path_to_defect,
-            "path_to_neutral": path_to_neutral,
-            "defect_charge": charge_state,
-            "IC": precomputed_val
-        }
-    else:
+def main():
+    # Sigma for the FNV charge model depends on every defect in the dataset, so it is found once here before any notebooks are run.
+    # The result is stored in a manifest that each notebook run reads, rather than each run re-reading all defect geometries.
+    if global_configuration["FNV"] == True and global_configuration["manual_sigma"] is None:
+        os.makedirs("ProcessedDefects", exist_ok=True)
+        sigma_prepass = dsa.dataset_sigma(global_configuration["path_to_all_defects"], os.path.join(global_configuration["path_to_host"], "geometry.in"), manifest_file=os.path.join("ProcessedDefects", "dataset_sigma.json"))
+        print("Sigma for Gaussian charge model of dataset = {0}, plane wave cutoff = {1}".format(sigma_prepass.sigma, sigma_prepass.cutoff))
+
+    if precompute_LZ == True:
+        # E1 and E3 terms are computed once for the host lattice and scaled for each charge state (see 'PyladaDefectsImageCharge.unit_charge_terms')
+        latt_vecs = dsa.lattice_vectors_array(os.path.join(global_configuration["path_to_host"], "geometry.in"))
+        dielectric_av = (global_configuration["dielectric_xx"]+global_configuration["dielectric_yy"]+global_configuration["dielectric_zz"])/3.0
+        charge_list = sorted(set(charge_state for neutral_dir, charge_dir, charge_state in defect_dataset.values()))
+        precomputed_IC = pdic.image_charge_corrections(np.transpose(latt_vecs), charge_list, dielectric_av, cutoff=50.)
+        print("Pre-computed LZ image-charge corrections (eV) for charge states: {0}".format(precomputed_IC))
+
+    if global_configuration["FNV"] == True:
+        # Values used by the notebook, for the pre-flight checks below
+        dataset_sigma = global_configuration["manual_sigma"] or sigma_prepass.sigma
+        dataset_cutoff = global_configuration["manual_cutoff"] or (20.0/1.4)/dataset_sigma
+
+    # Notebook parameters for specific charged defect to be processed
+    configurations = []
+    for name, (neutral_dir, charge_dir, charge_state) in defect_dataset.items():
+        # make sure required inputs exists
+        path_to_defect = os.path.join(base_dir, charge_dir)
+        path_to_neutral = os.path.join(base_dir, neutral_dir)  
+        assert os.path.isdir(path_to_defect), 'required input directory is missing {0}'.format(path_to_defect)
+        assert os.path.isdir(path_to_neutral), 'required input directory is missing {0}'.format(path_to_neutral)
         config = {
             "defect_outputs_dir": name,
             "path_to_defect": path_to_defect,
             "path_to_neutral": path_to_neutral,
             "defect_charge": charge_state,
-            "IC": None
+            "IC": precomputed_IC[charge_state] if precompute_LZ == True else None
         }
-    configurations.append(config)
-#print(configurations)
-
-# Use NotebookScripter to run notebook for each charged defect in turn
-for config in configurations: 
-    try:
-        notebook = run_notebook_in_jupyter("./DefectCorrectionsNotebook.ipynb", **global_configuration, **config,timeout=1200)("defect_outputs_dir", save_output_notebook="output_DefectCorrectionsNotebook.ipynb")
-        shutil.move("./output_DefectCorrectionsNotebook.ipynb", os.path.join(notebook.defect_outputs_dir, "output_DefectCorrectionsNotebook.ipynb"))
-    except Exception as err:
-        print("Caught error when executing notebook: {0}".format(err))
-
-print("")
-print("FINISHED")
-print("Outputs for all defects processed can be found in directories ProcessedDefects/: "+ ", ".join(defect_dataset.keys()) )
-print("See log.info files in each subdirectory for an overview of the analysis and corrections_summary.dat for final correction terms.")
-print("Have a nice day!")
\ No newline at end of file
+        if global_configuration["FNV"] == True:
+            # Pre-flight check of the charge model solves before any are run
+            lattice_vecs = dsa.read_lattice_vectors(os.path.join(path_to_defect, "geometry.in"))
+            multiples = [(1, 1, 1), (2, 2, 2), (3, 3, 3)]
+            if not ccf.estimate_charge_model(lattice_vecs, 1, 1, 1, dataset_sigma, dataset_cutoff).sigma_ok:
+                print("Warning: sigma = {0} looks too large for the supercell of {1}".format(dataset_sigma, name))
+            if memory_budget_GB is not None:
+                allowed = ccf.multiples_within_budget(lattice_vecs, dataset_sigma, dataset_cutoff, multiples, memory_budget_GB*1024**3,
+                                                      workers=global_configuration["charge_model_workers"])
+                if len(allowed) < 2:
+                    print("Skipping {0}: charge models do not fit in the memory budget of {1} GB".format(name, memory_budget_GB))
+                    continue
+                if len(allowed) < len(multiples):
+                    print("Using charge models {0} for {1} to stay within the memory budget".format(allowed, name))
+                    config["charge_model_multiples"] = [list(multiple) for multiple in allowed]
+        configurations.append(config)
+    #print(configurations)
+
+    # Use NotebookScripter to run notebook for each charged defect, up to 'workers' at the same time
+    results = dr.run_dataset(global_configuration, configurations, workers=workers, notebook=use_notebook)
+
+    print("")
+    print("FINISHED")
+    print("Outputs for all defects processed can be found in directories ProcessedDefects/: "+ ", ".join(result.name for result in results if result.success))
+    failed = [result.name for result in results if not result.success]
+    if failed:
+        print("Processing failed for: "+", ".join(failed)+". Working directories have been kept in ProcessedDefects/.work for these defects.")
+    print("See ProcessedDefects/dataset_summary.dat for the status of every defect.")
+    print("See log.info files in each subdirectory for an overview of the analysis and corrections_summary.dat for final correction terms.")
+    print("Have a nice day!")
+
+
+# Guard needed as defects are processed in separate processes, which may import this script
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,563 @@
+'''
+The analysis performed by DefectCorrectionsNotebook.ipynb as importable functions, so that corrections for a charged
+defect can be computed without starting a Jupyter kernel (e.g. for each defect of a dataset in a process pool).
+
+Each step of the notebook (reading the host supercell, locating the defect, the LZ and FNV correction schemes and the
+potential alignment steps) is a function below, which the notebook calls in turn and adds plots to. run_pipeline runs all
+of the steps for one defect from a dictionary of the parameters in the 'User inputs' cell of the notebook (as built by
+DefectCorrectionsDataset.py) and returns the results as a CorrectionResults.
+
+To use, the following lines must be added to the code:
+    import DefectCorrectionsPipeline as dcp
+    results = dcp.run_pipeline(dict(global_configuration, **config))
+'''
+
+import os
+import logging
+import numpy as np
+from collections import namedtuple
+import DefectSupercellAnalyses as dsa
+import CoffeeConvenienceFunctions as ccf
+import PlanarAverage as pa
+import SolverGrids as sg
+import LogFileSetup as lfs
+import PlottingFunctions as ptt
+import AtomPotentialAlignment as apa
+import ParsedDataCache as pdc
+logger = logging.getLogger()
+
+Ha_eV = 27.2116   # hartree to eV
+A_bohr = 1.88972598858   # angstrom to bohr
+
+# Parameters in the 'User inputs' cell of the notebook that have defaults, all other parameters must be set
+DEFAULT_CONFIG = {
+    "processed_defects_dir": "ProcessedDefects",
+    "LZ": True,
+    "FNV": True,
+    "atom_centered_pa": True,
+    "planar_av_pa": True,
+    "IC": None,
+    "manual_sigma": None,
+    "manual_cutoff": None,
+    "charge_model_workers": 1,
+    "charge_ladder": False,
+    "charge_model_multiples": [[1, 1, 1], [2, 2, 2], [3, 3, 3]],
+    "E_iso_tolerance": None,
+    # Figures are queued and drawn after the corrections are written (see PlottingFunctions.configure_plotting),
+    # by plot_workers background processes if more than 1, as png files at plot_dpi unless another plot_format is given
+    "headless_plots": True,
+    "plot_dpi": 600,
+    "plot_format": "png",
+    "plot_workers": 1
+}
+REQUIRED_CONFIG = ("dielectric_xx", "dielectric_yy", "dielectric_zz", "path_to_all_defects", "path_to_host", "defect_outputs_dir",
+                   "path_to_defect", "path_to_neutral", "defect_charge")
+
+# FHI-aims outputs used for a defect (default FHI-aims filenames)
+InputFiles = namedtuple('InputFiles', ['host_geom', 'defect_geom', 'host_atom_pot', 'charged_defect_atom_pot', 'neutral_defect_atom_pot',
+                                       'host_planeAv_pot', 'charged_defect_planeAv_pot', 'neutral_defect_planeAv_pot'])
+# Files written to the output directory of a defect
+OutputFiles = namedtuple('OutputFiles', ['defect_outputs_dir', 'charge_model_file', 'FNV_planar_pa_FNV_file', 'FNV_planar_pa_C1_file',
+                                         'FNV_planar_pa_C2_file', 'FNV_atom_pa_file', 'LZ_planar_pa_file', 'LZ_atom_pa_file', 'E_iso_file',
+                                         'final_outputs_file'])
+# Geometry of the perfect host supercell (geometry is the Geometry from 'read_geometry' the other fields are taken from)
+HostSupercell = namedtuple('HostSupercell', ['coords', 'coords_frac', 'atom_num', 'supercell_dims', 'lattice_vec_array', 'geometry'])
+# Geometry of the defect supercell and the defect located in it: defect_type ('vacancy', 'interstitial' or 'antisite'),
+# species (species_vac, species_int or (species_in, species_out)), coordinates of the defect (Angstroms), line of the defect atom,
+# SiteMap between host and defect atoms and nearest distances of the defect to the supercell boundaries
+DefectSite = namedtuple('DefectSite', ['coords', 'coords_frac', 'atom_num', 'defect_type', 'species', 'x', 'y', 'z', 'line', 'site_map',
+                                       'distances_to_boundary'])
+# E_q^{lat} from the charge models: supercell multiples and E_q^{per,m} of each charge model (in order of increasing volume),
+# 1/Omega^(1/3) of each, coefficients (f_1, f_2, f_3) of the fit, E_q^{iso,m} with its standard error and E_q^{lat}
+LatticeEnergy = namedtuple('LatticeEnergy', ['multiples', 'E_per', 'inverse_lengths', 'coefficients', 'E_iso', 'E_iso_error', 'E_lat'])
+# Results for a defect, terms of schemes that were not requested are None
+CorrectionResults = namedtuple('CorrectionResults', ['outputs', 'host', 'defect', 'E_corr_LZ', 'pa_atom_LZ', 'pa_planAv_LZ', 'sigma', 'cutoff',
+                                                     'lattice_energy', 'pa_atom_FNV', 'pa_planAv_C1', 'pa_planAv_C2', 'pa_planAv_CF', 'pa_planAv_Frey'])
+CorrectionResults.__new__.__defaults__ = (None,)*len(CorrectionResults._fields)
+
+
+def input_files(path_to_host: str, path_to_defect: str, path_to_neutral: str) -> InputFiles:
+    ''' Paths to the FHI-aims outputs for the host, charged defect and neutral defect supercells '''
+    return InputFiles(os.path.join(path_to_host, "geometry.in"), os.path.join(path_to_defect, "geometry.in"),
+                      os.path.join(path_to_host, "On-site_ESP.dat"), os.path.join(path_to_defect, "On-site_ESP.dat"),
+                      os.path.join(path_to_neutral, "On-site_ESP.dat"), os.path.join(path_to_host, "plane_average_realspace_ESP.out"),
+                      os.path.join(path_to_defect, "plane_average_realspace_ESP.out"), os.path.join(path_to_neutral, "plane_average_realspace_ESP.out"))
+
+
+def output_files(defect_outputs_dir: str, plot_format: str = "png") -> OutputFiles:
+    ''' Paths to the outputs written for a defect to defect_outputs_dir, with figures saved in plot_format '''
+    names = ("CoFFEE_charge_model.dat", "FNV_planar_pa_Frey", "FNV_planar_pa_C1", "FNV_planar_pa_C2", "FNV_atom_pa",
+             "LZ_planar_pa", "LZ_atom_pa", "E_iso", "corrections_summary.dat")
+    names = [name if '.' in name else name+'.'+plot_format for name in names]
+    return OutputFiles(defect_outputs_dir, *[os.path.join(defect_outputs_dir, name) for name in names])
+
+
+def read_host(host_geom: str) -> HostSupercell:
+    ''' Geometry of the perfect host supercell. The lattice vectors (and supercell dimensions) are the same for the
+    defect supercells, as their volume has not been relaxed '''
+    return HostSupercell(dsa.read_atom_coords(host_geom), dsa.read_atom_coords_frac(host_geom), dsa.count_atoms(host_geom),
+                         dsa.get_supercell_dimensions(host_geom), dsa.lattice_vectors_array(host_geom), dsa.read_geometry(host_geom))
+
+
+def identify_defect(host: HostSupercell, defect_geom: str, defect_charge: int) -> DefectSite:
+    ''' Locates the defect by comparing the defect supercell to the perfect host supercell
+
+    Args:
+        host: HostSupercell from 'read_host'
+        defect_geom: geometry.in file of the defect supercell
+        defect_charge: charge state of the defect (only used for log messages)
+
+    Returns:
+        DefectSite for the defect
+    '''
+    defect_coords = dsa.read_atom_coords(defect_geom)
+    defect_atom_num = dsa.count_atoms(defect_geom)
+    try:
+        site = dsa.locate_defect(host.geometry, dsa.read_geometry(defect_geom))
+    except ValueError:
+        logger.info("Error identifying defect type")
+        raise ValueError("Error identifying defect type of "+str(defect_geom))
+    defect_type, defect_line = site.defect_type, site.defect_line
+    defect_x, defect_y, defect_z = site.cart_coords.tolist()
+    if (defect_type == 'vacancy'):
+        species = site.species
+        logger.info('Defect is a '+str(species)+' vacancy with charge '+str(defect_charge))
+        logger.info('Defect coordinates in host supercell (Angstroms): '+str(defect_x)+', '+str(defect_y)+', '+str(defect_z))
+    elif (defect_type == 'interstitial'):
+        species = site.species
+        logger.info('Defect is a '+str(species)+' interstitial with charge '+str(defect_charge))
+        logger.info('Defect coordinates in defect supercell (Angstroms): '+str(defect_x)+', '+str(defect_y)+', '+str(defect_z))
+    else:
+        species = (site.species, site.species_out)
+        logger.info('Defect is a '+str(site.species)+'-on-'+str(site.species_out)+' antisite with charge '+str(defect_charge))
+        logger.info('Defect coordinates in defect supercell (Angstroms): '+str(defect_x)+', '+str(defect_y)+', '+str(defect_z))
+        logger.info('Defect atom line number:' + str(defect_line))
+
+    # Map between atoms in host and defect supercells, used by all potential alignment steps
+    site_map = dsa.build_site_map(defect_type, defect_line, host.atom_num, defect_atom_num)
+    distances_to_boundary = dsa.defect_to_boundary(defect_x, defect_y, defect_z, *host.supercell_dims[:3])
+    logger.info("Nearest defect distances to supercell boundaries (Angstroms): "+", ".join(str(distance) for distance in distances_to_boundary))
+    return DefectSite(defect_coords, dsa.read_atom_coords_frac(defect_geom), defect_atom_num, defect_type, species,
+                      defect_x, defect_y, defect_z, defect_line, site_map, distances_to_boundary)
+
+
+def lz_image_charge(lattice_vec_array: np.ndarray, defect_charge: int, dielectric_xx: float, dielectric_yy: float, dielectric_zz: float,
+                    IC: float = None) -> float:
+    ''' LZ image-charge correction E_corr_LZ, or IC if it has been pre-computed for defects in the same charge state '''
+    if IC is None:
+        # Imported here so that the rest of this module can be used without pylada installed
+        import PyladaDefectsImageCharge as pdic
+        # Isotropic average of dielectric constant
+        dielectric_av = (dielectric_xx+dielectric_yy+dielectric_zz)/3.0
+        # Using modified functions from pylada-defects to compute LZ image charge correction,
+        # the unit-charge terms are only computed once for each lattice (see 'PyladaDefectsImageCharge.unit_charge_terms')
+        E_corr_LZ = pdic.image_charge_correction(np.transpose(lattice_vec_array), defect_charge, dielectric_av, cutoff=50.)
+    else:
+        E_corr_LZ = IC
+    logger.info("LZ image-charge correction, E_corr_LZ = "+str(E_corr_LZ))
+    return E_corr_LZ
+
+
+def aims_atom_potentials(host: HostSupercell, defect: DefectSite, inputs: InputFiles, defect_atom_pot: str) -> np.ndarray:
+    ''' Distance of each atom from the defect and the difference of its FHI-aims atom potential between the defect supercell
+    (defect_atom_pot, On-site_ESP.dat of the neutral or charged defect) and the host supercell, with the sign used for plots '''
+    # Average free atom potentials read in from header of planar average potential FHI-aims output
+    # (Additional shift term necessary for FHI-aims)
+    shift_H = apa.read_free_atom_pot(inputs.host_planeAv_pot)
+    shift_D = apa.read_free_atom_pot(inputs.neutral_defect_planeAv_pot)
+    aims_atom_pots = apa.fhiaims_atomic_pot(defect.defect_type, host.atom_num, defect.atom_num, defect.line, host.lattice_vec_array,
+                                            dsa.coords_to_array(host.coords_frac), dsa.coords_to_array(defect.coords_frac),
+                                            inputs.host_atom_pot, defect_atom_pot, shift_H, shift_D, site_map=defect.site_map)
+    aims_atom_pots[:, 1] = -1.0*aims_atom_pots[:, 1]
+    return aims_atom_pots
+
+
+def lz_atom_alignment(host: HostSupercell, defect: DefectSite, inputs: InputFiles, outputs: OutputFiles, defect_charge: int) -> float:
+    ''' LZ potential alignment q(V_0 - V_host) with atom potentials, far from the defect (plotted to outputs.LZ_atom_pa_file) '''
+    aims_atom_pots = aims_atom_potentials(host, defect, inputs, inputs.neutral_defect_atom_pot)
+    np.savetxt(os.path.join(outputs.defect_outputs_dir, 'atom_potentials_FHI-aims_LZ.txt'), aims_atom_pots)
+    alignment = apa.atom_alignment(host.lattice_vec_array, aims_atom_pots)
+    pa_atom_LZ = -1.0*defect_charge*alignment.mean
+    ptt.plot_atom_average_alignment(host.lattice_vec_array, defect_charge, aims_atom_pots, None, False, outputs.LZ_atom_pa_file, alignment=alignment)
+    logger.info("LZ potential alignment correction with atom centres: "+str(pa_atom_LZ))
+    logger.info("Sampled "+str(alignment.count)+" atoms, standard deviation of potential = "+str(alignment.std))
+    logger.info("See "+str(outputs.LZ_atom_pa_file)+" for plot of LZ alignment with atom potentials.")
+    return pa_atom_LZ
+
+
+def _read_planar_pots(*planar_pot_files) -> list:
+    ''' (average free atom potential, planar average) for each 'plane_average_realspace_ESP.out' file '''
+    # Check FHI-aims outputs exist before trying to generate plot
+    for planar_pot_file in planar_pot_files:
+        if not os.path.exists(planar_pot_file):
+            raise Exception("Required FHI-aims output file not found")
+    # Each file is only read once in a run (e.g. the host file for the LZ and both FNV alignments)
+    planar_pots = [pa.read_planar_pot(planar_pot_file) for planar_pot_file in planar_pot_files]
+    return [(planar_pot.free_atom_pot, planar_pot.planar_pot) for planar_pot in planar_pots]
+
+
+def lz_planar_alignment(host: HostSupercell, defect: DefectSite, inputs: InputFiles, outputs: OutputFiles, defect_charge: int) -> float:
+    ''' LZ potential alignment q(V_0 - V_host) with planar averages, far from the defect (plotted to outputs.LZ_planar_pa_file) '''
+    (offset_o, origin), (offset_d, defect_neutral_pot) = _read_planar_pots(inputs.host_planeAv_pot, inputs.neutral_defect_planeAv_pot)
+    X = defect_neutral_pot[:, 0]
+    Y = -1.0*(defect_neutral_pot[:, 1]*Ha_eV - offset_d - (origin[:, 1]*Ha_eV-offset_o))
+    pa_planAv_LZ = float(ptt.plot_planar_average_alignment(host.supercell_dims[2], defect.z, defect_charge, X, Y, None, False, False, outputs.LZ_planar_pa_file))
+    logger.info("LZ potential alignment correction with planar average: "+str(pa_planAv_LZ))
+    logger.info("See "+str(outputs.LZ_planar_pa_file)+" for plot of LZ alignment with planar average of the potential.")
+    return pa_planAv_LZ
+
+
+def fnv_sigma(path_to_all_defects: str, host_geom: str, processed_defects_dir: str, manual_sigma: float = None) -> float:
+    ''' Sigma of the Gaussian charge model (Angstroms): 10% less than the closest distance of any defect in the dataset to a
+    supercell boundary (stored in processed_defects_dir/dataset_sigma.json, see 'DefectSupercellAnalyses.dataset_sigma'),
+    unless manual_sigma is set '''
+    if manual_sigma is not None:
+        logger.info("Sigma used for Gaussian charge model overwritten with sigma = "+str(manual_sigma))
+        return manual_sigma
+    logger.info("The following parameters were calculated for obtaining E_cor_FNV:")
+    sigma_prepass = dsa.dataset_sigma(path_to_all_defects, host_geom, manifest_file=os.path.join(processed_defects_dir, "dataset_sigma.json"))
+    logger.info("Closest distance of any defect in set to a supercell boundary (Angstroms) = "+str(sigma_prepass.closest_defect_to_boundary))
+    logger.info("Sigma used for Gaussian charge model = "+str(sigma_prepass.sigma))
+    return sigma_prepass.sigma
+
+
+def fnv_cutoff(sigma: float, manual_cutoff: float = None) -> float:
+    ''' Plane wave cutoff (Hartree) for the Poisson solver, 20.0 Hartree was found to converge well for sigma=1.4, unless manual_cutoff is set '''
+    cutoff = manual_cutoff if manual_cutoff is not None else (20.0/1.4)/sigma
+    logger.info("Cutoff used for Gaussian charge model = "+str(cutoff))
+    return cutoff
+
+
+def fnv_charge_models(defect_geom: str, defect: DefectSite, sigma: float, cutoff: float, defect_charge: int, dielectric_xx: float,
+                      dielectric_yy: float, dielectric_zz: float, defect_outputs_dir: str, charge_model_multiples: list = ((1, 1, 1), (2, 2, 2), (3, 3, 3)),
+                      charge_model_workers: int = 1, charge_ladder: bool = False, E_iso_tolerance: float = None) -> dict:
+    ''' Solves the Gaussian charge models for supercells of the defect supercell, used to obtain E_q^{per,m} for each.
+    The grids of the 1x1x1 charge model (V_r.npy, G1-3.npy and V_G-model.npy) are kept in defect_outputs_dir for the potential alignment.
+
+    Args:
+        defect_geom: geometry.in file of the defect supercell
+        defect: DefectSite from 'identify_defect'
+        sigma, cutoff: sigma (Angstroms) and plane wave cutoff (Hartree) for the charge model
+        defect_charge, dielectric_xx, dielectric_yy, dielectric_zz: charge state and dielectric constants, as in the notebook
+        defect_outputs_dir: directory for the solver inputs, outputs and grids
+        charge_model_multiples: supercell multiples of the defect supercell solved
+        charge_model_workers: number of charge models solved at the same time (not used with E_iso_tolerance, as supercells are then solved in turn)
+        charge_ladder: solve for unit charge and scale to defect_charge (see 'CoffeeConvenienceFunctions.scale_charge_model')
+        E_iso_tolerance: (optional) only solve larger supercells until E_q^{iso,m} changes by less than this value (eV), checked from
+            the third supercell on, so charge_model_multiples needs more than three multiples (e.g. 'CoffeeConvenienceFunctions.CONVERGENCE_MULTIPLES')
+
+    Returns:
+        Dictionary of ChargeModelSolution keyed by supercell multiple (tuple)
+    '''
+    lattice_vecs = dsa.read_lattice_vectors(defect_geom)
+    charge_model_multiples = [tuple(multiple) for multiple in charge_model_multiples]
+    # Pre-flight estimate of the size of each solve, before anything is run
+    cm_estimates = [ccf.estimate_charge_model(lattice_vecs, *multiple, sigma, cutoff) for multiple in charge_model_multiples]
+    for multiple, cm_estimate in zip(charge_model_multiples, cm_estimates):
+        logger.info("Charge model "+"x".join(str(n) for n in multiple)+": estimated grid "+str(cm_estimate.grid)+", memory "+str(round(cm_estimate.memory_bytes/1024**3, 2))+" GB, runtime "+str(round(cm_estimate.runtime_seconds))+" s")
+    # Sigma is checked against the defect supercell, so warned about once if any charge model is affected
+    if not all(cm_estimate.sigma_ok for cm_estimate in cm_estimates):
+        logger.info('Looks like sigma is too large try setting a smaller value than '+str(sigma)+'. See notebook cell (User option: manually override sigma value).')
+    solver_args = (sigma, cutoff, defect_charge, defect.x, defect.y, defect.z, dielectric_xx, dielectric_yy, dielectric_zz)
+    if E_iso_tolerance is not None:
+        if charge_model_workers > 1:
+            logger.info("charge_model_workers is ignored as E_iso_tolerance is set: supercells are solved one at a time until E_q^{iso,m} converges")
+        # Supercells are solved in order of increasing volume until E_q^{iso,m} has converged
+        E_iso_extrapolation = ccf.extrapolate_charge_model(lattice_vecs, *solver_args, multiples=charge_model_multiples, tolerance=E_iso_tolerance,
+                                                           artifacts_dir=defect_outputs_dir, grids_dir=defect_outputs_dir, charge_ladder=charge_ladder)
+        if not E_iso_extrapolation.converged:
+            logger.info("E_q^{iso,m} did not converge to within "+str(E_iso_tolerance)+" eV, consider adding larger supercells to charge_model_multiples")
+        return dict(zip(E_iso_extrapolation.multiples, E_iso_extrapolation.solutions))
+    if charge_model_workers > 1:
+        # Each charge model is solved in its own temporary directory in a separate process
+        return ccf.solve_charge_models(lattice_vecs, *solver_args, defect_outputs_dir, multiples=charge_model_multiples, keep_grids_for=(1, 1, 1),
+                                       max_workers=charge_model_workers, charge_ladder=charge_ladder)
+    charge_models = {}
+    for multiple in sorted(charge_model_multiples, key=np.prod, reverse=True):
+        charge_models[multiple] = ccf.cached_solve_charge_model(lattice_vecs, *multiple, *solver_args, artifacts_dir=defect_outputs_dir,
+                                                                grids_dir=defect_outputs_dir if multiple == (1, 1, 1) else None, charge_ladder=charge_ladder)
+    return charge_models
+
+
+def fnv_lattice_energy(charge_models: dict, supercell_dims: list, sigma: float, defect_outputs_dir: str) -> LatticeEnergy:
+    ''' E_q^{lat} = E_q^{iso,m} - E_q^{per,m}, with E_q^{iso,m} from a fit of p(Omega) = f_1/(Omega^(1/3)) + f_2/(Omega) + f_3 to E_q^{per,m}
+    of the charge models (see 'CoffeeConvenienceFunctions.fit_isolated_energy')
+
+    Args:
+        charge_models: dictionary of ChargeModelSolution keyed by supercell multiple, from 'fnv_charge_models'
+        supercell_dims: dimensions of the defect supercell (Angstroms)
+        sigma: sigma of the charge models (only used for log messages)
+        defect_outputs_dir: directory with the cm_<multiple>.out solver outputs (only used for log messages)
+
+    Returns:
+        LatticeEnergy, raises ValueError if E_q^{per,m} could not be found for the 1x1x1 and at least one larger supercell
+    '''
+    cm_multiples = []
+    E_q_per_m = []
+    for multiple in sorted(charge_models, key=np.prod):
+        cm_name = "x".join(str(n) for n in multiple)
+        cm_output = os.path.join(defect_outputs_dir, "cm_"+cm_name+".out")
+        if charge_models[multiple].sigma_too_large:
+            logger.info('Looks like sigma is too large try setting a smaller value than '+str(sigma)+'. See notebook cell (User option: manually override sigma value).')
+        if charge_models[multiple].energy is None:
+            logger.info('Warning! - Error finding E_q^{per,m}, check '+str(cm_output)+' for error messages')
+        else:
+            cm_multiples.append(multiple)
+            E_q_per_m.append(charge_models[multiple].energy)
+            logger.info("E_q_per_m for "+cm_name+" = "+str(E_q_per_m[-1]))
+    if (len(E_q_per_m) < 2 or cm_multiples[0] != (1, 1, 1)):
+        logger.info("Error in extracting E_q for charge models.")
+        raise ValueError("Error in extracting E_q for charge models, see the cm_*.out files in "+str(defect_outputs_dir))
+
+    # alat is used as scaling parameter for lattice vectors of supercell: (supercell_vol)**(1/3) in Angstrom
+    alat = np.prod(supercell_dims)**(1/3.)
+    # 1/\Omega^{1/3} for volumes of the supercells of original defect supercell
+    one_by_A = np.array([1./np.prod(multiple) for multiple in cm_multiples])**(1/3.)*(1/alat)
+    X, E_m_iso_error = ccf.fit_isolated_energy(one_by_A, np.array(E_q_per_m))
+    E_m_iso = X[2]
+    logger.info("E_m_iso from extrapolation = "+str(E_m_iso))
+    if not np.isnan(E_m_iso_error):
+        logger.info("Standard error of E_m_iso from fit = "+str(E_m_iso_error))
+    E_q_lat = E_m_iso - E_q_per_m[0]
+    logger.info("E_q_lat (in eV) = E_m_iso - E_q_per_m = "+str(E_q_lat))
+    return LatticeEnergy(cm_multiples, E_q_per_m, one_by_A, X, float(E_m_iso), float(E_m_iso_error), float(E_q_lat))
+
+
+def write_charge_model_file(lattice_energy: LatticeEnergy, charge_model_file: str):
+    ''' Writes E_q^{iso,m} followed by the supercell multiple and E_q^{per,m} of each charge model '''
+    with open(charge_model_file, "w") as charge_model_data:
+        charge_model_data.write("E_q^{iso,m} = "+str(lattice_energy.E_iso)+"\n")
+        charge_model_data.write("Supercell of defect supercell,  E_q_per_m\n")
+        for multiple, E_q in zip(lattice_energy.multiples, lattice_energy.E_per):
+            charge_model_data.write("x".join(str(n) for n in multiple)+", "+str(E_q)+"\n")
+
+
+def model_grid_scale(defect_charge: int, charge_ladder: bool) -> float:
+    ''' Factor for the potentials of the charge model grids kept in defect_outputs_dir, which are solved for unit charge
+    with charge_ladder (see 'CoffeeConvenienceFunctions.cached_solve_charge_model') and for defect_charge otherwise '''
+    return float(defect_charge) if charge_ladder else 1.0
+
+
+def fnv_model_atom_potentials(host: HostSupercell, defect: DefectSite, sigma: float, defect_outputs_dir: str,
+                              grid_scale: float = 1.0, chunk_bytes: int = sg.DEFAULT_CHUNK_BYTES) -> np.ndarray:
+    ''' Distance of each atom from the defect and the potential of the 1x1x1 charge model at its site, with the potential
+    multiplied by grid_scale (from 'model_grid_scale'). The model potential is a sum over the G-vectors of V_G-model, so it is
+    summed over slabs of V_G-model and G1-3 in defect_outputs_dir read in turn (at most chunk_bytes of them in memory at a time)
+    rather than passing the full grids to the solver, and converted to eV after sampling, so no scaled copy of V_G-model is made. '''
+    hartree = 27.2116
+    solver_grids = sg.SolverGrids(defect_outputs_dir)
+    grid = np.array(solver_grids.info('V_G-model').shape)
+    host_coords = dsa.coords_to_array(host.coords_frac)
+    defect_coords = dsa.coords_to_array(defect.coords_frac)
+    model_atom_pots = None
+    for start, (V_G, G1, G2, G3) in solver_grids.matching_slabs(('V_G-model', 'G1', 'G2', 'G3'), chunk_bytes):
+        slab_atom_pots = apa.model_atomic_pot(defect.defect_type, host.atom_num, defect.line, grid, host.lattice_vec_array,
+                                              host_coords, defect_coords, V_G, sigma, G1, G2, G3, site_map=defect.site_map)
+        if model_atom_pots is None:
+            model_atom_pots = slab_atom_pots
+        else:
+            model_atom_pots[:, 1] += slab_atom_pots[:, 1]
+    solver_grids.close()
+    # The model potential is linear in V_G, so only the sampled values are scaled
+    model_atom_pots[:, 1] *= hartree*grid_scale
+    # Written with the sign used for plots, as for the FHI-aims atom potentials
+    saved_atom_pots = model_atom_pots.copy()
+    saved_atom_pots[:, 1] = -1.0*saved_atom_pots[:, 1]
+    np.savetxt(os.path.join(defect_outputs_dir, 'atom_potentials_FNV_model.txt'), saved_atom_pots)
+    return model_atom_pots
+
+
+def fnv_atom_alignment(host: HostSupercell, defect: DefectSite, inputs: InputFiles, outputs: OutputFiles, defect_charge: int,
+                       model_atom_pots: np.ndarray) -> float:
+    ''' FNV potential alignment with atom potentials: q(V_0 - V_host) and q((V_charge-V_0) - V_model), far from the defect
+    (plotted to outputs.FNV_atom_pa_file)
+
+    Args:
+        host, defect, inputs, outputs, defect_charge: as returned by the functions above and set in the notebook
+        model_atom_pots: potentials of the charge model at the atom sites, from 'fnv_model_atom_potentials'
+    '''
+    aims_atom_pots = aims_atom_potentials(host, defect, inputs, inputs.charged_defect_atom_pot)
+    np.savetxt(os.path.join(outputs.defect_outputs_dir, 'atom_potentials_FHI-aims_FNV.txt'), aims_atom_pots)
+    alignment = apa.atom_alignment(host.lattice_vec_array, aims_atom_pots, model_atom_pots)
+    pa_atom_FNV = -1.0*defect_charge*alignment.mean
+    ptt.plot_atom_average_alignment(host.lattice_vec_array, defect_charge, aims_atom_pots, model_atom_pots, True, outputs.FNV_atom_pa_file,
+                                    alignment=alignment)
+    logger.info("FNV potential alignment correction with atom centres: "+str(pa_atom_FNV))
+    logger.info("Sampled "+str(alignment.count)+" atoms, standard deviation of potential difference = "+str(alignment.std))
+    logger.info("See "+str(outputs.FNV_atom_pa_file)+" for plot of FNV alignment with atom potentials.")
+    return pa_atom_FNV
+
+
+def fnv_model_planar_average(defect_outputs_dir: str, grid_scale: float = 1.0) -> np.ndarray:
+    ''' Planar average of the potential of the 1x1x1 charge model (V_r.npy in defect_outputs_dir) along the direction set in
+    the in_V file in defect_outputs_dir, multiplied by grid_scale (from 'model_grid_scale'), as columns of positions (Bohr)
+    and potential (eV), also written to plavg_a3.plot
+    (adapted from plavg.py written by Mit Naik (March 2017) in the CoFFEE_1.1 package at 'PotentialAlignment/Utilities/plavg.py')
+    '''
+    # Parameters from in_V and checking all are valid
+    file_inp, file_type, direction, factor, cell_dim = ptt.read_input(os.path.join(defect_outputs_dir, "in_V"))
+    if file_type != "python":
+        raise Exception("Only file_type = python (.npy files) is supported for the planar average of the charge model")
+    # The grid (V_r.npy) is memory-mapped by SolverGrids and averaged a chunk at a time
+    solver_grids = sg.SolverGrids(defect_outputs_dir)
+    plavg_z, plavg_V = pa.planar_average(solver_grids[os.path.splitext(file_inp)[0]], direction, cell_dim, factor)
+    solver_grids.close()
+    plavg_V = plavg_V*grid_scale
+    ptt.write2file(os.path.join(defect_outputs_dir, "plavg_a3.plot"), plavg_z, plavg_V)
+    return np.column_stack([plavg_z, plavg_V])
+
+
+def fnv_planar_alignment(host: HostSupercell, defect: DefectSite, inputs: InputFiles, outputs: OutputFiles, defect_charge: int,
+                         plavg_model: np.ndarray) -> tuple:
+    ''' FNV potential alignment with planar averages, in the CoFFEE format (term I: q(V_0 - V_host) and term II:
+    q((V_charge-V_0) - V_model)) and the format of the original Freysoldt paper (q((V_charge-V_host) - V_model)), far from the defect
+
+    Args:
+        host, defect, inputs, outputs, defect_charge: as returned by the functions above and set in the notebook
+        plavg_model: planar average of the charge model from 'fnv_model_planar_average'
+
+    Returns:
+        Alignment terms pa_planAv_C1, pa_planAv_C2 and pa_planAv_Frey (plotted to the FNV_planar_pa_*.png files in outputs)
+    '''
+    lattice_constant_z = host.supercell_dims[2]
+    (offset_o, origin), (offset_d, defect_neutral_pot), (offset_d2, defect_charge_pot) = _read_planar_pots(
+        inputs.host_planeAv_pot, inputs.neutral_defect_planeAv_pot, inputs.charged_defect_planeAv_pot)
+
+    # q*(V(Defect,0) - V(Host))
+    X = defect_neutral_pot[:, 0]
+    Y = -1.0*(defect_neutral_pot[:, 1]*Ha_eV - offset_d - (origin[:, 1]*Ha_eV-offset_o))
+    pa_planAv_C1 = float(ptt.plot_planar_average_alignment(lattice_constant_z, defect.z, defect_charge, X, Y, None, False, 'CoFFEE', outputs.FNV_planar_pa_C1_file))
+    logger.info("FNV potential alignment correction with planar average(COFFEE term One): "+str(pa_planAv_C1))
+    logger.info("See "+str(outputs.FNV_planar_pa_C1_file)+" for plot of FNV alignment with planar average of the potential.")
+
+    # V(Defect,charge) - V(Defect,0) and V_Model
+    X1 = defect_charge_pot[:, 0]
+    Y1 = -1.0*(defect_charge_pot[:, 1]*Ha_eV-offset_d2 - (defect_neutral_pot[:, 1]*Ha_eV-offset_d))
+    pa_planAv_C2 = float(ptt.plot_planar_average_alignment(lattice_constant_z, defect.z, defect_charge, X1, Y1, plavg_model, True, 'CoFFEE', outputs.FNV_planar_pa_C2_file))
+    logger.info("FNV potential alignment correction with planar average(COFFEE term two): "+str(pa_planAv_C2))
+    logger.info("FNV potential alignment correction with planar average(COFFEE term one+two): "+str(pa_planAv_C1 + pa_planAv_C2))
+    logger.info("See "+str(outputs.FNV_planar_pa_C2_file)+" for plot of FNV alignment with planar average of the potential.")
+
+    # Format of original Freysoldt Paper
+    X2 = defect_charge_pot[:, 0]
+    Y2 = -1.0*(defect_charge_pot[:, 1]*Ha_eV-offset_d2 - (origin[:, 1]*Ha_eV-offset_o))
+    pa_planAv_Frey = float(ptt.plot_planar_average_alignment(lattice_constant_z, defect.z, defect_charge, X2, Y2, plavg_model, True, 'Frey', outputs.FNV_planar_pa_FNV_file))
+    logger.info("FNV potential alignment correction with planar average(Freysoldt Format): "+str(pa_planAv_Frey))
+    logger.info("See "+str(outputs.FNV_planar_pa_FNV_file)+" for plot of FNV alignment with planar average of the potential.")
+    return pa_planAv_C1, pa_planAv_C2, pa_planAv_Frey
+
+
+def write_corrections_summary(results: CorrectionResults, LZ: bool = True, FNV: bool = True, atom_centered_pa: bool = True, planar_av_pa: bool = True):
+    ''' Writes the computed correction terms to results.outputs.final_outputs_file (corrections_summary.dat) '''
+    outputs = results.outputs
+    check = " to ensure that the sampling region far from the defect has a converged potential.\n"
+    with open(outputs.final_outputs_file, "w") as final_outputs:
+        if (LZ == False):
+            final_outputs.write("You did not request the LZ scheme.\n")
+        else:
+            final_outputs.write("Here are the outputs from the Lany-Zunger (LZ) finite-size correction scheme:\n")
+            final_outputs.write("LZ image-charge correction, E_corr_LZ = "+str(results.E_corr_LZ)+"\n")
+            if (atom_centered_pa == True):
+                final_outputs.write("LZ potential alignment correction with atom centres: "+'%.3f' % results.pa_atom_LZ+"\n")
+                final_outputs.write("Please check "+str(outputs.LZ_atom_pa_file)+check)
+            if (planar_av_pa == True):
+                final_outputs.write("LZ potential alignment correction with planar average: "+'%.3f' % results.pa_planAv_LZ+"\n")
+                final_outputs.write("Please check "+str(outputs.LZ_planar_pa_file)+check)
+            final_outputs.write("\n")
+
+        if (FNV == False):
+            final_outputs.write("You did not request the FNV scheme.\n")
+        else:
+            final_outputs.write("Here are the settings for the Freysoldt-Neugebauer-Van de Walle (FNV) finite-size correction scheme:\n")
+            final_outputs.write("cutoff (in eV) = "+str(results.cutoff)+"\n")
+            final_outputs.write("sigma = "+str(results.sigma)+"\n")
+            final_outputs.write("Here are the outputs from the Freysoldt-Neugebauer-Van de Walle (FNV) finite-size correction scheme:\n")
+            final_outputs.write("E_q_lat (in eV) = E_m_iso - E_q_per_m = "+str(results.lattice_energy.E_lat)+"\n")
+            if (atom_centered_pa == True):
+                final_outputs.write("FNV potential alignment correction with atom centres: "+'%.3f' % results.pa_atom_FNV+"\n")
+                final_outputs.write("Please check "+str(outputs.FNV_atom_pa_file)+check)
+            if (planar_av_pa == True):
+                final_outputs.write("FNV potential alignment correction with planar average (in CoFFEE format,term I): "+'%.3f' % results.pa_planAv_C1+"\n")
+                final_outputs.write("Please check "+str(outputs.FNV_planar_pa_C1_file)+check)
+                final_outputs.write("FNV potential alignment correction with planar average (in CoFFEE format,term II): "+'%.3f' % results.pa_planAv_C2+"\n")
+                final_outputs.write("Please check "+str(outputs.FNV_planar_pa_C2_file)+check)
+                final_outputs.write("FNV potential alignment correction with planar average (in Freysoldt format): "+'%.3f' % results.pa_planAv_Frey+"\n")
+                final_outputs.write("Please check "+str(outputs.FNV_planar_pa_FNV_file)+check)
+
+
+def pipeline_config(config: dict) -> dict:
+    ''' Parameters for run_pipeline: config (notebook parameters) with defaults from the 'User inputs' cell of the notebook
+    added, raises ValueError if a parameter without a default is missing '''
+    missing = [key for key in REQUIRED_CONFIG if config.get(key) is None]
+    if missing:
+        raise ValueError("Missing parameters for defect corrections: "+", ".join(missing))
+    return dict(DEFAULT_CONFIG, **config)
+
+
+def run_pipeline(config: dict) -> CorrectionResults:
+    ''' Runs every step of DefectCorrectionsNotebook.ipynb for one defect, without a notebook
+
+    Args:
+        config: parameters from the 'User inputs' cell of the notebook (see DEFAULT_CONFIG for those that have defaults),
+            e.g. dict(global_configuration, **config) for a defect in DefectCorrectionsDataset.py
+
+    Returns:
+        CorrectionResults for the defect, also written to defect_outputs_dir/corrections_summary.dat
+    '''
+    config = pipeline_config(config)
+    LZ, FNV = config["LZ"], config["FNV"]
+    atom_centered_pa, planar_av_pa = config["atom_centered_pa"], config["planar_av_pa"]
+    defect_charge = config["defect_charge"]
+    dielectrics = (config["dielectric_xx"], config["dielectric_yy"], config["dielectric_zz"])
+
+    # Make directory for outputs from processing of this defect, log file and cache as set up by the notebook
+    processed_defects_dir = config["processed_defects_dir"]
+    defect_outputs_dir = os.path.join(processed_defects_dir, config["defect_outputs_dir"])
+    os.makedirs(defect_outputs_dir, exist_ok=True)
+    lfs.configure_logging(os.path.join(defect_outputs_dir, "log"))
+    pdc.configure_cache(os.path.join(processed_defects_dir, "cache"))
+    # Plot settings are restored and queued figures dropped however processing ends, so they do not carry over to the next defect
+    previous_plot_settings = ptt.configure_plotting(config["headless_plots"], config["plot_dpi"], config["plot_workers"])
+    try:
+        inputs = input_files(config["path_to_host"], config["path_to_defect"], config["path_to_neutral"])
+        outputs = output_files(defect_outputs_dir, config["plot_format"])
+
+        host = read_host(inputs.host_geom)
+        defect = identify_defect(host, inputs.defect_geom, defect_charge)
+        results = CorrectionResults(outputs, host, defect)
+
+        if LZ == True or config["IC"] is not None:
+            results = results._replace(E_corr_LZ=lz_image_charge(host.lattice_vec_array, defect_charge, *dielectrics, IC=config["IC"]))
+        if LZ == True and atom_centered_pa == True:
+            results = results._replace(pa_atom_LZ=lz_atom_alignment(host, defect, inputs, outputs, defect_charge))
+        if LZ == True and planar_av_pa == True:
+            results = results._replace(pa_planAv_LZ=lz_planar_alignment(host, defect, inputs, outputs, defect_charge))
+
+        if FNV == True:
+            sigma = fnv_sigma(config["path_to_all_defects"], inputs.host_geom, processed_defects_dir, config["manual_sigma"])
+            cutoff = fnv_cutoff(sigma, config["manual_cutoff"])
+            charge_models = fnv_charge_models(inputs.defect_geom, defect, sigma, cutoff, defect_charge, *dielectrics, defect_outputs_dir,
+                                              charge_model_multiples=config["charge_model_multiples"], charge_model_workers=config["charge_model_workers"],
+                                              charge_ladder=config["charge_ladder"], E_iso_tolerance=config["E_iso_tolerance"])
+            lattice_energy = fnv_lattice_energy(charge_models, host.supercell_dims, sigma, defect_outputs_dir)
+            write_charge_model_file(lattice_energy, outputs.charge_model_file)
+            ptt.plot_lattice_energy_fit(lattice_energy.multiples, lattice_energy.E_per, lattice_energy.inverse_lengths, lattice_energy.coefficients,
+                                        lattice_energy.E_iso, outputs.E_iso_file)
+            results = results._replace(sigma=sigma, cutoff=cutoff, lattice_energy=lattice_energy)
+            if atom_centered_pa == True:
+                model_atom_pots = fnv_model_atom_potentials(host, defect, sigma, defect_outputs_dir, model_grid_scale(defect_charge, config["charge_ladder"]))
+                results = results._replace(pa_atom_FNV=fnv_atom_alignment(host, defect, inputs, outputs, defect_charge, model_atom_pots))
+            if planar_av_pa == True:
+                # Write in_V file for CoFFEE next to V_r.npy, convert supercell dims from Angstrom to Bohr
+                ccf.write_CoFFEE_in_V_file(host.supercell_dims[2]*A_bohr, defect_outputs_dir)
+                plavg_model = fnv_model_planar_average(defect_outputs_dir, model_grid_scale(defect_charge, config["charge_ladder"]))
+                pa_planAv_C1, pa_planAv_C2, pa_planAv_Frey = fnv_planar_alignment(host, defect, inputs, outputs, defect_charge, plavg_model)
+                results = results._replace(pa_planAv_C1=pa_planAv_C1, pa_planAv_C2=pa_planAv_C2, pa_planAv_CF=pa_planAv_C1+pa_planAv_C2,
+                                           pa_planAv_Frey=pa_planAv_Frey)
+
+        write_corrections_summary(results, LZ, FNV, atom_centered_pa, planar_av_pa)
+        ptt.render_queued_plots()
+    finally:
+        ptt.discard_queued_plots()
+        ptt.configure_plotting(**previous_plot_settings)
+    return results
@@ -1,10 +1,127 @@
 import numpy as np
-import re
-from math import sqrt
+import os
+import glob
+import json
+from collections import namedtuple, OrderedDict
+import ParsedDataCache as pdc
 import logging
 logger = logging.getLogger()
 
 
+class Geometry(namedtuple('Geometry', ['lattice', 'cart_coords', 'frac_coords', 'species_codes', 'species_symbols'])):
+    ''' Compact, array-backed representation of an FHI-aims geometry.in file (obtained with 'read_geometry')
+
+    Fields:
+        lattice: 3x3 numpy array of lattice vectors (rows are a1, a2, a3) in Angstroms
+        cart_coords: (N,3) float64 numpy array of Cartesian atom coordinates in Angstroms
+        frac_coords: (N,3) float64 numpy array of fractional atom coordinates
+        species_codes: (N,) integer numpy array indexing into species_symbols for each atom
+        species_symbols: tuple of chemical symbols, in order of first appearance in the file
+    '''
+    __slots__ = ()
+
+    @property
+    def atom_num(self) -> int:
+        return len(self.species_codes)
+
+    @property
+    def species(self) -> np.ndarray:
+        ''' Chemical symbol of each atom as a numpy array of strings (same order as the file) '''
+        return np.array(self.species_symbols, dtype=str)[self.species_codes]
+
+
+# Parsed geometries are memoized per file (keyed on path, modification time and size) so that
+# each geometry.in is only read once, however many of the functions below are called on it
+_GEOMETRY_CACHE_SIZE = 64
+_geometry_cache = OrderedDict()
+
+
+def _parse_geometry(geom_file: str) -> dict:
+    ''' Single pass over geometry.in that only splits 'lattice_vector', 'atom' and 'atom_frac' lines.
+    All other lines (comments, hessian_block, initial_moment etc.) are skipped on their first characters.
+    '''
+    lattice_rows = []
+    atom_rows = []
+    is_frac = []
+    symbols = []
+    with open(geom_file, 'r') as f:
+        for line in f:
+            line = line.lstrip()
+            if line[:4] == 'atom':
+                words = line.split()
+                atom_rows.append(words[1:4])
+                is_frac.append(words[0] == 'atom_frac')
+                symbols.append(words[4])
+            elif line[:14] == 'lattice_vector':
+                lattice_rows.append(line.split()[1:4])
+    if not lattice_rows:
+        logger.info('Warning! - No lattice vectors found in '+str(geom_file))
+    if not atom_rows:
+        logger.info('Warning! - No atom coordinates found in '+str(geom_file))
+
+    lattice = np.zeros([3,3])
+    if lattice_rows:
+        lattice[:len(lattice_rows[:3])] = np.array(lattice_rows[:3], dtype=np.float64)
+    coords = np.array(atom_rows, dtype=np.float64).reshape(-1,3)
+    is_frac = np.array(is_frac, dtype=bool)
+    # Convert whichever coordinate type was not given in the file with one vectorized operation each way
+    cart_coords = coords.copy()
+    cart_coords[is_frac] = coords[is_frac] @ lattice
+    frac_coords = coords.copy()
+    if (~is_frac).any():
+        try:
+            frac_coords[~is_frac] = np.linalg.solve(lattice.T, coords[~is_frac].T).T
+        except np.linalg.LinAlgError:
+            logger.info('Warning! - Lattice vectors in '+str(geom_file)+' are singular, fractional coordinates not available')
+            frac_coords[~is_frac] = np.nan
+    # Integer species codes with a symbol table in order of first appearance
+    symbol_table = {}
+    species_codes = np.array([symbol_table.setdefault(symbol, len(symbol_table)) for symbol in symbols], dtype=np.intp)
+
+    return {'lattice': lattice, 'cart_coords': cart_coords, 'frac_coords': frac_coords,
+            'species_codes': species_codes, 'species_symbols': np.array(list(symbol_table), dtype=str)}
+
+
+def _geometry_from_arrays(arrays: dict) -> Geometry:
+    for name in ('lattice', 'cart_coords', 'frac_coords', 'species_codes'):
+        arrays[name].setflags(write=False)
+    return Geometry(arrays['lattice'], arrays['cart_coords'], arrays['frac_coords'], arrays['species_codes'], tuple(arrays['species_symbols'].tolist()))
+
+
+def read_geometry(geom_file: str) -> Geometry:
+    ''' Reads an FHI-aims geometry file once and returns all structural information as numpy arrays.
+    Atom lines may use either 'atom' (Cartesian) or 'atom_frac' (fractional) coordinates.
+    Results are memoized, so repeated calls on an unchanged file do not re-read it, and are stored in the on-disk
+    cache from 'ParsedDataCache' (if configured) so the file is not parsed again in later runs.
+    NOTE: Arrays in the returned Geometry are read-only as they are shared between calls, copy before modifying.
+
+    Args: 
+        geom_file: input crystal geometry file in format for FHI-aims (geometry.in)
+
+    Returns: 
+        Geometry namedtuple with fields lattice, cart_coords, frac_coords, species_codes and species_symbols
+    '''
+    stat = os.stat(geom_file)
+    key = (os.path.abspath(geom_file), stat.st_mtime_ns, stat.st_size)
+    geometry = _geometry_cache.get(key)
+    if geometry is None:
+        geometry = _geometry_from_arrays(dict(pdc.cached_parse(geom_file, 'geometry', _parse_geometry)))
+        _geometry_cache[key] = geometry
+        if len(_geometry_cache) > _GEOMETRY_CACHE_SIZE:
+            _geometry_cache.popitem(last=False)
+    else:
+        _geometry_cache.move_to_end(key)
+    return geometry
+
+
+def _read_geometry_or_none(geom_file: str) -> Geometry:
+    try:
+        return read_geometry(geom_file)
+    except IOError:
+        logger.info("Could not open "+str(geom_file))
+        return None
+
+
 def count_atoms(geom_file: str) -> int:
     ''' Counts number of lines in file starting with 'atom' to allow for use of 'atom' or 'atom_frac'.
     NOTE: It is important lines containing atom coordinates have been deleted (not commented out) to create the defect.
@@ -15,15 +132,10 @@ def count_atoms(geom_file: str) -> int:
     Returns: 
         Number of atoms identified in file (int)
     '''
-    atom_num = 0
-    try:
-        with open(geom_file, 'r') as f:
-            for line in f:
-                if re.search('atom', line):
-                    atom_num += 1
-    except IOError:
-        logger.info("Could not open "+str(geom_file))
-    return atom_num
+    geometry = _read_geometry_or_none(geom_file)
+    if geometry is None:
+        return 0
+    return geometry.atom_num
 
 
 def read_lattice_vectors(geom_file: str) -> list:
@@ -36,22 +148,10 @@ def read_lattice_vectors(geom_file: str) -> list:
         lists for x, y and z components of a1, a2 and a3 lattice vectors
         E.g. x_vecs[1], y_vecs[1], z_vecs[1] would be x, y, z components of a2
     '''
-    x_vecs = []
-    y_vecs = []
-    z_vecs = []
-    try:
-        with open(geom_file, 'r') as f:
-            for line in f:
-                if re.search('lattice_vector', line):
-                    words = line.split()
-                    x_vecs.append(float(words[1]))
-                    y_vecs.append(float(words[2]))
-                    z_vecs.append(float(words[3]))
-                    if line == None:
-                        logger.info('Warning! - No lattice vectors found in '+str(geom_file))
-    except IOError:
-        logger.info("Could not open "+str(geom_file))
-    return x_vecs, y_vecs, z_vecs
+    geometry = _read_geometry_or_none(geom_file)
+    if geometry is None:
+        return [], [], []
+    return geometry.lattice[:,0].tolist(), geometry.lattice[:,1].tolist(), geometry.lattice[:,2].tolist()
 
 
 def lattice_vectors_array(geom_file: str) -> tuple:
@@ -63,22 +163,10 @@ def lattice_vectors_array(geom_file: str) -> tuple:
     Returns: 
         Each component of the lattice vectors as elements of a 3x3 numpy array
     '''
-    latt_vec_array = np.zeros([3,3])
-    try:
-        with open(geom_file, 'r') as f:
-            i = 0
-            for line in f:
-                if re.search('lattice_vector', line):
-                    words = line.split()
-                    latt_vec_array[i][0] = float(words[1])
-                    latt_vec_array[i][1] = float(words[2])
-                    latt_vec_array[i][2] = float(words[3])
-                    i += 1
-                    if line == None:
-                        logger.info('Warning! - No lattice vectors found in '+str(geom_file))
-    except IOError:
-        logger.info("Could not open "+str(geom_file))      
-    return latt_vec_array
+    geometry = _read_geometry_or_none(geom_file)
+    if geometry is None:
+        return np.zeros([3,3])
+    return np.array(geometry.lattice)
 
 
 def get_supercell_dimensions(geom_file: str) -> list:
@@ -110,25 +198,10 @@ def read_atom_coords(geom_file: str) -> list:
         List of lists for all atom coordinates where atom_coords[row][col]
         Columns are: x, y, z, species and each row is a different atom
     '''
-    atom_coords = []
-    # For converting from fractional to Cartesian coordinates
-    latvec = lattice_vectors_array(geom_file)
-    try:
-        with open(geom_file, 'r') as f:
-            for line in f:
-                if re.search('atom', line):
-                    words = line.split()
-                    if (words[0] == 'atom_frac'):
-                        # Convert from fractional coordinates to Cartesian coordinates using lattice vectors
-                        cart_coords = float(words[1])*latvec[0,:] + float(words[2])*latvec[1,:] + float(words[3])*latvec[2,:]
-                        atom_coords.append((cart_coords[0], cart_coords[1], cart_coords[2], str(words[4])))
-                    else:
-                        atom_coords.append((float(words[1]), float(words[2]), float(words[3]), str(words[4])))
-                    if line == None:
-                        logger.info('Warning! - No atom coordinates found in '+str(geom_file))
-    except IOError:
-        logger.info("Could not open "+str(geom_file))
-    return atom_coords
+    geometry = _read_geometry_or_none(geom_file)
+    if geometry is None:
+        return []
+    return [(x, y, z, geometry.species_symbols[code]) for (x, y, z), code in zip(geometry.cart_coords.tolist(), geometry.species_codes.tolist())]
 
 
 def coords_to_array(coord_list: list) -> tuple:
@@ -139,6 +212,8 @@ def coords_to_array(coord_list: list) -> tuple:
     Returns: 
         Only the coordinates (not also species type as in read_atom_coords) as a numpy array
     '''
+    if isinstance(coord_list, np.ndarray):
+        return np.array(coord_list[:,:3], dtype=np.float64)
     coords_array = np.zeros([len(coord_list),3])
     for i in range(len(coord_list)):
         coords_array[i][0], coords_array[i][1], coords_array[i][2] = coord_list[i][0], coord_list[i][1], coord_list[i][2]
@@ -165,7 +240,6 @@ def frac_coords_convert(geom_file: str) -> tuple:
     return super_invmat, wrap_vec
 
 
-# TO-DO: Add test for this function
 def read_atom_coords_frac(geom_file: str) -> tuple:
     ''' Function searches for atom using string 'atom' to allow for either 'atom' or 'atom_frac' in the file format
     If coordinates are not already fractional, they are converted to fractional for compatibility with CoFFEE code routines
@@ -176,66 +250,103 @@ def read_atom_coords_frac(geom_file: str) -> tuple:
     Returns: 
         Numpy array of fractional coordinates
     '''
-    # For converting from Cartesian to fractional coordinates
-    super_invmat, wrap_vec = frac_coords_convert(geom_file)
-    # Initialise np array for coordinates
-    coord_num = count_atoms(geom_file)
-    coords = np.zeros([coord_num,3])
-    frac_coords = np.zeros([coord_num,3])
-    try:
-        with open(geom_file, 'r') as f:
-            i = 0
-            for line in f:
-                if re.search('atom', line):
-                    words = line.split()
-                    if (words[0] != 'atom_frac'):
-                        # Convert from Cartesian coordinates to fractional coordinates using lattice vectors
-                        coords[i,:] = float(words[1]), float(words[2]), float(words[3])
-                        frac_coords[i,:] =  wrap_vec(coords[i,:])
-                        frac_coords[i,:] = np.dot(super_invmat,coords[i,:])
-                    else:
-                        frac_coords[i,:] = float(words[1]), float(words[2]), float(words[3])
-                    if line == None:
-                        logger.info('Warning! - No atom coordinates found in '+str(geom_file))
-                    i +=1 
-    except IOError:
-        logger.info("Could not open "+str(geom_file))   
-    return frac_coords
+    geometry = _read_geometry_or_none(geom_file)
+    if geometry is None:
+        return np.zeros([0,3])
+    return np.array(geometry.frac_coords)
 
 
 def find_defect_type(host_coords: list, defect_coords: list) -> str:
-    ''' Compares number of atoms in defect and host supercells to determine type of defect
-    host_atom_num == defect_atom_num+1 --> vacancy
-    host_atom_num == defect_atom_num-1 --> interstitial
-    host_atom_num == defect_atom_num --> antisite
+    ''' Compares the number of atoms of each species in defect and host supercells to determine type of defect
+    (see 'species_census'): one atom less --> vacancy, one atom more --> interstitial, one species swapped for another --> antisite
 
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function 
     
     Returns: 
-        defect_type (vacancy, interstitial, antisite) as a string
-    '''
-    host_atom_num = len(host_coords)
-    defect_atom_num = len(defect_coords)
-    if (host_atom_num == defect_atom_num+1):
-        defect_type = 'vacancy'
-    elif (host_atom_num == defect_atom_num-1):
-        defect_type = 'interstitial'
-    elif (host_atom_num == defect_atom_num):
-        defect_type = 'antisite'
-    else:
+        defect_type (vacancy, interstitial, antisite) as a string, or None if the supercells do not differ by a single point defect
+    '''
+    defect_type = species_census(host_coords, defect_coords).defect_type
+    if defect_type is None:
         logger.info('Error finding defect type')
     return defect_type
 
 
+class SpeciesCensus(namedtuple('SpeciesCensus', ['species', 'host_counts', 'defect_counts', 'count_deltas'])):
+    ''' Number of atoms of each species in the host and defect supercells (obtained with 'species_census')
+
+    Fields:
+        species: tuple of chemical symbols present in either supercell (defect supercell species first)
+        host_counts: integer numpy array of the number of each species in the host supercell
+        defect_counts: integer numpy array of the number of each species in the defect supercell
+        count_deltas: defect_counts - host_counts
+    '''
+    __slots__ = ()
+
+    @property
+    def defect_type(self) -> str:
+        ''' vacancy, interstitial or antisite from the change in total number of atoms (None if not a single point defect) '''
+        atom_num_delta = int(self.count_deltas.sum())
+        if atom_num_delta == -1:
+            return 'vacancy'
+        if atom_num_delta == 1:
+            return 'interstitial'
+        if atom_num_delta == 0 and self.species_added is not None:
+            return 'antisite'
+        return None
+
+    @property
+    def species_removed(self) -> str:
+        ''' Species with one less atom in the defect supercell (vacancy species or species_out for an antisite) '''
+        removed = np.flatnonzero(self.count_deltas == -1)
+        return self.species[removed[-1]] if len(removed) else None
+
+    @property
+    def species_added(self) -> str:
+        ''' Species with one more atom in the defect supercell (interstitial species or species_in for an antisite) '''
+        added = np.flatnonzero(self.count_deltas == 1)
+        return self.species[added[-1]] if len(added) else None
+
+
+def _species_codes(atoms, symbol_index: dict) -> np.ndarray:
+    ''' Integer species codes for a Geometry, array of symbols or list from 'read_atom_coords', using (and extending) symbol_index '''
+    if isinstance(atoms, Geometry):
+        # Remap the per-file symbol table onto the shared one without touching per-atom strings
+        code_map = np.array([symbol_index.setdefault(symbol, len(symbol_index)) for symbol in atoms.species_symbols], dtype=np.intp)
+        return code_map[atoms.species_codes]
+    if not isinstance(atoms, np.ndarray):
+        atoms = np.array([atom[3] for atom in atoms], dtype=str)
+    symbols, codes = np.unique(atoms, return_inverse=True)
+    code_map = np.array([symbol_index.setdefault(symbol, len(symbol_index)) for symbol in symbols.tolist()], dtype=np.intp)
+    return code_map[codes.ravel()]
+
+
+def species_census(host_atoms, defect_atoms) -> SpeciesCensus:
+    ''' Counts every species in the host and defect supercells in one pass with integer species codes and np.bincount.
+    Species present only in the defect supercell (extrinsic defects) have a host count of zero and vice versa.
+
+    Args: 
+        host_atoms: host supercell as a Geometry from 'read_geometry', a list from 'read_atom_coords' or an array of chemical symbols
+        defect_atoms: defect supercell in any of the same formats as host_atoms
+
+    Returns: 
+        SpeciesCensus namedtuple with the species, host and defect counts and their differences,
+        along with the defect_type, species_removed and species_added derived from them
+    '''
+    symbol_index = OrderedDict()
+    defect_codes = _species_codes(defect_atoms, symbol_index)
+    host_codes = _species_codes(host_atoms, symbol_index)
+    host_counts = np.bincount(host_codes, minlength=len(symbol_index))
+    defect_counts = np.bincount(defect_codes, minlength=len(symbol_index))
+    return SpeciesCensus(tuple(symbol_index), host_counts, defect_counts, defect_counts - host_counts)
+
+
 def count_species(host_coords: list, defect_coords: list) -> list:
-    ''' Reads through species in atom_coords[row][3] for host and defect supercells
-    Assumption is made that only intrinsic defects are present, hence same atom types are present in host and defect supercells
-    TZ: This assumption is not always work, and extrinsic defects is normal in the ``antisite" case, and ``interstitials". 
-        As a result, I change the species count based on the defect supercell: 
-        For intrinsic defects, it will be the same as before: 
-        However, for extrinsic defects, it will count the extrinsic species, and the number in the host would be zero. 
+    ''' Counts the species in atom_coords[row][3] for host and defect supercells (see 'species_census')
+    TZ: Extrinsic defects are normal in the ``antisite" case, and ``interstitials". 
+        For intrinsic defects the same species are present in host and defect supercells,
+        for extrinsic defects the extrinsic species is also counted, and the number in the host would be zero. 
 
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
@@ -245,276 +356,343 @@ def count_species(host_coords: list, defect_coords: list) -> list:
         First function output is a list of all different species present in the host supercell
         Next two outputs are the number of each of these species in the host and defect supercell, in the same order
     '''
-    species = [] 
-    current_species = defect_coords[0][3]
-    species.append(defect_coords[0][3])
-    for i in range(0,len(defect_coords)):
-        if (defect_coords[i][3] != current_species): 
-            species.append(defect_coords[i][3])
-            current_species = defect_coords[i][3]
-    #eliminate the duplicate species 
-    species = list(set(species))       
-    #Suzy original code, keep it here. 
-    #Obtain list of all species contained in host supercell
-    #species = []
-    #current_species = host_coords[0][3]
-    #species.append(host_coords[0][3])
-    #for i in range(0, len(host_coords)):
-    #    if (host_coords[i][3] != current_species):
-    #        species.append(host_coords[i][3])
-    #        current_species = host_coords[i][3]         
-    
-    # Count number of each species in host supercell
-    host_species_nums = []
-    for j in range(0, len(species)):
-        species_count = 0
-        for i in range(0, len(host_coords)):
-            if (host_coords[i][3] == species[j]):
-                species_count += 1
-        host_species_nums.append(int(species_count))
-    # Count number of each species in defect supercell
-    defect_species_nums = []
-    for j in range(0, len(species)):
-        species_count = 0
-        for i in range(0, len(defect_coords)):
-            if (defect_coords[i][3] == species[j]):
-                species_count += 1
-        defect_species_nums.append(int(species_count))       
-    return species, host_species_nums, defect_species_nums
+    census = species_census(host_coords, defect_coords)
+    return list(census.species), census.host_counts.tolist(), census.defect_counts.tolist()
     
        
-def find_vacancy(host_coords: list, defect_coords: list) -> str:
+def find_vacancy(host_coords: list, defect_coords: list, census: SpeciesCensus = None) -> str:
     ''' Find species where count is one less in defect supercell than in host supercell.
 
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function
+        census: (optional) result of 'species_census' for these supercells, to avoid recounting species
 
     Returns: 
         vacancy species as a string
     '''
-    species, host_species_nums, defect_species_nums = count_species(host_coords, defect_coords)
-    species_vac = 'no vacancy'
-    for i in range (0, len(species)):
-        if (host_species_nums[i] == defect_species_nums[i]+1):
-            species_vac = species[i]
-    if (species_vac == 'no vacancy'):
+    if census is None:
+        census = species_census(host_coords, defect_coords)
+    species_vac = census.species_removed
+    if species_vac is None:
+        species_vac = 'no vacancy'
         logger.info('Error finding vacancy')
     return species_vac
 
 
-def find_interstitial(host_coords: list, defect_coords: list) -> str:
+def find_interstitial(host_coords: list, defect_coords: list, census: SpeciesCensus = None) -> str:
     ''' Find species where count is one more in defect supercell than in host supercell.
 
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function 
+        census: (optional) result of 'species_census' for these supercells, to avoid recounting species
 
     Returns: 
         interstitial species as a string
     '''
-    species, host_species_nums, defect_species_nums = count_species(host_coords, defect_coords)
-    species_int = 'no interstitial'
-    for i in range (0, len(species)):
-        if (host_species_nums[i] == defect_species_nums[i]-1):
-            species_int = species[i]
-    if (species_int == 'no interstitial'):
+    if census is None:
+        census = species_census(host_coords, defect_coords)
+    species_int = census.species_added
+    if species_int is None:
+        species_int = 'no interstitial'
         logger.info('Error finding interstitial')
     return species_int
 
 
-def find_antisite(host_coords: list, defect_coords: list) -> str:
+def find_antisite(host_coords: list, defect_coords: list, census: SpeciesCensus = None) -> str:
     ''' Find species where count is one less in defect supercell than in host (species_out).
     Find species where count is one more in defect supercell than in host (species_in).
 
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function
+        census: (optional) result of 'species_census' for these supercells, to avoid recounting species
 
     Returns: 
         Two strings, the first is the species added into the defect supercell to make the antisite defect 
         and the second is the species removed from the host
     
     '''
-    species, host_species_nums, defect_species_nums = count_species(host_coords, defect_coords)
-    species_in = 'no species in'
-    species_out = 'no species out'     
-    #If this is only used to find antisite, it's more easy to do the selections. 
-    #the following code is not always work for the reason that people may change the antisite defects at any positions they want, as a result, the same species may not be in the same positions.   for example: 
-
-    for i in range (0, len(species)):
-        if (host_species_nums[i] == defect_species_nums[i]-1):
-            species_in = species[i]
-        if (host_species_nums[i] == defect_species_nums[i]+1):
-            species_out = species[i]
-    if (species_in == 'no species in' or species_out == 'no species out'):
+    if census is None:
+        census = species_census(host_coords, defect_coords)
+    species_in = census.species_added
+    species_out = census.species_removed
+    if (species_in is None or species_out is None):
         logger.info('Error finding antisite')
+    if species_in is None:
+        species_in = 'no species in'
+    if species_out is None:
+        species_out = 'no species out'
     return species_in, species_out
 
 
-def vacancy_coords(host_coords: list, defect_coords: list) -> tuple:
+def _wrap_frac(frac_coords: np.ndarray) -> np.ndarray:
+    ''' Wraps fractional coordinates into [0, 1) '''
+    wrapped = frac_coords - np.floor(frac_coords)
+    wrapped[wrapped >= 1.0] = 0.0
+    return wrapped
+
+
+# Lattice translations to the 26 neighbouring cells (and the cell itself), as integer multiples of the lattice vectors
+_IMAGE_OFFSETS = np.array([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)], dtype=np.float64)
+
+
+def minimum_image_distances(frac_coords: np.ndarray, defect_frac_coords: np.ndarray, lattice_vec_array: np.ndarray) -> np.ndarray:
+    ''' Batched minimum-image distances between atoms and one or more defect positions.
+    Relative fractional coordinates are wrapped into [-0.5, 0.5] with np.round, then the shortest of the Cartesian
+    vectors to that image and its 26 neighbouring images is taken, as in skewed cells (e.g. hexagonal) the wrapped
+    image is not always the closest one.
+
+    Args: 
+        frac_coords: (N,3) numpy array of fractional atom coordinates (or a (M,N,3) stack, one set per defect)
+        defect_frac_coords: fractional coordinates of the defect, either shape (3,) or a stack of shape (M,3)
+        lattice_vec_array: 3x3 numpy array of lattice vectors (rows), in the units wanted for the distances
+
+    Returns: 
+        Numpy array of distances with shape (N,) for a single defect position or (M,N) for a stack of defect positions
+    '''
+    lattice_vec_array = np.asarray(lattice_vec_array, dtype=np.float64)
+    defect_frac_coords = np.asarray(defect_frac_coords, dtype=np.float64)
+    rel = np.asarray(frac_coords, dtype=np.float64) - defect_frac_coords[...,np.newaxis,:]
+    rel -= np.round(rel)
+    cart = rel @ lattice_vec_array
+    distances = np.linalg.norm(cart, axis=-1)
+    for offset in _IMAGE_OFFSETS @ lattice_vec_array:
+        np.minimum(distances, np.linalg.norm(cart + offset, axis=-1), out=distances)
+    return distances
+
+
+def nearest_neighbour_distances(coords: np.ndarray, reference_coords: np.ndarray, lattice_vec_array: np.ndarray = None) -> tuple:
+    ''' KD-tree search for the nearest atom in 'reference_coords' to each atom in 'coords'.
+    If lattice vectors are given, coordinates are taken as fractional and the search is periodic: the KD-tree is built
+    on the Cartesian coordinates of the reference atoms (wrapped into the supercell) and their images in the 26
+    neighbouring cells, so the distances are true minimum-image distances also in skewed cells.
+
+    Args: 
+        coords: (N,3) numpy array of atom coordinates (fractional if lattice_vec_array is given, otherwise Cartesian)
+        reference_coords: (M,3) numpy array of atom coordinates to search, in the same convention as coords
+        lattice_vec_array: 3x3 numpy array of lattice vectors (rows), e.g. from 'lattice_vectors_array'
+
+    Returns: 
+        Numpy arrays for the distance (Angstroms if lattice vectors given) to the nearest reference atom and its index in reference_coords
+        (distances are inf and indices are -1 if reference_coords is empty)
+    '''
+    # scipy is imported on first use, as it is only needed for the neighbour search
+    from scipy.spatial import cKDTree
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1,3)
+    reference_coords = np.asarray(reference_coords, dtype=np.float64).reshape(-1,3)
+    if len(reference_coords) == 0:
+        return np.full(len(coords), np.inf), np.full(len(coords), -1, dtype=np.intp)
+    if lattice_vec_array is None:
+        distances, indices = cKDTree(reference_coords).query(coords)
+        return distances, indices
+    lattice_vec_array = np.asarray(lattice_vec_array, dtype=np.float64)
+    # Images are ordered offset by offset, so the index of an image modulo M is the index of its reference atom
+    images = (_wrap_frac(reference_coords)[np.newaxis,:,:] + _IMAGE_OFFSETS[:,np.newaxis,:]).reshape(-1,3)
+    distances, image_indices = cKDTree(images @ lattice_vec_array).query(_wrap_frac(coords) @ lattice_vec_array)
+    return distances, image_indices % len(reference_coords)
+
+
+def _most_isolated_atom(candidate_coords: np.ndarray, reference_coords: np.ndarray, lattice_vec_array: np.ndarray = None) -> int:
+    ''' Index of the atom in candidate_coords whose nearest neighbour in reference_coords is furthest away '''
+    distances, _ = nearest_neighbour_distances(candidate_coords, reference_coords, lattice_vec_array)
+    return int(np.argmax(distances))
+
+
+def _species_coords(coords: list, lattice_vec_array: np.ndarray = None) -> tuple:
+    ''' Split list from 'read_atom_coords' into an (N,3) array and array of species.
+    If lattice vectors are given, the Cartesian coordinates are converted to fractional for periodic searches.
+    '''
+    coords_array = coords_to_array(coords)
+    species = np.array([atom[3] for atom in coords], dtype=str)
+    if lattice_vec_array is not None:
+        coords_array = np.linalg.solve(np.asarray(lattice_vec_array).T, coords_array.T).T
+    return coords_array, species
+
+
+def vacancy_coords(host_coords: list, defect_coords: list, lattice_vec_array: np.ndarray = None) -> tuple:
     '''
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function
+        lattice_vec_array: (optional) lattice vectors from 'lattice_vectors_array', if given the search for the vacancy is periodic
 
     Returns: 
         Vacancy species as string, vacancy coordinates in the perfect host supercell and the line in the geometry file for the defect
         defect_line for a vacancy is defined as the line number in the perfect host supercell of the atom missing in the vacancy supercell
     '''
-    species_vac = find_vacancy(host_coords, defect_coords)  
-    # Read in coordinates of vacancy species in perfect host supercell
-    host_vac_coords = []
-    for i in range (0, len(host_coords)):
-        if (host_coords[i][3] == species_vac):
-            host_vac_coords.append(host_coords[i][:3])
-    # Read in coordinates of vacancy species in defect supercell
-    defect_vac_coords = []
-    for i in range (0, len(defect_coords)):
-        if (defect_coords[i][3] == species_vac):
-            defect_vac_coords.append(defect_coords[i][:3]) 
-    # Find closest vacancy species in defect supercell for each one in host supercell
-    all_closest_species = []
-    for x_host, y_host, z_host in host_vac_coords:
-        closest_species = None
-        min_distance = None
-        for x_defect, y_defect, z_defect in defect_vac_coords:
-            distance_to_defect = sqrt( (abs(x_host-x_defect)*abs(x_host-x_defect)) + (abs(y_host-y_defect)*abs(y_host-y_defect)) + (abs(z_host-z_defect)*abs(z_host-z_defect)))
-            if min_distance is None or distance_to_defect < min_distance:
-                min_distance = distance_to_defect
-                closest_species = [x_defect, y_defect, z_defect]
-        all_closest_species.append(closest_species + [min_distance])
-    # Find which species in host where the 'closest distance' to a species in the defect supercell is largest
-    # This is identified as the vacancy in the host supercell
-    x_vac, y_vac, z_vac = host_vac_coords[np.argmax([i[3] for i in all_closest_species])][:3]
-    # Above in one-liner version of code commented out below
-    '''
-    max_dist = 0
-    for i in range(0, len(all_closest_species)):
-        if (all_closest_species[i][3] > max_dist):
-            x_vac, y_vac, z_vac = host_coords[i][:3]
-            max_dist = all_closest_species[i][3]
-    '''
-    # Find line number in coordinates list that corresponds to the defect (in host supercell for vacancy)
-    tmp = host_vac_coords[np.argmax([i[3] for i in all_closest_species])][:3]
-    for i in range (0, len(host_coords)):
-        if (host_coords[i][0:3] == tmp):
-            defect_line = i
+    host_array, host_species = _species_coords(host_coords, lattice_vec_array)
+    defect_array, defect_species = _species_coords(defect_coords, lattice_vec_array)
+    species_vac = find_vacancy(host_coords, defect_coords, species_census(host_species, defect_species))
+    # Vacancy species in host whose closest match of the same species in the defect supercell is furthest away
+    host_vac_lines = np.flatnonzero(host_species == species_vac)
+    defect_line = int(host_vac_lines[_most_isolated_atom(host_array[host_vac_lines], defect_array[defect_species == species_vac], lattice_vec_array)])
+    x_vac, y_vac, z_vac = host_coords[defect_line][:3]
     return species_vac, x_vac, y_vac, z_vac, defect_line
 
 
-def interstitial_coords(host_coords: list, defect_coords: list) -> tuple:
+def interstitial_coords(host_coords: list, defect_coords: list, lattice_vec_array: np.ndarray = None) -> tuple:
     '''
      Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function
+        lattice_vec_array: (optional) lattice vectors from 'lattice_vectors_array', if given the search for the interstitial is periodic
 
     Returns: 
         Vacancy species as string, vacancy coordinates in the perfect host supercell and the line in the geometry file for the defect
         defect_line for an interstitial is defined as the line number in the defect supercell of the atom not present in the host supercell
     '''
-    species_int = find_interstitial(host_coords, defect_coords)  
-    # Read in coordinates of interstitial species in perfect host supercell
-    host_int_coords = []
-    for i in range (0, len(host_coords)):
-        if (host_coords[i][3] == species_int):
-            host_int_coords.append(host_coords[i][:3])
-    # Read in coordinates of interstitial species in defect supercell
-    defect_int_coords = []
-    for i in range (0, len(defect_coords)):
-        if (defect_coords[i][3] == species_int):
-            defect_int_coords.append(defect_coords[i][:3]) 
-    # Find closest interstitial species in host supercell for each one in defect supercell
-    all_closest_species = []
-    for x_defect, y_defect, z_defect in defect_int_coords:
-        closest_species = None
-        min_distance = None
-        for x_host, y_host, z_host in host_int_coords:
-            distance_to_defect = sqrt( (abs(x_host-x_defect)*abs(x_host-x_defect)) + (abs(y_host-y_defect)*abs(y_host-y_defect)) + (abs(z_host-z_defect)*abs(z_host-z_defect)))
-            if min_distance is None or distance_to_defect < min_distance:
-                min_distance = distance_to_defect
-                closest_species = [x_host, y_host, z_host]
-        all_closest_species.append(closest_species + [min_distance])
-    # Find which species in defect where the 'closest distance' to a species in the host supercell is largest
-    # This is identified as the interstitial in the defect supercell
-    x_int, y_int, z_int = defect_int_coords[np.argmax([i[3] for i in all_closest_species])][:3]
-    # Find line number in coordinates list that corresponds to the defect (in defect supercell for interstitial)
-    tmp = defect_int_coords[np.argmax([i[3] for i in all_closest_species])][:3]
-    for i in range (0, len(defect_coords)):
-        if (defect_coords[i][0:3] == tmp):
-            defect_line = i
+    host_array, host_species = _species_coords(host_coords, lattice_vec_array)
+    defect_array, defect_species = _species_coords(defect_coords, lattice_vec_array)
+    species_int = find_interstitial(host_coords, defect_coords, species_census(host_species, defect_species))
+    # Interstitial species in defect supercell whose closest match of the same species in the host is furthest away
+    defect_int_lines = np.flatnonzero(defect_species == species_int)
+    defect_line = int(defect_int_lines[_most_isolated_atom(defect_array[defect_int_lines], host_array[host_species == species_int], lattice_vec_array)])
+    x_int, y_int, z_int = defect_coords[defect_line][:3]
     return species_int, x_int, y_int, z_int, defect_line
 
 
-def antisite_coords(host_coords: list, defect_coords: list) -> tuple:
-    ''' NOTE: TZ:  The way to find the defect is worng for some specific structures, we should find a better way to find the defect atoms. 
-    I try to fixed that within the antisite_coords first, probably similar job should be done in the other routines, i.e. vacancies, and interstitial.
+def antisite_coords(host_coords: list, defect_coords: list, lattice_vec_array: np.ndarray = None) -> tuple:
+    ''' NOTE: TZ: species_in is searched for in the defect supercell. If species_in is not present in the host (extrinsic
+    defect) the first species_in atom in the defect supercell is taken to be the defect. Otherwise the species_in atom
+    whose closest species_in atom in the host is furthest away is identified as the defect.
     
     Args: 
         host_coords: lists of coordinates of host supercell obtained with 'read_atom_coords' function 
         defect_coords: lists of coordinates of defect supercell obtained with 'read_atom_coords' function
+        lattice_vec_array: (optional) lattice vectors from 'lattice_vectors_array', if given the search for the antisite is periodic
 
     Returns: 
         Vacancy species as string, vacancy coordinates in the perfect host supercell and the line in the geometry file for the defect
         defect_line for an antisite is defined as the line number in the defect supercell of the atom not present in the host supercell   
     '''
-    species_in, species_out = find_antisite(host_coords, defect_coords)
-
-    # Find species_in in defect supercell mostly using function for finding interstitial
-    # Read in coordinates of antisite_out species in perfect host supercell
-    # TZ: To make it work for all cases, this should be species_out in the host, and species_in in the defects. 
-    # The defect atoms can be find to be the smallest distance between this coordinates.  the other difference existed in the crystal 
-    # should always be larger than this small changes.   
-
-    host_in_coords = []
-    for i in range (0, len(host_coords)):
-        if (host_coords[i][3] == species_in):
-            host_in_coords.append(host_coords[i][:3]) 
-    # Read in coordinates of antisite_out species in defect supercell
-    defect_in_coords = []
-    for i in range (0, len(defect_coords)):
-        if (defect_coords[i][3] == species_in):
-            defect_in_coords.append(defect_coords[i][:3])  
-    # Find closest antisite_in species in host supercell for each one in defect supercell
-# Original code from suzy 
-#    all_closest_species = []
-#    for x_defect, y_defect, z_defect in defect_in_coords:
-#        closest_species = None
-#        min_distance = None
-#        for x_host, y_host, z_host in host_in_coords:
-#            distance_to_defect = sqrt( (abs(x_host-x_defect)*abs(x_host-x_defect)) + (abs(y_host-y_defect)*abs(y_host-y_defect)) + (abs(z_host-z_defect)*abs(z_host-z_defect)))
-#            if min_distance is None or distance_to_defect < min_distance:
-#                min_distance = distance_to_defect
-#                closest_species = [x_defect, y_defect, z_defect]
-#        all_closest_species.append(closest_species + [min_distance])
-    if not host_in_coords: 
-        #if the species_in coords in the host cell are an empty list, which means the species in is extrinsic defects. 
-        x_in, y_in, z_in = defect_in_coords[0][:3] 
-    else: 
-        #if the species_in coords are not belong to a extrinsic defect type, we compare the min_distance value of the corrd of species_in in the host and defect 
-        #atoms has the largest min distance value is the defect atoms
-        all_closest_species = []
-        for x_defect, y_defect, z_defect in defect_in_coords:
-            closest_species = None
-            min_distance = None
-            for x_host, y_host, z_host in host_in_coords:
-                distance_to_defect = sqrt( (abs(x_host-x_defect)*abs(x_host-x_defect)) + (abs(y_host-y_defect)*abs(y_host-y_defect)) + (abs(z_host-z_defect)*abs(z_host-z_defect)))
-                if min_distance is None or distance_to_defect < min_distance:
-                    min_distance = distance_to_defect
-                    closest_species = [x_defect, y_defect, z_defect]
-            all_closest_species.append(closest_species + [min_distance])
-    # Find which species in defect where the 'closest distance' to a species in the perfect supercell is largest
-    # This is identified as the species added into in the defect supercell
-        x_in, y_in, z_in = defect_in_coords[np.argmax([i[3] for i in all_closest_species])][:3]
-    # Find line number in coordinates list that corresponds to the defect (in defect supercell for antisite)
-    tmp = (x_in, y_in, z_in)
-    #tmp = defect_in_coords[np.argmin([i[3] for i in all_closest_species])][:3]
-    for i in range (0, len(defect_coords)):
-        if (defect_coords[i][0:3] == tmp):
-            defect_line = i
+    host_array, host_species = _species_coords(host_coords, lattice_vec_array)
+    defect_array, defect_species = _species_coords(defect_coords, lattice_vec_array)
+    species_in, species_out = find_antisite(host_coords, defect_coords, species_census(host_species, defect_species))
+    defect_in_lines = np.flatnonzero(defect_species == species_in)
+    # For extrinsic antisites the host has no species_in atoms, so the most isolated atom is the first one
+    defect_line = int(defect_in_lines[_most_isolated_atom(defect_array[defect_in_lines], host_array[host_species == species_in], lattice_vec_array)])
+    x_in, y_in, z_in = defect_coords[defect_line][:3]
     return species_in, species_out, x_in, y_in, z_in, defect_line
 
 
+DefectSite = namedtuple('DefectSite', ['defect_type', 'species', 'species_out', 'cart_coords', 'frac_coords', 'defect_line'])
+
+
+def locate_defect(host_geometry: Geometry, defect_geometry: Geometry) -> DefectSite:
+    ''' Identifies the defect type and species and locates the defect with one periodic KD-tree search.
+    Works directly on the arrays from 'read_geometry' and uses the lattice vectors of the host supercell.
+
+    Args: 
+        host_geometry: Geometry of perfect host supercell obtained with 'read_geometry' function
+        defect_geometry: Geometry of defect supercell obtained with 'read_geometry' function
+
+    Returns: 
+        DefectSite namedtuple with fields:
+        defect_type (vacancy, interstitial, antisite), species (vacancy/interstitial species or species_in for antisites),
+        species_out (species removed for antisites, otherwise None), Cartesian and fractional coordinates of the defect
+        (numpy arrays) and defect_line (in the host supercell for vacancies, otherwise in the defect supercell)
+    '''
+    census = species_census(host_geometry, defect_geometry)
+    host_species = host_geometry.species
+    defect_species = defect_geometry.species
+    lattice = host_geometry.lattice
+
+    defect_type = census.defect_type
+    if defect_type == 'vacancy' and census.species_removed is not None:
+        species, species_out = census.species_removed, None
+        host_lines = np.flatnonzero(host_species == species)
+        defect_line = int(host_lines[_most_isolated_atom(host_geometry.frac_coords[host_lines], defect_geometry.frac_coords[defect_species == species], lattice)])
+        return DefectSite('vacancy', species, species_out, np.array(host_geometry.cart_coords[defect_line]), np.array(host_geometry.frac_coords[defect_line]), defect_line)
+    if defect_type == 'interstitial' and census.species_added is not None:
+        species, species_out = census.species_added, None
+    elif defect_type == 'antisite' and census.species_removed is not None:
+        species, species_out = census.species_added, census.species_removed
+    else:
+        raise ValueError('Error finding defect type for host with '+str(host_geometry.atom_num)+' atoms and defect supercell with '+str(defect_geometry.atom_num)+' atoms')
+    defect_lines = np.flatnonzero(defect_species == species)
+    defect_line = int(defect_lines[_most_isolated_atom(defect_geometry.frac_coords[defect_lines], host_geometry.frac_coords[host_species == species], lattice)])
+    return DefectSite(defect_type, species, species_out, np.array(defect_geometry.cart_coords[defect_line]), np.array(defect_geometry.frac_coords[defect_line]), defect_line)
+
+
+class SiteMap(namedtuple('SiteMap', ['defect_type', 'defect_line', 'host_partner', 'host_index', 'defect_index', 'host_site_mask', 'defect_site_mask'])):
+    ''' Correspondence between atoms in the host and defect supercells (obtained with 'build_site_map')
+    Atoms are paired by their order in the geometry files, skipping the defect site.
+
+    Fields:
+        defect_type: vacancy, interstitial or antisite
+        defect_line: line of the defect (in the host supercell for vacancies, otherwise in the defect supercell)
+        host_partner: integer numpy array with the host atom index paired with each defect supercell atom (-1 for the defect atom)
+        host_index, defect_index: integer numpy arrays of paired host and defect atom indices, in the same order
+        host_site_mask: boolean numpy array over host atoms, True for the defect site (vacancy or antisite)
+        defect_site_mask: boolean numpy array over defect supercell atoms, True for the defect atom (interstitial or antisite)
+    '''
+    __slots__ = ()
+
+    def defect_position(self, host_coords_array: np.ndarray, defect_coords_array: np.ndarray) -> np.ndarray:
+        ''' Coordinates of the defect (from the host supercell for a vacancy, otherwise from the defect supercell) '''
+        if self.defect_type == 'vacancy':
+            return np.asarray(host_coords_array)[self.defect_line]
+        return np.asarray(defect_coords_array)[self.defect_line]
+
+    def paired_coords(self, defect_coords_array: np.ndarray) -> np.ndarray:
+        ''' Coordinates in the defect supercell of every atom that has a host partner (as a new array) '''
+        return np.asarray(defect_coords_array)[self.defect_index]
+
+    def paired_difference(self, host_values: np.ndarray, defect_values: np.ndarray) -> np.ndarray:
+        ''' defect_values - host_values for every pair of host and defect supercell atoms '''
+        return np.asarray(defect_values)[self.defect_index] - np.asarray(host_values)[self.host_index]
+
+    def sampling_coords(self, host_coords_array: np.ndarray, defect_coords_array: np.ndarray) -> np.ndarray:
+        ''' Coordinates of host supercell atoms moved to the positions of their partners in the (relaxed) defect supercell.
+        For a vacancy the vacant site keeps its host position, for other defects this is the defect supercell itself.
+        Returns a new array, neither input is modified.
+        '''
+        if self.defect_type != 'vacancy':
+            return np.array(defect_coords_array)
+        coords = np.array(host_coords_array)
+        coords[self.host_index] = np.asarray(defect_coords_array)[self.defect_index]
+        return coords
+
+
+def build_site_map(defect_type: str, defect_line: int, host_atom_num: int, defect_atom_num: int = None) -> SiteMap:
+    ''' Builds the map between host and defect supercell atoms once per host/defect pair,
+    so potential differences and distances can be computed by indexing whole arrays.
+
+    Args: 
+        defect_type: vacancy, interstitial or antisite (e.g. from 'find_defect_type')
+        defect_line: line of the defect (e.g. from 'vacancy_coords', 'interstitial_coords' or 'antisite_coords')
+        host_atom_num: number of atoms in the host supercell
+        defect_atom_num: number of atoms in the defect supercell (inferred from defect_type if not given)
+
+    Returns: 
+        SiteMap namedtuple
+    '''
+    if defect_atom_num is None:
+        defect_atom_num = host_atom_num + {'vacancy': -1, 'interstitial': 1, 'antisite': 0}[defect_type]
+    host_site_mask = np.zeros(host_atom_num, dtype=bool)
+    defect_site_mask = np.zeros(defect_atom_num, dtype=bool)
+    if defect_type == 'vacancy':
+        host_site_mask[defect_line] = True
+    elif defect_type == 'interstitial':
+        defect_site_mask[defect_line] = True
+    elif defect_type == 'antisite':
+        host_site_mask[defect_line] = True
+        defect_site_mask[defect_line] = True
+    else:
+        raise ValueError('Unknown defect type: '+str(defect_type))
+    host_index = np.flatnonzero(~host_site_mask)
+    defect_index = np.flatnonzero(~defect_site_mask)
+    if len(host_index) != len(defect_index):
+        raise ValueError('Number of atoms in host ('+str(host_atom_num)+') and defect ('+str(defect_atom_num)+') supercells is not consistent with '+str(defect_type))
+    host_partner = np.full(defect_atom_num, -1, dtype=np.intp)
+    host_partner[defect_index] = host_index
+    for array in (host_partner, host_index, defect_index, host_site_mask, defect_site_mask):
+        array.setflags(write=False)
+    return SiteMap(defect_type, int(defect_line), host_partner, host_index, defect_index, host_site_mask, defect_site_mask)
+
+
 def defect_to_boundary(x_defect: float, y_defect: float, z_defect: float, supercell_x: float, supercell_y: float, supercell_z: float) -> float:
     '''
     Args: 
@@ -534,3 +712,92 @@ def defect_to_boundary(x_defect: float, y_defect: float, z_defect: float, superc
     y_min = y_defect if (y_defect <= supercell_y/2.0) else supercell_y - y_defect
     z_min = z_defect if (z_defect <= supercell_z/2.0) else supercell_z - z_defect
     return x_min, y_min, z_min
+
+
+# Largest sigma of the Gaussian charge model relative to the shortest lattice vector of the supercell, to avoid charge spilling over
+MAX_SIGMA_RATIO = 0.2
+
+
+def max_sigma(lattice_vec_array: np.ndarray) -> float:
+    ''' Largest sigma (Angstroms) for the Gaussian charge model in a supercell: MAX_SIGMA_RATIO times the length of its shortest
+    lattice vector (the smallest supercell dimension for orthogonal supercells)
+
+    Args: 
+        lattice_vec_array: 3x3 numpy array of lattice vectors (rows), e.g. from 'lattice_vectors_array'
+    '''
+    return float(MAX_SIGMA_RATIO*np.linalg.norm(np.asarray(lattice_vec_array, dtype=np.float64), axis=1).min())
+
+
+DatasetSigma = namedtuple('DatasetSigma', ['sigma', 'cutoff', 'closest_defect_to_boundary', 'distances_to_boundaries'])
+
+
+def _dataset_geometry_files(path_to_all_defects: str, host_geom: str) -> list:
+    return sorted(geom_file for geom_file in glob.glob(os.path.join(path_to_all_defects, '**/geometry.in'), recursive=True)
+                  if not os.path.samefile(geom_file, host_geom))
+
+
+def _dataset_stamp(host_geom: str, geom_files: list, cutoff_ratio: float) -> list:
+    ''' Path, modification time and size of every file used in the pre-pass, to check if a manifest is still valid '''
+    stamp = [cutoff_ratio]
+    for geom_file in [host_geom] + geom_files:
+        stat = os.stat(geom_file)
+        stamp.append([os.path.abspath(geom_file), stat.st_mtime_ns, stat.st_size])
+    return stamp
+
+
+def dataset_sigma(path_to_all_defects: str, host_geom: str, cutoff_ratio: float = 20.0/1.4, manifest_file: str = None) -> DatasetSigma:
+    ''' Pre-pass over a dataset to set the sigma of the Gaussian charge model shared by all defects (and the corresponding cutoff).
+    Every defect is located once (see 'locate_defect') and the distances of all defects to the supercell boundaries
+    are computed together. Sigma is set 10% less than the closest distance of any defect in the dataset to a supercell boundary,
+    but no larger than 20% of the shortest lattice vector to avoid charge spilling over (see 'max_sigma').
+
+    Args: 
+        path_to_all_defects: directory containing all defect supercells (geometry.in files are found recursively)
+        host_geom: geometry.in of perfect host supercell (skipped if present in path_to_all_defects)
+        cutoff_ratio: plane wave cutoff (Hartree) multiplied by sigma, 20.0 Hartree was found to converge well for sigma=1.4
+        manifest_file: (optional) JSON file storing the results. If none of the geometry files have changed since it was
+                       written, results are read from it and the pre-pass is skipped entirely.
+
+    Returns: 
+        DatasetSigma namedtuple with sigma (Angstroms), cutoff (Hartree), closest_defect_to_boundary (Angstroms)
+        and distances_to_boundaries (dict of closest distance of each defect to a supercell boundary, keyed by geometry file)
+    '''
+    geom_files = _dataset_geometry_files(path_to_all_defects, host_geom)
+    stamp = _dataset_stamp(host_geom, geom_files, cutoff_ratio)
+    if manifest_file is not None and os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('stamp') == stamp:
+            return DatasetSigma(manifest['sigma'], manifest['cutoff'], manifest['closest_defect_to_boundary'], manifest['distances_to_boundaries'])
+
+    host_geometry = read_geometry(host_geom)
+    supercell_dims = np.array(get_supercell_dimensions(host_geom))
+    located_files = []
+    defect_positions = []
+    for geom_file in geom_files:
+        try:
+            defect_positions.append(locate_defect(host_geometry, read_geometry(geom_file)).cart_coords)
+            located_files.append(geom_file)
+        except ValueError as err:
+            logger.info(str(err)+' in '+str(geom_file))
+    if not defect_positions:
+        raise ValueError('No defects could be identified in '+str(path_to_all_defects))
+    # Closest x, y, z distances of every defect to the supercell boundaries in one sweep
+    defect_positions = np.array(defect_positions)
+    boundary_distances = np.where(defect_positions <= supercell_dims/2.0, defect_positions, supercell_dims - defect_positions)
+    closest_distances = boundary_distances.min(axis=1)
+
+    closest_defect_to_boundary = float(abs(closest_distances.min()))
+    if closest_defect_to_boundary == 0.0:
+        raise ValueError('A defect in '+str(path_to_all_defects)+' lies on a supercell boundary, sigma must be set manually')
+    sigma = closest_defect_to_boundary-(0.1*closest_defect_to_boundary)
+    if (sigma >= max_sigma(host_geometry.lattice)):
+        sigma = max_sigma(host_geometry.lattice)
+    cutoff = cutoff_ratio/sigma
+    distances_to_boundaries = dict(zip(located_files, closest_distances.tolist()))
+
+    if manifest_file is not None:
+        with open(manifest_file, 'w') as f:
+            json.dump({'stamp': stamp, 'sigma': sigma, 'cutoff': cutoff, 'closest_defect_to_boundary': closest_defect_to_boundary,
+                       'distances_to_boundaries': distances_to_boundaries}, f, indent=1)
+    return DatasetSigma(sigma, cutoff, closest_defect_to_boundary, distances_to_boundaries)
@@ -0,0 +1,144 @@
+'''
+Numpy implementations of the unit-charge terms of the Lany-Zunger (LZ) image-charge correction, without pylada:
+the Madelung energy E1 of a point charge in a neutralising background (Ewald sum) and the third-order term E3.
+These give the same values as 'get_madelungenergy' and 'thirdO' in PyladaDefectsImageCharge.py (for unit charge,
+epsilon = 1), and are vectorised over lattices, so the terms for many supercells are computed together.
+
+Both terms only depend on the lattice through its metric tensor (A^T A for lattice vectors as the columns of A), so the
+squared lengths of all lattice/reciprocal lattice vectors (or quadrature points) of a batch of lattices are obtained with
+one matrix product. scipy (for erfc) is only imported when the Madelung energies are computed.
+
+To use, the following lines must be added to the code:
+    import ImageChargeKernels as ick
+    E1 = ick.madelung_energy(latt_vec_array)
+    E3 = ick.third_order_energy(latt_vec_array, n=20)
+'''
+
+from functools import lru_cache
+import numpy as np
+
+hartree = 27.21138505
+bohr = 0.52917721092
+# e^2/(4 pi epsilon_0) in eV Angstrom
+coulomb = hartree*bohr
+# Ewald sums are truncated where the terms fall below exp(-EWALD_EXPONENT**2) of the leading term
+EWALD_EXPONENT = 6.0
+# Number of lattices handled in each matrix product, to bound memory for large batches
+BATCH_SIZE = 8
+
+def _as_lattices(latt_vec_arrays) -> np.ndarray:
+    ''' Batch of lattices (L, 3, 3), with lattice vectors as columns '''
+    lattices = np.asarray(latt_vec_arrays, dtype=float)
+    return lattices.reshape(-1, 3, 3)
+
+
+def _metric_components(lattices: np.ndarray) -> np.ndarray:
+    ''' Independent components (M_00, M_11, M_22, M_01, M_02, M_12) of the metric tensor of each lattice, shape (6, L) '''
+    metric = np.einsum('lji,ljk->lik', lattices, lattices)
+    return np.array([metric[:, 0, 0], metric[:, 1, 1], metric[:, 2, 2], metric[:, 0, 1], metric[:, 0, 2], metric[:, 1, 2]])
+
+
+def _monomials(vectors: np.ndarray) -> np.ndarray:
+    ''' Products of components of vectors (K, 3), such that _monomials(v) @ _metric_components(A) = |A v|^2 '''
+    x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+    return np.column_stack([x*x, y*y, z*z, 2*x*y, 2*x*z, 2*y*z])
+
+
+def _integer_vectors(n_max) -> np.ndarray:
+    ''' All integer vectors with |n_i| <= n_max[i], except the origin '''
+    ranges = [np.arange(-n, n+1) for n in n_max]
+    vectors = np.array(np.meshgrid(*ranges, indexing='ij')).reshape(3, -1).T
+    return vectors[np.any(vectors != 0, axis=1)]
+
+
+def madelung_energies(latt_vec_arrays) -> np.ndarray:
+    ''' Madelung energy E1 (eV) of a unit point charge in a neutralising background for each lattice, from the Ewald sum
+    E = (1/2) [sum_R erfc(eta R)/R + (4 pi/V) sum_G exp(-G^2/(4 eta^2))/G^2 - 2 eta/sqrt(pi) - pi/(eta^2 V)] and E1 = -E
+
+    Args:
+        latt_vec_arrays: lattice vectors as columns (Angstroms), one (3, 3) array or a batch of shape (L, 3, 3)
+
+    Returns:
+        Numpy array of E1 for each lattice
+    '''
+    from scipy.special import erfc
+    lattices = _as_lattices(latt_vec_arrays)
+    energies = np.empty(len(lattices))
+    for start in range(0, len(lattices), BATCH_SIZE):
+        batch = lattices[start:start+BATCH_SIZE]
+        volumes = np.abs(np.linalg.det(batch))
+        # Splitting parameter that balances the number of real and reciprocal space terms
+        eta = np.sqrt(np.pi)/volumes**(1/3.)
+        inverse = np.linalg.inv(batch)
+        # Real space: all R = A n with |R| <= EWALD_EXPONENT/eta, n_i is bounded by the spacing of lattice planes
+        r_cut = EWALD_EXPONENT/eta
+        n_real = np.ceil(np.max(r_cut[:, None]*np.linalg.norm(inverse, axis=2), axis=0)).astype(int)
+        R2 = _monomials(_integer_vectors(n_real)) @ _metric_components(batch)
+        R = np.sqrt(R2)
+        real = np.where(R <= r_cut, erfc(eta*R)/R, 0.0).sum(axis=0)
+        # Reciprocal space: all G = 2 pi A^-T m with |G| <= 2 eta EWALD_EXPONENT
+        g_cut = 2.0*eta*EWALD_EXPONENT
+        n_recip = np.ceil(np.max(g_cut[:, None]*np.linalg.norm(batch, axis=1)/(2.0*np.pi), axis=0)).astype(int)
+        reciprocal = 2.0*np.pi*np.transpose(inverse, (0, 2, 1))
+        G2 = _monomials(_integer_vectors(n_recip)) @ _metric_components(reciprocal)
+        recip = 4.0*np.pi/volumes*np.where(G2 <= g_cut**2, np.exp(-G2/(4.0*eta**2))/G2, 0.0).sum(axis=0)
+        ewald = 0.5*(real + recip - 2.0*eta/np.sqrt(np.pi) - np.pi/(eta**2*volumes))
+        energies[start:start+len(batch)] = -coulomb*ewald
+    return energies
+
+
+def madelung_energy(latt_vec_array) -> float:
+    ''' Madelung energy E1 (eV) of a unit point charge for one lattice (vectors as columns, Angstroms), see madelung_energies '''
+    return float(madelung_energies(latt_vec_array)[0])
+
+
+# One of each pair +-n of the 26 nearest periodic images (fractional translations)
+_IMAGE_PAIRS = np.array([n for n in np.array(np.meshgrid(*[np.arange(-1, 2)]*3, indexing='ij')).reshape(3, -1).T
+                         if tuple(n) > (0, 0, 0)], dtype=float)
+
+
+@lru_cache(maxsize=8)
+def _quadrature_points(n: int) -> tuple:
+    ''' The n^3 fractional quadrature points of the cell, shifted by lattice vectors to lie in [-1/2, 1/2]^3, and their monomials '''
+    points = np.array(np.meshgrid(*[np.arange(n)/float(n)]*3, indexing='ij')).reshape(3, -1).T
+    points = points - np.round(points)
+    return points, _monomials(points)
+
+
+def third_order_energies(latt_vec_arrays, n: int = 20) -> np.ndarray:
+    ''' Third-order term E3 (eV) of the LZ image-charge correction for a unit charge for each lattice,
+    E3 = -(2 pi/3V) <r^2>, with <r^2> the mean squared minimum-image distance from the defect over an n x n x n grid of the cell
+    (as 'third_order' from pylada.crystal.defects, Eq. 7 of LZ 2009)
+
+    For a point f (fractional, in [-1/2, 1/2]^3) and metric M, |f+m|^2 = |f|^2 + 2 f.(Mm) + m.Mm, so the nearer of the images
+    +-m is |f|^2 + m.Mm - 2|f.(Mm)|. Pairs with m.Mm >= sum_i |(Mm)_i| are never nearer than f itself and are skipped,
+    which leaves few (or no) images to check for cells that are not strongly skewed.
+
+    Args:
+        latt_vec_arrays: lattice vectors as columns (Angstroms), one (3, 3) array or a batch of shape (L, 3, 3)
+        n: number of quadrature points along each lattice vector
+
+    Returns:
+        Numpy array of E3 for each lattice
+    '''
+    lattices = _as_lattices(latt_vec_arrays)
+    points, monomials = _quadrature_points(int(n))
+    energies = np.empty(len(lattices))
+    for start in range(0, len(lattices), BATCH_SIZE):
+        batch = lattices[start:start+BATCH_SIZE]
+        r2 = monomials @ _metric_components(batch)
+        metric = np.einsum('lji,ljk->lik', batch, batch)
+        Mm = np.einsum('lij,kj->lik', metric, _IMAGE_PAIRS)
+        mMm = np.einsum('ki,lik->lk', _IMAGE_PAIRS, Mm)
+        # Change in r^2 from the nearest image of each point (zero where it is the point itself), shape (L, n^3)
+        shift = np.zeros((len(batch), len(points)))
+        for k in np.flatnonzero(np.any(mMm < np.abs(Mm).sum(axis=1), axis=0)):
+            np.minimum(shift, mMm[:, k, None] - 2.0*np.abs(Mm[:, :, k] @ points.T), out=shift)
+        mean_r2 = r2.mean(axis=0) + shift.mean(axis=1)
+        energies[start:start+len(batch)] = -coulomb*(2.0*np.pi/3.0)*mean_r2/np.abs(np.linalg.det(batch))
+    return energies
+
+
+def third_order_energy(latt_vec_array, n: int = 20) -> float:
+    ''' Third-order term E3 (eV) for a unit charge for one lattice (vectors as columns, Angstroms), see third_order_energies '''
+    return float(third_order_energies(latt_vec_array, n)[0])
@@ -0,0 +1,230 @@
+'''
+Persistent on-disk cache for numpy arrays parsed from FHI-aims output files (and other workflow results).
+
+Each entry is a directory of .npy files named by a key. For parsed files, the key is the hash of the file contents
+plus the kind of data parsed, so an unchanged file is only ever parsed once, however many notebooks or dataset runs read it.
+Hashes are remembered against each file's path, modification time and size (one small record per path, replaced when the file
+changes), so unchanged files are not re-hashed either.
+Arrays are loaded with memory-mapping on a cache hit. The total size of the cache is capped, evicting the least recently used entries;
+entries larger than the cap are not stored.
+
+To use, the following lines must be added to the code (the cache is disabled until a directory is set):
+    import ParsedDataCache as pdc
+    pdc.configure_cache(os.path.join("ProcessedDefects", "cache"))
+
+The cache directory can also be set with the environment variable DEFECT_CORRECTIONS_CACHE_DIR.
+'''
+
+import numpy as np
+import os
+import hashlib
+import json
+import shutil
+import tempfile
+import logging
+logger = logging.getLogger()
+
+# Increase if the format of stored entries changes, so that old entries are not used
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 2*1024**3
+
+_cache_dir = os.environ.get('DEFECT_CORRECTIONS_CACHE_DIR') or None
+_max_bytes = DEFAULT_MAX_BYTES
+# Directory (inside the cache directory) of content hash records, one JSON file per source file path
+_HASHES_DIR = '.hashes'
+# Size of the cache directory as last scanned plus the entries stored by this process since, None until first scanned
+_cache_bytes = None
+
+
+def configure_cache(cache_dir: str, max_bytes: int = DEFAULT_MAX_BYTES) -> str:
+    ''' Sets the directory used for the cache (None to disable it) and the maximum total size of stored entries
+
+    Args:
+        cache_dir: directory to store cached arrays in, created if it does not exist
+        max_bytes: size cap for the cache, least recently used entries are removed when it is exceeded
+
+    Returns:
+        Absolute path of the cache directory (or None if disabled)
+    '''
+    global _cache_dir, _max_bytes, _cache_bytes
+    _max_bytes = max_bytes
+    _cache_bytes = None
+    if cache_dir is None:
+        _cache_dir = None
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    _cache_dir = os.path.abspath(cache_dir)
+    return _cache_dir
+
+
+def get_cache_dir() -> str:
+    ''' Directory currently used for the cache (None if caching is disabled) '''
+    return _cache_dir
+
+
+def get_max_bytes() -> int:
+    ''' Current size cap for the cache '''
+    return _max_bytes
+
+
+def clear_cache():
+    ''' Removes all entries from the cache directory '''
+    if _cache_dir is not None and os.path.isdir(_cache_dir):
+        shutil.rmtree(_cache_dir)
+        os.makedirs(_cache_dir, exist_ok=True)
+
+
+def hash_key(*parts) -> str:
+    ''' Canonical sha256 hex digest for a key built from strings, numbers, lists, dicts and numpy arrays '''
+    def canonical(obj):
+        if isinstance(obj, np.ndarray):
+            return {'shape': list(obj.shape), 'data': obj.tolist()}
+        if isinstance(obj, (np.integer, np.floating)):
+            return obj.item()
+        if isinstance(obj, (list, tuple)):
+            return [canonical(item) for item in obj]
+        if isinstance(obj, dict):
+            return {str(key): canonical(value) for key, value in obj.items()}
+        return obj
+    text = json.dumps([CACHE_VERSION, canonical(list(parts))], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _hash_record_path(source_path: str) -> str:
+    return os.path.join(_cache_dir, _HASHES_DIR, hashlib.sha256(source_path.encode()).hexdigest()+'.json')
+
+
+def _load_hash_record(source_path: str) -> dict:
+    try:
+        with open(_hash_record_path(source_path), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_hash_record(source_path: str, record: dict):
+    # Written to a temporary file and renamed, so concurrent writers never leave a partly written record
+    record_path = _hash_record_path(source_path)
+    os.makedirs(os.path.dirname(record_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(record_path), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, record_path)
+
+
+def file_hash(source_file: str) -> str:
+    ''' sha256 of the contents of source_file, only re-hashed if its path, modification time or size change.
+    The hash is recorded in its own file for each path, so the record of a changed file replaces its stale one
+    and processes hashing different files never write to the same record. '''
+    stat = os.stat(source_file)
+    source_path = os.path.abspath(source_file)
+    stamp = '|'.join([str(stat.st_mtime_ns), str(stat.st_size)])
+    record = _load_hash_record(source_path) if _cache_dir is not None else {}
+    if record.get('stamp') == stamp:
+        return record['hash']
+    sha = hashlib.sha256()
+    with open(source_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    content_hash = sha.hexdigest()
+    if _cache_dir is not None:
+        _save_hash_record(source_path, {'stamp': stamp, 'hash': content_hash})
+    return content_hash
+
+
+def load_entry(key: str) -> dict:
+    ''' Arrays stored under key, memory-mapped read-only (None if there is no such entry) '''
+    if _cache_dir is None:
+        return None
+    entry_dir = os.path.join(_cache_dir, key)
+    if not os.path.isdir(entry_dir):
+        return None
+    try:
+        arrays = {name[:-4]: np.load(os.path.join(entry_dir, name), mmap_mode='r')
+                  for name in os.listdir(entry_dir) if name.endswith('.npy')}
+    except (IOError, ValueError):
+        logger.info('Ignoring unreadable cache entry '+str(entry_dir))
+        return None
+    # Modification time of the entry directory records when it was last used, for LRU eviction
+    os.utime(entry_dir, None)
+    return arrays
+
+
+def store_entry(key: str, arrays: dict):
+    ''' Stores a dict of numpy arrays under key, then evicts least recently used entries if the cache is over its size cap.
+    Entries larger than the size cap are not stored. '''
+    global _cache_bytes
+    if _cache_dir is None:
+        return
+    arrays = {name: np.asarray(array) for name, array in arrays.items()}
+    if sum(array.nbytes for array in arrays.values()) > _max_bytes:
+        logger.info('Not caching '+str(key)+' as it is larger than the cache size cap of '+str(_max_bytes)+' bytes')
+        return
+    entry_dir = os.path.join(_cache_dir, key)
+    tmp_dir = tempfile.mkdtemp(dir=_cache_dir, prefix='.tmp-')
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name+'.npy'), array)
+    size = _entry_size(tmp_dir)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    # The cache directory is only scanned when the running total goes over the cap, not after every store
+    if _cache_bytes is None:
+        _cache_bytes = _scan_entries()[1]
+    else:
+        _cache_bytes += size
+    if _cache_bytes > _max_bytes:
+        _evict()
+
+
+def _entry_size(entry_dir: str) -> int:
+    return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+
+def _scan_entries() -> tuple:
+    ''' (modification time, size, path) of every entry in the cache directory and their total size '''
+    entries = []
+    for name in os.listdir(_cache_dir):
+        entry_dir = os.path.join(_cache_dir, name)
+        if not name.startswith('.') and os.path.isdir(entry_dir):
+            try:
+                entries.append((os.path.getmtime(entry_dir), _entry_size(entry_dir), entry_dir))
+            except OSError:
+                # Evicted by another process while scanning
+                continue
+    return entries, sum(size for _, size, _ in entries)
+
+
+def _evict():
+    global _cache_bytes
+    entries, total = _scan_entries()
+    for _, size, entry_dir in sorted(entries):
+        if total <= _max_bytes:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total -= size
+    _cache_bytes = total
+
+
+def cached_parse(source_file: str, kind: str, parse) -> dict:
+    ''' Returns the arrays parsed from source_file, only calling parse on a cache miss
+
+    Args:
+        source_file: file to be parsed
+        kind: name for the type of data parsed from the file (e.g. 'geometry'), part of the cache key
+        parse: function taking source_file and returning a dict of numpy arrays
+
+    Returns:
+        Dict of numpy arrays (memory-mapped when loaded from the cache)
+    '''
+    if _cache_dir is None:
+        return parse(source_file)
+    key = kind+'-'+hash_key(kind, file_hash(source_file))
+    arrays = load_entry(key)
+    if arrays is None:
+        arrays = parse(source_file)
+        store_entry(key, arrays)
+    return arrays
@@ -0,0 +1,119 @@
+'''
+Planar averages of potentials on 3D grids (e.g. V_r.npy from the CoFFEE Poisson solver), as done by plavg.py from CoFFEE_1.1
+('PotentialAlignment/Utilities/plavg.py' written by Mit Naik).
+
+The average over the planes normal to a1, a2 or a3 is done with numpy reductions over chunks of the grid, so that large
+grids in .npy files are memory-mapped and read a chunk at a time rather than loaded into memory all at once.
+
+It also reads the planar averages of the electrostatic potential written by FHI-aims (plane_average_realspace_ESP.out).
+
+To use, the following lines must be added to the code:
+    import PlanarAverage as pa
+    z, V_z = pa.planar_average("V_r.npy", "a3", cell_length)
+    free_atom_pot, average_pot, planar_pot = pa.read_planar_pot("plane_average_realspace_ESP.out")
+'''
+
+import os
+import numpy as np
+from collections import namedtuple, OrderedDict
+import ParsedDataCache as pdc
+import SolverGrids as sg
+
+rydberg = 13.60569253
+hartree = 27.21138505
+
+# Index of the grid axis along each lattice vector
+DIRECTIONS = {'a1': 0, 'a2': 1, 'a3': 2}
+# Size of the chunks of the grid read into memory at a time
+DEFAULT_CHUNK_BYTES = sg.DEFAULT_CHUNK_BYTES
+
+# Contents of a plane_average_realspace_ESP.out file: average free-atom electrostatic potential (eV) and average real-space
+# part of the electrostatic potential (eV) from the header, and the planar average (z in Angstroms, potential in hartree)
+PlanarPotential = namedtuple('PlanarPotential', ['free_atom_pot', 'average_pot', 'planar_pot'])
+# Files read most recently, keyed by path, modification time and size of the file (see read_planar_pot), the least recently
+# used are dropped so that long-running processes (e.g. dataset workers) do not keep every file they have read
+_PLANAR_POT_CACHE_SIZE = 64
+_planar_pots = OrderedDict()
+
+
+def load_grid(grid_file: str) -> np.ndarray:
+    ''' Memory-mapped (read-only) 3D grid from a .npy file, nothing is read into memory until it is used '''
+    return np.load(grid_file, mmap_mode='r')
+
+
+def planar_average(grid, direction: str = 'a3', cell_length: float = None, factor: str = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+    ''' Average of a 3D grid over the planes normal to one lattice vector
+
+    Args:
+        grid: 3D numpy array (or memmap), or .npy file containing one
+        direction: lattice vector the average is plotted along, 'a1', 'a2' or 'a3'
+        cell_length: (optional) length of the cell along direction, the coordinates are grid indices if not set
+        factor: (optional) 'Ryd' or 'Hartree' to convert the potential from these units to eV
+        chunk_bytes: maximum size of the part of the grid in memory at a time
+
+    Returns:
+        Coordinates of the planes along direction and the planar average for each plane (numpy arrays)
+    '''
+    if direction not in DIRECTIONS:
+        raise ValueError("Direction for planar average should be a1, a2 or a3, not "+str(direction))
+    if isinstance(grid, str):
+        grid = load_grid(grid)
+    axis = DIRECTIONS[direction]
+    n1, n2, n3 = grid.shape
+    profile = np.zeros(grid.shape[axis])
+    # Chunks are slabs along the first (slowest varying) axis, so each is a contiguous block of the file
+    for start, (chunk,) in sg.grid_slabs([grid], chunk_bytes):
+        # Only the real part of the potential is used (the imaginary part is numerical noise)
+        chunk = np.real(chunk)
+        if axis == 0:
+            profile[start:start+chunk.shape[0]] = chunk.sum(axis=(1, 2))
+        elif axis == 1:
+            profile += chunk.sum(axis=(0, 2))
+        else:
+            profile += chunk.sum(axis=(0, 1))
+    profile /= (n1*n2*n3)/grid.shape[axis]
+
+    if factor == "Ryd":
+        profile = profile*rydberg
+    elif factor == "Hartree":
+        profile = profile*hartree
+    step = 1.0 if cell_length is None else cell_length/grid.shape[axis]
+    return np.arange(grid.shape[axis])*step, profile
+
+
+def _parse_planar_pot(planar_pot_file: str) -> dict:
+    with open(planar_pot_file, 'r') as f:
+        free_atom_pot = float(f.readline().split()[-1])
+        average_pot = float(f.readline().split()[-1])
+        f.readline() # Skip column headers
+        # Rest of the file is split and converted in one go, columns are: z-coordinate, plane-average
+        planar_pot = np.array(f.read().split(), dtype=np.float64).reshape(-1,2)
+    return {'free_atom_pot': np.array(free_atom_pot), 'average_pot': np.array(average_pot), 'planar_pot': planar_pot}
+
+
+def read_planar_pot(planar_pot_file: str) -> PlanarPotential:
+    ''' Reads a plane_average_realspace_ESP.out file from FHI-aims, with the header and the planar average read together.
+    Each file is only read once (while it is unchanged and among the last 64 files read), later calls return the same result,
+    with a read-only planar_pot array
+    (parsed arrays are also stored in the on-disk cache from ParsedDataCache, if configured)
+
+    Args:
+        planar_pot_file: plane_average_realspace_ESP.out file from an FHI-aims calculation
+
+    Returns:
+        PlanarPotential of free_atom_pot and average_pot (floats, eV) and planar_pot (numpy array of z (Angstroms) and potential (hartree))
+    '''
+    stat = os.stat(planar_pot_file)
+    key = (os.path.abspath(planar_pot_file), stat.st_mtime_ns, stat.st_size)
+    planar_potential = _planar_pots.get(key)
+    if planar_potential is None:
+        arrays = pdc.cached_parse(planar_pot_file, 'planar_pot_file', _parse_planar_pot)
+        planar_pot = np.array(arrays['planar_pot'])
+        planar_pot.setflags(write=False)
+        planar_potential = PlanarPotential(float(arrays['free_atom_pot']), float(arrays['average_pot']), planar_pot)
+        _planar_pots[key] = planar_potential
+        if len(_planar_pots) > _PLANAR_POT_CACHE_SIZE:
+            _planar_pots.popitem(last=False)
+    else:
+        _planar_pots.move_to_end(key)
+    return planar_potential
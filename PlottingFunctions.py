@@ -1,69 +1,45 @@
 import numpy as np
 import sys, string
-import matplotlib.pyplot as plt    
-import matplotlib   
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+import PlanarAverage as pa
+import AtomPotentialAlignment as apa
+
+# A figure to be drawn: draw(axes, **data) draws it and it is saved to filename
+PlotJob = namedtuple('PlotJob', ['draw', 'filename', 'data'])
+# Settings for saving figures (see configure_plotting), figures queued in headless mode (PlotJob, or Future if drawn in the background)
+_plot_settings = {"headless": False, "dpi": 600, "workers": 1}
+_plot_queue = []
+_plot_executor = None
 
 # Functions from Tong's plotting scripts -----------------------------------------------------------------------------------
 
-def py_read(file):
-    vol = np.load(file)
+def py_read(file, mmap_mode=None):
+    # mmap_mode='r' opens the grid memory-mapped rather than reading it all into memory
+    vol = np.load(file, mmap_mode=mmap_mode)
     grid = np.shape(vol)
     return grid,vol
 
 def read_file(Filename):  
     # Reading the plane-average-file from FHI-aims output, 
     # and obtain the free-average-contribution, and the raw data 
-    F = open(Filename, "r")
-    res = F.readline().split()
-    dim=len(res)
-    average_free = float(res[dim-1])
-    F.readline()
-    F.readline()
-    data = F.readlines()
-    dim = len(data)
-    result  = np.zeros([dim,2])
-    i = 0 
-    for line in data:
-        words = line.split()
-        result[i][0] = float(words[0])
-        result[i][1] = float(words[1])
-        i=i+1
-    return average_free, result
-
-def plot_atom_average_alignment(lattice,defect_charge,aims_atom_pots,model_pots,model,filename, user_ymin = None, user_ymax = None, user_xlabel = None, user_ylabel = None, user_title = None): 
-    volume = np.dot(lattice[0,:],np.cross(lattice[1,:],lattice[2,:]))
-    # Define the parameters corresponding to the Wigner-Seize Cells.   
-    Rws = (volume*3.0/(4.0*np.pi))**(1.0/3.0)
-    temp_a = (lattice[0][0]+lattice[1][0]+lattice[2][0])**2
-    temp_b = (lattice[0][1]+lattice[1][1]+lattice[2][1])**2
-    temp_c = (lattice[0][2]+lattice[1][2]+lattice[2][2])**2
-    Rwl  = 0.5*np.sqrt(temp_a + temp_b + temp_c)
- 
-    plt.clf()
-    matplotlib.rc('font',family='Times New Roman')
-    plt.figure(figsize=(5.3,4.0))
-  
-    plt.xlabel(r'Distance from a defect ($\AA$)',fontsize=15,fontname = "Times New Roman")
-    plt.ylabel('Potential (V)',fontsize=15,fontname = "Times New Roman")
-    plt.xlim((0,Rwl))
+    # (read once for each file with 'PlanarAverage.read_planar_pot', a copy of the data is returned)
+    planar_pot = pa.read_planar_pot(Filename)
+    return planar_pot.free_atom_pot, np.array(planar_pot.planar_pot)
+
+def plot_atom_average_alignment(lattice,defect_charge,aims_atom_pots,model_pots,model,filename, user_ymin = None, user_ymax = None, user_xlabel = None, user_ylabel = None, user_title = None, alignment = None): 
+    # The alignment is computed with 'AtomPotentialAlignment.atom_alignment' (or given as alignment), this draws its sampling region
+    if alignment is None:
+        alignment = apa.atom_alignment(lattice, aims_atom_pots, model_pots if model == True else None)
+    Rws, Rwl = alignment.Rws, alignment.Rwl
+    value_sample = alignment.mean
+    value = '%.3f' % (-1.0*defect_charge*alignment.mean)
+    pa_atom = value
+
+    xlabel = user_xlabel if user_xlabel else r'Distance from a defect ($\AA$)'
+    ylabel = user_ylabel if user_ylabel else 'Potential (V)'
 
     if model == False: 
-        #Calculate the Potential Alignment Term
-        Dim = len(aims_atom_pots[:,1])
-        value = 0
-        number = 0
-        for i in range(Dim):
-            dist = aims_atom_pots[i][0]
-            if ((dist > Rws) and (dist < Rwl)):
-                value += aims_atom_pots[i,1]
-                number += 1.0
-
-        value_sample = value/number
-        value = -1.0*defect_charge*value/number
-    
-        value = '%.3f' % value
-        pa_atom = value
- 
         title = r'$\Delta E_{PA}^{LZ}(\alpha, q) = -q(V(\alpha,0)-V(Host))|_{far}$ = '+str(value) + ' eV'
 
         mean = (max(aims_atom_pots[:,1]) + min(aims_atom_pots[:,1]))/2.0
@@ -71,44 +47,15 @@ def plot_atom_average_alignment(lattice,defect_charge,aims_atom_pots,model_pots,
         # Options for user to override plot settings
         if user_title:
             title = user_title
-        if user_xlabel:
-            plt.xlabel(user_xlabel,fontsize=14,fontname = "Times New Roman")
-        if user_ylabel:
-            plt.ylabel(user_ylabel,fontsize=14,fontname = "Times New Roman")
-        
-        
+
         #Ploting the alignment plot       
-        plt.axvline(x=Rws,linestyle='--',color='orange',lw =2.0) 
-        plt.text(Rws,mean,r'$R_{ws}$',color='orange',fontsize=15,fontname = "Times New Roman")
-    
-        plt.title(title,fontsize=15,fontname = "Times New Roman")
-    
-        plt.plot(aims_atom_pots[:,0],aims_atom_pots[:,1],'o',ms=5,markerfacecolor='none', markeredgecolor='red',label=r'V($\alpha$,0)-V(Host)')
-        plt.annotate(s='', xy=(Rwl,value_sample), xytext=(Rws,value_sample), arrowprops=dict(arrowstyle='<->',color = 'orange',lw = 2.0))
-        plt.axhline(y=value_sample, xmin=Rws, xmax=Rwl, color='orange',label='Sampling Region')
-        plt.legend()
-        plt.savefig(filename,dpi=600)
-        plt.show(block=False)
+        _output_figure(_draw_atom_average_alignment, filename, Rws=Rws, Rwl=Rwl, mean=mean, value_sample=value_sample, title=title,
+                       xlabel=xlabel, ylabel=ylabel, points=[(aims_atom_pots[:,0],aims_atom_pots[:,1],r'V($\alpha$,0)-V(Host)')])
         return  pa_atom
     
     
     if model == True: 
         Diff = aims_atom_pots[:,1] - model_pots[:,1]
-        Dim = len(Diff)
-        number = 0
-        value = 0
-
-        for i in range(Dim):
-            #print(Model[i,0])
-            if ((model_pots[i,0] > Rws) and (model_pots[i,0] < Rwl)):
-                value += Diff[i]
-                number += 1.0
-
-        value_sample = value/number 
-        value = defect_charge*value/number 
-        value = -1.0*value 
-        value = '%.3f' % value
-        pa_atom = value
         title = r'$-q \Delta $'+'='+str(value) 
         y_min = min(model_pots[:,1])
         y_max = max(model_pots[:,1])
@@ -123,31 +70,35 @@ def plot_atom_average_alignment(lattice,defect_charge,aims_atom_pots,model_pots,
             Ymax = user_ymax
         if user_title:
             title = user_title
-        if user_xlabel:
-            plt.xlabel(user_xlabel,fontsize=15,fontname = "Times New Roman")
-        if user_ylabel:
-            plt.ylabel(user_ylabel,fontsize=15,fontname = "Times New Roman")
-
-        plt.ylim((Ymin,Ymax))    
-        plt.axvline(x=Rws,linestyle='--',color='orange',lw =2.0) 
-        plt.text(Rws,mean,r'$R_{ws}$',color='orange',fontsize=15,fontname = "Times New Roman")
-        #plt.title(title,fontsize=15,fontname = "Times New Roman")
-        plt.title('test 2',fontsize=15,fontname = "Times New Roman")
-    
+
         #plt.plot(X1,Y1,'or',label='V(Defect,q)-V(Defect,0)')
-        plt.plot(aims_atom_pots[:,0],aims_atom_pots[:,1],'o',ms=5,markerfacecolor='none', markeredgecolor='red',label=r'V($\alpha$,q)-V(Host)')
-        plt.plot(model_pots[:,0],model_pots[:,1],'o',ms=5,markerfacecolor='none', markeredgecolor='blue',label=r'V(Model)')
-        plt.plot(model_pots[:,0],Diff,'ok',ms=5,label=r'(V($\alpha$,q)-V(Host))-V(Model)')
-        plt.annotate(s='', xy=(Rws,value_sample), xytext=(Rwl,value_sample), arrowprops=dict(arrowstyle='<->',color = 'orange',lw = 2.0))
-        plt.axhline(y=value_sample, xmin=Rws, xmax=Rwl, color='orange',label='Sampling Region')
-    
-    
-        plt.legend()
-        plt.savefig(filename,dpi=600)
-        
+        _output_figure(_draw_atom_average_alignment, filename, Rws=Rws, Rwl=Rwl, mean=mean, value_sample=value_sample, title='test 2',
+                       xlabel=xlabel, ylabel=ylabel, ylim=(Ymin,Ymax),
+                       points=[(aims_atom_pots[:,0],aims_atom_pots[:,1],r'V($\alpha$,q)-V(Host)'),
+                               (model_pots[:,0],model_pots[:,1],r'V(Model)'),
+                               (model_pots[:,0],Diff,r'(V($\alpha$,q)-V(Host))-V(Model)')])
         return pa_atom  
 
 
+def _draw_atom_average_alignment(ax, Rws, Rwl, mean, value_sample, title, xlabel, ylabel, points, ylim=None):
+    # points: (distances, potentials, label) for each set of atom potentials, drawn as red, blue and then black markers
+    ax.set_xlabel(xlabel,fontsize=15,fontname = "Times New Roman")
+    ax.set_ylabel(ylabel,fontsize=15,fontname = "Times New Roman")
+    ax.set_xlim((0,Rwl))
+    if ylim is not None:
+        ax.set_ylim(ylim)
+    ax.axvline(x=Rws,linestyle='--',color='orange',lw =2.0) 
+    ax.text(Rws,mean,r'$R_{ws}$',color='orange',fontsize=15,fontname = "Times New Roman")
+    ax.set_title(title,fontsize=15,fontname = "Times New Roman")
+    for (X,Y,label),color in zip(points,['red','blue']):
+        ax.plot(X,Y,'o',ms=5,markerfacecolor='none', markeredgecolor=color,label=label)
+    if len(points) == 3:
+        ax.plot(points[2][0],points[2][1],'ok',ms=5,label=points[2][2])
+    ax.annotate('', xy=(Rwl,value_sample), xytext=(Rws,value_sample), arrowprops=dict(arrowstyle='<->',color = 'orange',lw = 2.0))
+    ax.axhline(y=value_sample, xmin=Rws, xmax=Rwl, color='orange',label='Sampling Region')
+    ax.legend()
+
+
 def plot_planar_average_alignment(lattice_constant_z,Defect_pos,charge,X,aims_pots,model_pots,model,func,filename, user_ymin = None, user_ymax = None, user_xlabel = None, user_ylabel = None, user_title = None):
     # begin ploting planer_average_alignment  
     # find the postion which is most far away from the defect position.
@@ -186,20 +137,9 @@ def plot_planar_average_alignment(lattice_constant_z,Defect_pos,charge,X,aims_po
     if user_ymax:
         y_max = user_ymax
 
-    #Generating the Plots    
-    plt.clf()
-    matplotlib.rc('font',family='Times New Roman')
-    plt.figure(figsize=(5.3,4.0)) 
-    plt.xlim((0,lattice_constant_z))
-    plt.ylim((y_min,y_max)) 
-    plt.xlabel(r'Z-coordinates ($\AA$)',fontsize=15,fontname = "Times New Roman")
-    plt.ylabel('Potential (V)',fontsize=15,fontname = "Times New Roman")
-    if user_xlabel:
-        plt.xlabel(user_xlabel,fontsize=15,fontname = "Times New Roman")
-    if user_ylabel:
-        plt.ylabel(user_ylabel,fontsize=15,fontname = "Times New Roman")
+    xlabel = user_xlabel if user_xlabel else r'Z-coordinates ($\AA$)'
+    ylabel = user_ylabel if user_ylabel else 'Potential (V)'
 
-    
     if model == False :  
         #Stands for the case which have not model potential contribution    
         value =  -1.0*charge*aims_pots[idx]
@@ -211,14 +151,8 @@ def plot_planar_average_alignment(lattice_constant_z,Defect_pos,charge,X,aims_po
         if user_title:
             title = user_title
 
-        plt.title(title,fontsize=15,fontname = "Times New Roman")
-    
-        plt.axhline(y=aims_pots[idx], xmin=0, xmax=lattice_constant_z,linestyle = '--', lw=2,color='orange')
-    
-        plt.plot(X_shift,aims_pots,'or',ms=5,label=r'V($\alpha$,0)-V(Host)')
-        plt.legend()
-        plt.savefig(filename,dpi=600)
-        plt.show(block=False)
+        _output_figure(_draw_planar_average_alignment, filename, lattice_constant_z=lattice_constant_z, ylim=(y_min,y_max), title=title,
+                       xlabel=xlabel, ylabel=ylabel, value_sample=aims_pots[idx], lines=[(X_shift,aims_pots,'or',r'V($\alpha$,0)-V(Host)')])
         return pa_planAv
     else:  
         #Stands for the case which have the model potential contribution   
@@ -280,21 +214,150 @@ def plot_planar_average_alignment(lattice_constant_z,Defect_pos,charge,X,aims_po
         if user_title:
             title = user_title
 
-        plt.title(title,fontsize=15,fontname = "Times New Roman")
-        
-        plt.plot(X_shift,aims_pots,'or',label=label1)
-        plt.plot(X_shift,Y_model_corr,'--b',label='V(Model)')
-        plt.plot(X_shift,Diff,'--k',label = label2)
-        plt.axhline(y=value_sample, xmin=0, xmax=lattice_constant_z,linestyle = '--',lw=2, color='orange')
-        plt.legend()
-        plt.savefig(filename,dpi=600)
-        plt.show(block=False)
+        _output_figure(_draw_planar_average_alignment, filename, lattice_constant_z=lattice_constant_z, ylim=(y_min,y_max), title=title,
+                       xlabel=xlabel, ylabel=ylabel, value_sample=value_sample,
+                       lines=[(X_shift,aims_pots,'or',label1), (X_shift,Y_model_corr,'--b','V(Model)'), (X_shift,Diff,'--k',label2)])
         return pa_planAv   
 
 
+def _draw_planar_average_alignment(ax, lattice_constant_z, ylim, title, xlabel, ylabel, value_sample, lines):
+    # lines: (z, potentials, format, label) for each planar average, value_sample is marked by the dashed orange line
+    ax.set_xlim((0,lattice_constant_z))
+    ax.set_ylim(ylim) 
+    ax.set_xlabel(xlabel,fontsize=15,fontname = "Times New Roman")
+    ax.set_ylabel(ylabel,fontsize=15,fontname = "Times New Roman")
+    ax.set_title(title,fontsize=15,fontname = "Times New Roman")
+    for X,Y,fmt,label in lines:
+        ax.plot(X,Y,fmt,ms=5,label=label)
+    ax.axhline(y=value_sample, xmin=0, xmax=lattice_constant_z,linestyle = '--',lw=2, color='orange')
+    ax.legend()
+
+
+def plot_lattice_energy_fit(multiples, E_per, inverse_lengths, coefficients, E_iso, filename):
+    # E_q^{per,m} of the charge models against 1/\Omega^{1/3} with the fit p(\Omega) = f_1/(\Omega^(1/3)) + f_2/(\Omega) + f_3
+    # used to extrapolate to E_q^{iso,m} (adapted from plot_fit.py in the CoFFEE_1.1 'Examples' directory)
+    E_m = np.array(E_per)
+    one_by_A = np.array(inverse_lengths)
+    x_limit = 0.1*(max(one_by_A)-min(one_by_A))+max(one_by_A)
+    Linv = np.arange(0,x_limit,0.005) 
+    Y = coefficients[0]*Linv + coefficients[1]*Linv**3 + coefficients[2]
+    value = E_iso - E_m[0]
+    value = '%.2f' % value 
+    title = r'$E_q^{lat} = E_q^{m,iso} - E_q^{m,per}$'+' = '+str(value) + ' eV'
+    _output_figure(_draw_lattice_energy_fit, filename, x_limit=x_limit, title=title, multiples=[tuple(multiple) for multiple in multiples],
+                   one_by_A=one_by_A, E_m=E_m, Linv=Linv, Y=Y)
+
+
+def _draw_lattice_energy_fit(ax, x_limit, title, multiples, one_by_A, E_m, Linv, Y):
+    ax.set_xlim((0,x_limit))
+    ax.set_title(title,fontsize=15,fontname = "Times New Roman")
+    ax.plot(one_by_A, E_m,'ok',ms=10,label = r'E$^{m,per}$')
+    for i, multiple in enumerate(multiples):
+        ax.text(one_by_A[i],E_m[i],r'$'+r'\times'.join(str(n) for n in multiple)+'$',color='black',ha="right" if i == 0 else "left",fontsize=15,fontname = "Times New Roman")
+    ax.plot(Linv,Y,'--r') 
+    ax.legend()
+    ax.set_xlabel(r'$\Omega^{-1/3}$ ($\AA^{-1}$)',fontsize=15,fontname = "Times New Roman")
+    ax.set_ylabel(r'E$^{m,per}_q$ (eV)',fontsize=15,fontname = "Times New Roman")
+
+
+# Rendering of the figures ---------------------------------------------------------------------------------------------------
+# By default each figure is drawn and saved as soon as it is plotted (and shown in the notebook). In headless mode
+# (see configure_plotting) the data for each figure is queued instead, so the corrections do not wait on matplotlib,
+# and the figures are drawn by a pool of background processes or by render_queued_plots.
+
+def configure_plotting(headless: bool = False, dpi: int = 600, workers: int = 1) -> dict:
+    '''
+    Args:
+        headless: True to queue figures for render_queued_plots rather than drawing them when plotted (no figures are shown)
+        dpi: resolution of saved figures, their format is given by the extension of the filename (e.g. .png, .pdf or .svg)
+        workers: in headless mode, number of background processes drawing queued figures while processing continues,
+            figures are drawn by render_queued_plots for workers = 1
+
+    Returns:
+        The previous settings, which can be restored with configure_plotting(**previous_settings)
+    '''
+    previous_settings = dict(_plot_settings)
+    _plot_settings.update(headless=headless, dpi=dpi, workers=workers)
+    return previous_settings
+
 
+def render_queued_plots() -> list:
+    '''
+    Draws the figures queued in headless mode (or waits for those drawn by the background processes).
+    If a figure fails, the remaining figures are still drawn and the first error is raised afterwards.
 
-        # begin ploting planer_average_alignment without model potential contribution
+    Returns:
+        List of the files written, in the order the figures were plotted
+    '''
+    queued = list(_plot_queue)
+    del _plot_queue[:]
+    filenames = []
+    error = None
+    try:
+        for item in queued:
+            try:
+                filenames.append(item.result() if isinstance(item, Future) else render_figure(item, _plot_settings["dpi"]))
+            except Exception as err:
+                error = error or err
+    finally:
+        _shutdown_plot_executor()
+    if error is not None:
+        raise error
+    return filenames
+
+
+def discard_queued_plots():
+    ''' Drops the figures queued in headless mode without drawing them (e.g. after an error), cancelling those not started
+    by the background processes '''
+    queued = list(_plot_queue)
+    del _plot_queue[:]
+    for item in queued:
+        if isinstance(item, Future):
+            item.cancel()
+    _shutdown_plot_executor()
+
+
+def _shutdown_plot_executor():
+    global _plot_executor
+    if _plot_executor is not None:
+        _plot_executor.shutdown()
+        _plot_executor = None
+
+
+def render_figure(job: PlotJob, dpi: int = 600) -> str:
+    # Draws a queued figure without pyplot (so no GUI backend is needed) and saves it to job.filename
+    import matplotlib
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    matplotlib.rc('font',family='Times New Roman')
+    fig = Figure(figsize=(5.3,4.0))
+    FigureCanvasAgg(fig)
+    job.draw(fig.add_subplot(111), **job.data)
+    fig.savefig(job.filename, dpi=dpi)
+    return job.filename
+
+
+def _output_figure(draw, filename, **data):
+    # Draws the figure with draw(axes, **data) and saves it to filename, or queues it in headless mode
+    global _plot_executor
+    job = PlotJob(draw, filename, data)
+    if _plot_settings["headless"]:
+        if _plot_settings["workers"] > 1:
+            if _plot_executor is None:
+                _plot_executor = ProcessPoolExecutor(max_workers=_plot_settings["workers"])
+            _plot_queue.append(_plot_executor.submit(render_figure, job, _plot_settings["dpi"]))
+        else:
+            _plot_queue.append(job)
+        return
+    # matplotlib is imported on first use, so the readers in this module can be used without it
+    import matplotlib
+    import matplotlib.pyplot as plt
+    plt.clf()
+    matplotlib.rc('font',family='Times New Roman')
+    fig = plt.figure(figsize=(5.3,4.0))
+    draw(fig.add_subplot(111), **data)
+    fig.savefig(filename,dpi=_plot_settings["dpi"])
+    plt.show(block=False)
 
 
 # Functions from CoFFEE plotting script ('Examples/plot_fit.py' written by Mit Naik) --------------------------------------
@@ -359,17 +422,6 @@ def write2file(file_name,A,v_a):
     fp.close()
 
 def pl_avg_a3(vol,a1_dim,a2_dim,a3_dim,step_l,factor, hartree, rydberg):
-    A3 = []
-    vol_a3 = np.zeros((a3_dim))
-    for k in range(a3_dim):
-        Sum1 = 0.
-        for i in range(a1_dim):
-            for j in range(a2_dim):
-                Sum1 = Sum1 + vol[i][j][k]
-        vol_a3[k] = Sum1/(a2_dim*a1_dim)
-        A3.append(k*step_l)
-    if factor == "Ryd":
-        vol_a3 = vol_a3*rydberg
-    elif factor == "Hartree":
-        vol_a3 = vol_a3*hartree
-    return vol_a3, np.array(A3)
+    # Vectorised planar average from PlanarAverage (hartree and rydberg are kept for compatibility, the same constants are used there)
+    A3, vol_a3 = pa.planar_average(vol[:a1_dim,:a2_dim,:a3_dim], 'a3', step_l*a3_dim, factor)
+    return vol_a3, A3
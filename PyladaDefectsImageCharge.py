@@ -2,13 +2,18 @@
 The following functions have been adapted with permission from pylada-defects
 See: https://github.com/pylada/pylada-defects
 and doi: 10.1016/j.commatsci.2016.12.040
+
+pylada is only imported by get_madelungenergy and thirdO, which are kept as the reference implementations and used by
+get_imagecharge; image_charge_correction(s) and dataset_image_charge_corrections evaluate the same terms with the numpy
+kernels in ImageChargeKernels.py (compared with the reference in tests/test_ImageChargeKernels.py when pylada is installed)
 """
 
-from pylada.crystal import Structure
-from quantities import elementary_charge, eV, pi, angstrom
-from pylada.physics import Ry, a0
-from pylada.ewald import ewald
-from pylada.crystal.defects import third_order
+import numpy as np
+import ParsedDataCache as pdc
+import ImageChargeKernels as ick
+
+# Unit-charge E1 and E3 terms (eV) computed so far, keyed by lattice vectors, Ewald cutoff and n (see unit_charge_terms)
+_unit_charge_terms = {}
 
 ##############################################################
 def get_madelungenergy(latt_vec_array: tuple, charge: int, epsilon: float, cutoff: float) -> float:
@@ -31,6 +36,11 @@ def get_madelungenergy(latt_vec_array: tuple, charge: int, epsilon: float, cutof
         2. Function is adopted from Haowei Peng's version in pylada.defects modules
     """
 
+    from pylada.crystal import Structure
+    from quantities import eV
+    from pylada.physics import Ry
+    from pylada.ewald import ewald
+
     ewald_cutoff = cutoff * Ry
     
     cell_scale = 1.0 # SKW: In notebook workflow cell parameters are converted to Cartesians and units of Angstroms
@@ -61,6 +71,10 @@ def thirdO(latt_vec_array: tuple, charge: int, n: int) -> float:
         third image correction in eV
     """
 
+    from quantities import eV, pi, angstrom
+    from pylada.physics import Ry, a0
+    from pylada.crystal.defects import third_order
+
     cell_scale = 1.0 # SKW: In notebook workflow cell parameters are converted to Cartesians and units of Angstroms  
     cell = (latt_vec_array*cell_scale) * angstrom.rescale(a0) 
 
@@ -85,10 +99,14 @@ def get_imagecharge(latt_vec_array: tuple, charge: int, epsilon: float, cutoff:
     Returns
         Non-verbose = Madelung + scaled 3rd order image charge correction in eV
         Verbose = Madelung_energy, 3rd Order, shape-factor csh, scaling f, final_image_correction in eV
+
+    Note:
+        E1 and E3 are computed with pylada (get_madelungenergy and thirdO) for every call, see image_charge_correction
+        for the numpy kernels with the terms computed once for each lattice
     """
 
-    E1 = get_madelungenergy(latt_vec_array, charge=1e0, epsilon=1e0, cutoff=cutoff)
-    E3 = -1.*thirdO(latt_vec_array, charge=1e0, n=n)
+    E1 = float(get_madelungenergy(latt_vec_array, charge=1e0, epsilon=1e0, cutoff=cutoff))
+    E3 = float(-1.*thirdO(latt_vec_array, charge=1e0, n=n))
 
     if epsilon == 1e0:
         # epsilon==1e0, meaning vacuum                                                                                 
@@ -106,3 +124,87 @@ def get_imagecharge(latt_vec_array: tuple, charge: int, epsilon: float, cutoff:
         else:
             return ["{:0.3f}".format(float(E1)), "{:0.3f}".format(float(E3)), "{:0.3f}".format(float(csh)) \
                         ,"{:0.3f}".format(float(f)), "{:0.3f}".format(float(E_ic))]
+
+
+##############################################################
+def unit_charge_terms(latt_vec_array: tuple, cutoff: float, n: int = 20) -> tuple:
+    """ E1 (Madelung energy) and E3 (3rd order term) for a unit charge in vacuum, which image_charge_correction scales by the
+    charge and dielectric constant. They only depend on the lattice, so are computed once for each lattice, Ewald cutoff and n
+    and kept in memory, and in the cache from ParsedDataCache (if configured) to be shared with other processes.
+    The terms are evaluated with the numpy kernels in ImageChargeKernels.py rather than get_madelungenergy and thirdO, so
+    cutoff is not used other than in the key (the numpy Ewald sum is converged independently of it).
+
+    Args
+        latt_vec_array: lattice vectors as columns (Angstroms), as for get_imagecharge
+        cutoff: Ewald cutoff parameter
+        n: precision in integral of Eq. 7 (LZ 2009)
+
+    Returns
+        E1, E3 in eV (floats)
+    """
+    return _unit_charge_terms_for([latt_vec_array], cutoff, n)[0]
+
+
+def _unit_charge_key(latt_vec_array: np.ndarray, cutoff: float, n: int) -> str:
+    return 'lz_unit_charge-'+pdc.hash_key('lz_unit_charge', latt_vec_array.tolist(), [float(cutoff), int(n)])
+
+
+def _unit_charge_terms_for(latt_vec_arrays: list, cutoff: float, n: int) -> list:
+    """ unit_charge_terms for a list of lattices, with the terms of all lattices not yet in memory or in the cache
+    computed in one batch """
+    latt_vec_arrays = [np.asarray(latt_vec_array, dtype=float) for latt_vec_array in latt_vec_arrays]
+    keys = [_unit_charge_key(latt_vec_array, cutoff, n) for latt_vec_array in latt_vec_arrays]
+    missing = {}
+    for key, latt_vec_array in zip(keys, latt_vec_arrays):
+        if key in _unit_charge_terms or key in missing:
+            continue
+        arrays = pdc.load_entry(key)
+        if arrays is not None:
+            _unit_charge_terms[key] = (float(arrays['E1']), float(arrays['E3']))
+        else:
+            missing[key] = latt_vec_array
+    if missing:
+        lattices = np.array(list(missing.values()))
+        for key, E1, E3 in zip(missing, ick.madelung_energies(lattices), ick.third_order_energies(lattices, n)):
+            _unit_charge_terms[key] = (float(E1), float(E3))
+            pdc.store_entry(key, {'E1': np.array(E1), 'E3': np.array(E3)})
+    return [_unit_charge_terms[key] for key in keys]
+
+
+def image_charge_correction(latt_vec_array: tuple, charge: int, epsilon: float, cutoff: float = 50., n: int = 20) -> float:
+    """ Image charge correction E_ic = (E1 + E3*(1 - 1/epsilon))*q^2/epsilon, as get_imagecharge (non-verbose) but as a float,
+    with E1 and E3 from unit_charge_terms so they are only computed once for each lattice
+
+    Args
+        latt_vec_array, cutoff, n: as for get_imagecharge
+        charge: charge of point defect
+        epsilon: isotropic average of dielectric constant
+
+    Returns
+        E_ic in eV
+    """
+    E1, E3 = unit_charge_terms(latt_vec_array, cutoff, n)
+    return (E1 + E3*(1e0 - 1e0/epsilon)) * charge * charge / epsilon
+
+
+def image_charge_corrections(latt_vec_array: tuple, charges: list, epsilon: float, cutoff: float = 50., n: int = 20) -> dict:
+    """ Image charge corrections for every charge state of a defect (or a dataset of defects) in the same supercell
+
+    Returns
+        Dictionary of E_ic (eV) keyed by charge
+    """
+    return {charge: image_charge_correction(latt_vec_array, charge, epsilon, cutoff, n) for charge in charges}
+
+
+def dataset_image_charge_corrections(defects: list, epsilon: float, cutoff: float = 50., n: int = 20) -> list:
+    """ Image charge corrections for a dataset of defects, with E1 and E3 computed once (in one batch) for each distinct lattice
+
+    Args
+        defects: list of (latt_vec_array, charge) for each defect
+        epsilon, cutoff, n: as for image_charge_correction
+
+    Returns
+        List of E_ic (eV), in the same order as defects
+    """
+    terms = _unit_charge_terms_for([latt_vec_array for latt_vec_array, charge in defects], cutoff, n)
+    return [(E1 + E3*(1e0 - 1e0/epsilon)) * charge * charge / epsilon for (E1, E3), (latt_vec_array, charge) in zip(terms, defects)]
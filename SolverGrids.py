@@ -0,0 +1,87 @@
+'''
+Lazy, read-only access to the grids written by the CoFFEE Poisson solver (V_r.npy, G1.npy, G2.npy, G3.npy and V_G-model.npy).
+
+Grids are opened memory-mapped when first used and read a slab (along the first axis) at a time, so only a chunk of
+each grid is in memory at once, e.g. for planar averages of V_r or the sums over G-vectors of V_G-model and G1-3 for the
+model potential at atom sites. Shapes and dtypes are read from the .npy headers without reading any grid data.
+
+To use, the following lines must be added to the code:
+    import SolverGrids as sg
+    solver_grids = sg.SolverGrids(defect_outputs_dir)
+    for start, (V_G, G1) in solver_grids.matching_slabs(('V_G-model', 'G1')):
+        ...
+'''
+
+import numpy as np
+import os
+from collections import namedtuple
+
+# Grids written by the CoFFEE solver
+GRID_NAMES = ('V_r', 'G1', 'G2', 'G3', 'V_G-model')
+# Size of the slabs of the grids read into memory at a time by grid_slabs
+DEFAULT_CHUNK_BYTES = 64*1024**2
+
+# Metadata of a grid from its .npy header: shape, numpy dtype and size of the data in bytes
+GridInfo = namedtuple('GridInfo', ['shape', 'dtype', 'nbytes'])
+
+
+def read_grid_info(grid_file: str) -> GridInfo:
+    ''' Shape and dtype of the array in a .npy file, only reading the header '''
+    with open(grid_file, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return GridInfo(tuple(shape), dtype, int(np.prod(shape))*dtype.itemsize)
+
+
+def grid_slabs(grids: list, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+    ''' Yields (start index, slabs) for consecutive slabs along the first axis of grids (arrays or memmaps with the same first
+    dimension), with the matching slab of each grid read into memory in turn and at most chunk_bytes of them at a time '''
+    slab_bytes = max(1, sum(int(np.prod(grid.shape[1:]))*grid.dtype.itemsize for grid in grids))
+    slabs_per_chunk = max(1, int(chunk_bytes // slab_bytes))
+    for start in range(0, grids[0].shape[0], slabs_per_chunk):
+        yield start, [np.asarray(grid[start:start+slabs_per_chunk]) for grid in grids]
+
+
+class SolverGrids:
+    ''' Solver grids in a directory, opened memory-mapped (read-only) on first use
+
+    Args:
+        grids_dir: directory containing the .npy files written by the solver
+    '''
+    def __init__(self, grids_dir: str = '.'):
+        self.grids_dir = grids_dir
+        self._grids = {}
+
+    def path(self, name: str) -> str:
+        ''' .npy file for grid name (e.g. 'V_G-model') '''
+        return os.path.join(self.grids_dir, name+'.npy')
+
+    def __contains__(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def info(self, name: str) -> GridInfo:
+        ''' Shape, dtype and size of grid name, without reading any of its data '''
+        return read_grid_info(self.path(name))
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        ''' Grid name as a read-only memmap, data is only read from disk where it is used '''
+        if name not in self._grids:
+            self._grids[name] = np.load(self.path(name), mmap_mode='r')
+        return self._grids[name]
+
+    def slabs(self, name: str, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+        ''' Yields (start index, slab) for consecutive slabs along the first axis of grid name, each read into memory in turn '''
+        for start, (slab,) in grid_slabs([self[name]], chunk_bytes):
+            yield start, slab
+
+    def matching_slabs(self, names: tuple, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+        ''' Yields (start index, slabs) with the same slab of each of the grids names (e.g. V_G-model and G1-3), at most
+        chunk_bytes of them in memory at a time '''
+        return grid_slabs([self[name] for name in names], chunk_bytes)
+
+    def close(self):
+        ''' Releases the memory maps of all grids opened so far '''
+        self._grids = {}
@@ -0,0 +1,23 @@
+import AtomPotentialAlignment as apa
+import numpy as np
+import pytest
+
+
+def test_atom_alignments():
+    lattice = np.diag([10.0, 10.0, 10.0])
+    Rws, Rwl = apa.sampling_radii(lattice)
+    assert Rws[0] == pytest.approx((3*1000/(4*np.pi))**(1/3.))
+    assert Rwl[0] == pytest.approx(0.5*np.sqrt(300))
+    distances = np.linspace(1.0, 8.5, 40)
+    atom_pots = np.column_stack([distances, 0.05 - 0.3/distances])
+    model_pots = np.column_stack([distances, -0.3/distances])
+    sampled = (distances > Rws[0]) & (distances < Rwl[0])
+    # Defects with different numbers of atoms are sampled together
+    alignments = apa.atom_alignments(np.array([lattice, 2*lattice]), [atom_pots, atom_pots[:10]])
+    assert alignments[0].count == np.count_nonzero(sampled)
+    assert alignments[0].mean == pytest.approx(np.mean(atom_pots[sampled, 1]))
+    assert alignments[0].std == pytest.approx(np.std(atom_pots[sampled, 1]))
+    assert alignments[1].count == 0 and np.isnan(alignments[1].mean)
+    alignment = apa.atom_alignment(lattice, atom_pots, model_pots)
+    assert isinstance(alignment.mean, float)
+    assert alignment.mean == pytest.approx(0.05) and alignment.std == pytest.approx(0.0, abs=1e-12)
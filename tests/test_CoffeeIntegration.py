@@ -1,10 +1,19 @@
 import CoffeeConvenienceFunctions as ccf
+import ParsedDataCache as pdc
+import PlottingFunctions as ptt
 import re
 import os
 import pytest
+import numpy as np
 
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TestData")
 
-def test_coffee_solver():
+
+def test_coffee_solver(monkeypatch, tmp_path):
+    # coffee.py needs the CoFFEE Poisson solver and mpi4py
+    pytest.importorskip("PoissonSolver")
+    pytest.importorskip("mpi4py")
+    monkeypatch.chdir(tmp_path)
     # Known energy output for test system (2x2x2 supercell of antisite test defect supercell)
     expectedEnergy = 0.4008
     coffee_solver_output = 'cm_2x2x2.out'
@@ -13,7 +22,7 @@ def test_coffee_solver():
     coffee_exe = "coffee.py"
     # Parameters for known test system
     super_x, super_y, super_z = 2, 2, 2
-    defect_geom = 'tests/TestData/antisite/geometry.in'
+    defect_geom = os.path.join(TEST_DATA, 'antisite', 'geometry.in')
     sigma = 2.108966292
     cutoff = 6.773799249378561
     defect_charge = 1
@@ -37,3 +46,138 @@ def test_coffee_solver():
         print('Could not open ' + str(os.path.join(defect_outputs_dir, coffee_solver_output)))
 
     assert testEnergy == pytest.approx(expectedEnergy)
+
+
+def test_solve_charge_model(monkeypatch, tmp_path):
+    # Same test system as above, solved in-process without writing any files to the working directory
+    pytest.importorskip("PoissonSolver")
+    monkeypatch.chdir(tmp_path)
+    expectedEnergy = 0.4008
+    lattice_vecs = ccf.read_lattice_vectors(os.path.join(TEST_DATA, 'antisite', 'geometry.in'))
+    solution = ccf.solve_charge_model(lattice_vecs, 2, 2, 2, 2.108966292, 6.773799249378561, 1,
+                                      5.58437198, 8.56614992, 6.21005598, 7.49, 6.92, 7.19)
+    assert not solution.sigma_too_large
+    assert solution.energy == pytest.approx(expectedEnergy)
+    assert solution.V_r.ndim == 3
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_solve_charge_models(monkeypatch, tmp_path):
+    # 1x1x1 and 2x2x2 charge models of the test system solved at the same time in separate processes
+    pytest.importorskip("PoissonSolver")
+    expectedEnergy = 0.4008
+    monkeypatch.chdir(tmp_path)
+    outputs_dir = tmp_path / "outputs"
+    outputs_dir.mkdir()
+    lattice_vecs = ccf.read_lattice_vectors(os.path.join(TEST_DATA, 'antisite', 'geometry.in'))
+    solutions = ccf.solve_charge_models(lattice_vecs, 2.108966292, 6.773799249378561, 1, 5.58437198, 8.56614992, 6.21005598,
+                                        7.49, 6.92, 7.19, str(outputs_dir), multiples=(1, 2))
+    assert solutions[2].energy == pytest.approx(expectedEnergy)
+    # Grids are only kept for the 1x1x1 charge model, written straight into the outputs directory
+    assert solutions[1].V_r is not None and solutions[2].V_r is None
+    for output_name in ("V_r.npy",) + ccf.SOLVER_GRID_FILES + ("cm_1x1x1.out", "cm_2x2x2.out"):
+        assert (outputs_dir / output_name).exists()
+    # Temporary directories of the solver are removed and nothing is written to the working directory
+    assert not [name for name in os.listdir(str(outputs_dir)) if name.startswith('.')]
+    assert os.listdir(str(tmp_path)) == ["outputs"]
+
+
+def test_cached_solve_charge_model(monkeypatch, tmp_path):
+    pytest.importorskip("PoissonSolver")
+    monkeypatch.chdir(tmp_path)
+    pdc.configure_cache(str(tmp_path / "cache"))
+    try:
+        lattice_vecs = ccf.read_lattice_vectors(os.path.join(TEST_DATA, 'antisite', 'geometry.in'))
+        params = (lattice_vecs, 2, 2, 2, 2.108966292, 6.773799249378561, 1, 5.58437198, 8.56614992, 6.21005598, 7.49, 6.92, 7.19)
+        # Key only changes when the parameters of the charge model change
+        assert ccf.charge_model_key(*params) == ccf.charge_model_key(*params[:6], 1.0, *params[7:])
+        assert ccf.charge_model_key(*params) != ccf.charge_model_key(*params[:4], 2.0, *params[5:])
+        solution = ccf.cached_solve_charge_model(*params)
+        assert pdc.load_entry(ccf.charge_model_key(*params)) is not None
+        cached_solution = ccf.cached_solve_charge_model(*params)
+        assert cached_solution.energy == pytest.approx(solution.energy)
+    finally:
+        pdc.configure_cache(None)
+
+
+def test_scale_charge_model():
+    solution = ccf.ChargeModelSolution(0.4008, np.ones((2, 2, 2)), False, "! Total Energy (eV): 0.4008\n")
+    scaled_solution = ccf.scale_charge_model(solution, -2)
+    # Energy scales as q^2 and potential as q
+    assert scaled_solution.energy == pytest.approx(4*0.4008)
+    assert scaled_solution.V_r == pytest.approx(-2*np.ones((2, 2, 2)))
+    assert ccf._parse_solver_output(scaled_solution.solver_output) == (pytest.approx(4*0.4008), False)
+
+
+def test_charge_ladder_grids(monkeypatch, tmp_path):
+    # Grids are kept on disk for unit charge however many charge states are solved, only the returned V_r is scaled
+    def solve_unit_charge(*params, artifacts_dir=None, grids_dir=None):
+        assert params[6] == 1
+        np.save(os.path.join(grids_dir, "V_G-model.npy"), np.ones((2, 2, 2)))
+        return ccf.ChargeModelSolution(0.4008, np.ones((2, 2, 2)), False, "! Total Energy (eV): 0.4008\n")
+    monkeypatch.setattr(ccf, "solve_charge_model", solve_unit_charge)
+    lattice_vecs = ccf.read_lattice_vectors(os.path.join(TEST_DATA, 'antisite', 'geometry.in'))
+    for charge in (-2, 2):
+        solution = ccf.cached_solve_charge_model(lattice_vecs, 1, 1, 1, 2.1, 6.8, charge, 5.6, 8.6, 6.2, 7.49, 6.92, 7.19,
+                                                 grids_dir=str(tmp_path), charge_ladder=True)
+        assert solution.V_r == pytest.approx(charge*np.ones((2, 2, 2)))
+    for output_name in ("V_r.npy", "V_G-model.npy"):
+        assert np.load(str(tmp_path / output_name)) == pytest.approx(np.ones((2, 2, 2)))
+
+
+def test_extrapolate_charge_model(monkeypatch, caplog):
+    # Energies of a charge model following E = f_1/L + f_3 exactly, so E_iso has converged from the third supercell on
+    lattice_vecs = np.diag([10.0, 10.0, 10.0])
+    solved = []
+    def solve(lattice_vecs, super_x, super_y, super_z, *args, **kwargs):
+        solved.append((super_x, super_y, super_z))
+        return ccf.ChargeModelSolution(0.6 - 2.0*(super_x*super_y*super_z)**(-1/3.)/10.0, None, False, "")
+    monkeypatch.setattr(ccf, "cached_solve_charge_model", solve)
+    extrapolation = ccf.extrapolate_charge_model(lattice_vecs, 2.1, 6.8, 1, 5.0, 5.0, 5.0, 7.5, 6.9, 7.2,
+                                                 multiples=ccf.CONVERGENCE_MULTIPLES, tolerance=1e-3)
+    assert extrapolation.converged
+    assert extrapolation.E_iso == pytest.approx(0.6)
+    assert solved == [(1, 1, 1), (1, 1, 2), (1, 2, 2)]
+    # With three multiples all of them are solved, which is logged
+    del solved[:]
+    with caplog.at_level("INFO"):
+        ccf.extrapolate_charge_model(lattice_vecs, 2.1, 6.8, 1, 5.0, 5.0, 5.0, 7.5, 6.9, 7.2, tolerance=1e-3)
+    assert solved == [(1, 1, 1), (2, 2, 2), (3, 3, 3)]
+    assert "E_iso convergence is only checked from the third charge model on" in caplog.text
+
+
+def test_fit_isolated_energy():
+    # With three supercells the least squares fit is the same as the exact fit used before
+    one_by_A = np.array([1., 1/2., 1/3.])/12.
+    E_m = np.array([0.2, 0.3, 0.33])
+    coefficients, E_iso_error = ccf.fit_isolated_energy(one_by_A, E_m)
+    assert coefficients == pytest.approx(ptt.compute_fit(E_m, *one_by_A))
+    assert np.isnan(E_iso_error)
+    # Energies following the model exactly are recovered from an overdetermined fit, with no error
+    one_by_A = np.array([1., 2**(-1/3.), 1/2., 1/3.])/12.
+    E_m = 0.4 - 2.0*one_by_A - 30.0*one_by_A**3
+    coefficients, E_iso_error = ccf.fit_isolated_energy(one_by_A, E_m)
+    assert coefficients == pytest.approx([-2.0, -30.0, 0.4])
+    assert E_iso_error == pytest.approx(0.0, abs=1e-8)
+
+
+def test_estimate_charge_model():
+    lattice_vecs = ccf.read_lattice_vectors(os.path.join(TEST_DATA, 'antisite', 'geometry.in'))
+    estimate = ccf.estimate_charge_model(lattice_vecs, 1, 1, 1, 2.108966292, 6.773799249378561)
+    assert estimate.sigma_ok
+    assert estimate.grid_points == np.prod(estimate.grid)
+    assert all(n % 2 == 1 for n in estimate.grid)
+    # Doubling the supercell roughly doubles the grid along each direction
+    estimate_2x2x2 = ccf.estimate_charge_model(lattice_vecs, 2, 2, 2, 2.108966292, 6.773799249378561)
+    assert estimate_2x2x2.memory_bytes > 6*estimate.memory_bytes
+    assert not ccf.estimate_charge_model(lattice_vecs, 1, 1, 1, 5.0, 6.773799249378561).sigma_ok
+    # Only the charge models that fit in the budget are kept
+    budget = estimate_2x2x2.memory_bytes*1.5
+    assert ccf.multiples_within_budget(lattice_vecs, 2.108966292, 6.773799249378561, [(3, 3, 3), (1, 1, 1), (2, 2, 2)], budget) == [(1, 1, 1), (2, 2, 2)]
+    # Hexagonal supercell with a = 10 and c = 16 Angstroms: both in-plane lattice vectors have the same length
+    x_vecs, y_vecs, z_vecs = [10.0, -5.0, 0.0], [0.0, 5.0*np.sqrt(3), 0.0], [0.0, 0.0, 16.0]
+    hexagonal_estimate = ccf.estimate_charge_model((x_vecs, y_vecs, z_vecs), 1, 1, 1, 1.9, 6.1)
+    assert hexagonal_estimate.grid == (23, 23, 35)
+    assert hexagonal_estimate.sigma_ok
+    assert ccf.estimate_charge_model((x_vecs, y_vecs, z_vecs), 1, 1, 1, 2.0, 6.1).sigma_ok
+    assert not ccf.estimate_charge_model((x_vecs, y_vecs, z_vecs), 1, 1, 1, 2.01, 6.1).sigma_ok
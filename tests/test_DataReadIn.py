@@ -1,4 +1,5 @@
 import DefectSupercellAnalyses as dsa
+import ParsedDataCache as pdc
 import LogFileSetup as lfs
 import pytest
 import numpy as np
@@ -22,8 +23,10 @@ def group_species_with_count(species_list, host_counts, defect_counts):
     return species_countHostDefect
 
 # Test log file function call
-def test_log_file_config():
+def test_log_file_config(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
     lfs.configure_logging("log_test")
+    assert (tmp_path / "log_test.info").exists()
 
 # Unit tests for functions
 def test_read_lattice_vectors():
@@ -80,6 +83,8 @@ def test_find_defect_type():
     assert vacancy_test == 'vacancy'
     assert antisite_test == 'antisite'
     assert interstitial_test == 'interstitial'
+    # Supercells that do not differ by a single point defect have no defect type
+    assert dsa.find_defect_type(host_coords, host_coords[:-2]) is None
 def test_find_vacancy():
     verified_species = 'S'
     host_coords = dsa.read_atom_coords("tests/TestData/perfect/geometry.in")
@@ -123,4 +128,121 @@ def test_defect_to_boundary():
     species_in, species_out, defect_x, defect_y, defect_z, defect_line = dsa.antisite_coords(host_coords, defect_coords)
     supercell_dims = dsa.get_supercell_dimensions("tests/TestData/perfect/geometry.in")
     test_defect_dist = dsa.defect_to_boundary(defect_x, defect_y, defect_z, supercell_dims[0], supercell_dims[1], supercell_dims[2])
-    assert verified_defect_dist == pytest.approx(test_defect_dist)   
\ No newline at end of file
+    assert verified_defect_dist == pytest.approx(test_defect_dist)   
+def test_read_geometry():
+    geometry = dsa.read_geometry("tests/TestData/perfect/geometry.in")
+    assert geometry.atom_num == 128
+    assert geometry.cart_coords.shape == (128, 3)
+    assert geometry.frac_coords.shape == (128, 3)
+    assert geometry.lattice == pytest.approx(dsa.lattice_vectors_array("tests/TestData/perfect/geometry.in"))
+    # Fractional and Cartesian coordinates must be consistent with the lattice vectors
+    assert geometry.frac_coords @ geometry.lattice == pytest.approx(geometry.cart_coords)
+    verified_counts = {'S': 64, 'Cu': 48, 'As': 16}
+    test_counts = {symbol: int(np.sum(geometry.species == symbol)) for symbol in geometry.species_symbols}
+    assert verified_counts == test_counts
+    # Repeated reads of an unchanged file are served from memory
+    assert dsa.read_geometry("tests/TestData/perfect/geometry.in") is geometry
+def test_read_atom_coords_frac():
+    frac_coords_test = dsa.read_atom_coords_frac("tests/TestData/perfect/geometry.in")
+    latt_vec_array = dsa.lattice_vectors_array("tests/TestData/perfect/geometry.in")
+    coords_array = dsa.coords_to_array(dsa.read_atom_coords("tests/TestData/perfect/geometry.in"))
+    assert frac_coords_test @ latt_vec_array == pytest.approx(coords_array)
+def test_vacancy_coords_periodic():
+    verified_vac_coords = (5.52373568, 8.61786697, 2.34329588)
+    host_coords = dsa.read_atom_coords("tests/TestData/perfect/geometry.in")
+    defect_coords = dsa.read_atom_coords("tests/TestData/vacancy/geometry.in")
+    latt_vec_array = dsa.lattice_vectors_array("tests/TestData/perfect/geometry.in")
+    test_vac_coords = dsa.vacancy_coords(host_coords, defect_coords, latt_vec_array)
+    assert verified_vac_coords == pytest.approx(test_vac_coords[1:4])
+    assert host_coords[test_vac_coords[4]][0:3] == pytest.approx(verified_vac_coords)
+def test_nearest_neighbour_distances_periodic():
+    # Atoms either side of the supercell boundary are nearest neighbours under the minimum-image convention
+    lattice = np.diag([10.0, 10.0, 10.0])
+    coords = np.array([[0.01, 0.5, 0.5], [0.5, 0.5, 0.5]])
+    reference_coords = np.array([[0.99, 0.5, 0.5], [0.3, 0.5, 0.5]])
+    distances, indices = dsa.nearest_neighbour_distances(coords, reference_coords, lattice)
+    assert distances == pytest.approx([0.2, 2.0])
+    assert list(indices) == [0, 1]
+def test_nearest_neighbour_distances_skewed_cell():
+    # In a hexagonal cell the wrapped image is not always the closest one, so distances are checked against a brute-force search
+    lattice = np.array([[10.0, 0.0, 0.0], [-5.0, 5.0*np.sqrt(3), 0.0], [0.0, 0.0, 12.0]])
+    assert dsa.minimum_image_distances(np.array([[0.4, -0.4, 0.0]]), np.zeros(3), lattice) == pytest.approx([np.sqrt(28.0)])
+    rng = np.random.RandomState(0)
+    coords, reference_coords = rng.rand(50, 3), rng.rand(20, 3)
+    offsets = np.array([[i, j, k] for i in range(-2, 3) for j in range(-2, 3) for k in range(-2, 3)])
+    rel = coords[:,np.newaxis,np.newaxis,:] - reference_coords[np.newaxis,:,np.newaxis,:] + offsets
+    brute_force = np.linalg.norm(rel @ lattice, axis=-1).min(axis=2)
+    distances, indices = dsa.nearest_neighbour_distances(coords, reference_coords, lattice)
+    assert distances == pytest.approx(brute_force.min(axis=1))
+    assert list(indices) == list(brute_force.argmin(axis=1))
+def test_locate_defect():
+    host_geometry = dsa.read_geometry("tests/TestData/perfect/geometry.in")
+    verified_sites = {'vacancy': ('S', None, (5.52373568, 8.61786697, 2.34329588)),
+                      'interstitial': ('Cu', None, (5.6, 2.6, 4.6)),
+                      'antisite': ('As', 'Cu', (5.58437198, 8.56614992, 6.21005598))}
+    for defect_type, (species, species_out, coords) in verified_sites.items():
+        site = dsa.locate_defect(host_geometry, dsa.read_geometry("tests/TestData/"+defect_type+"/geometry.in"))
+        assert site.defect_type == defect_type
+        assert site.species == species
+        assert site.species_out == species_out
+        assert site.cart_coords == pytest.approx(coords)
+def test_species_census():
+    host_geometry = dsa.read_geometry("tests/TestData/perfect/geometry.in")
+    antisite_geometry = dsa.read_geometry("tests/TestData/antisite/geometry.in")
+    census = dsa.species_census(host_geometry, antisite_geometry)
+    test_grouped = group_species_with_count(census.species, census.host_counts.tolist(), census.defect_counts.tolist())
+    verified_grouped = group_species_with_count(['S', 'Cu', 'As'], [64, 48, 16], [64, 47, 17])
+    assert verified_grouped == test_grouped
+    assert census.defect_type == 'antisite'
+    assert (census.species_added, census.species_removed) == ('As', 'Cu')
+    # Extrinsic species are counted with zero atoms in the host
+    extrinsic_census = dsa.species_census(np.array(['Ga', 'As']), np.array(['Ga', 'Si']))
+    assert extrinsic_census.defect_type == 'antisite'
+    assert (extrinsic_census.species_added, extrinsic_census.species_removed) == ('Si', 'As')
+def test_build_site_map():
+    vacancy_map = dsa.build_site_map('vacancy', 2, 5)
+    assert list(vacancy_map.host_partner) == [0, 1, 3, 4]
+    assert list(vacancy_map.host_site_mask) == [False, False, True, False, False]
+    interstitial_map = dsa.build_site_map('interstitial', 1, 4)
+    assert list(interstitial_map.host_partner) == [0, -1, 1, 2, 3]
+    antisite_map = dsa.build_site_map('antisite', 0, 3)
+    assert list(antisite_map.host_index) == [1, 2]
+    assert list(antisite_map.defect_index) == [1, 2]
+    # Potential differences and coordinates are obtained by indexing, inputs are left unchanged
+    host_pot, defect_pot = np.array([1., 2., 3., 4., 5.]), np.array([10., 20., 40., 50.])
+    assert list(vacancy_map.paired_difference(host_pot, defect_pot)) == [9., 18., 36., 45.]
+    host_coords, defect_coords = np.zeros([5,3]), np.ones([4,3])
+    sampling_coords = vacancy_map.sampling_coords(host_coords, defect_coords)
+    assert list(sampling_coords[:,0]) == [1., 1., 0., 1., 1.]
+    assert not host_coords.any()
+def test_minimum_image_distances():
+    lattice = np.diag([10.0, 20.0, 10.0])
+    frac_coords = np.array([[0.95, 0.5, 0.5], [0.5, 0.5, 0.5], [0.1, 0.5, 0.5]])
+    distances = dsa.minimum_image_distances(frac_coords, np.array([0.05, 0.5, 0.5]), lattice)
+    assert distances == pytest.approx([1.0, 4.5, 0.5])
+    # A stack of defect positions gives one row of distances per defect
+    stacked_distances = dsa.minimum_image_distances(frac_coords, np.array([[0.05, 0.5, 0.5], [0.5, 0.0, 0.5]]), lattice)
+    assert stacked_distances.shape == (2, 3)
+    assert stacked_distances[1] == pytest.approx([np.sqrt(4.5**2 + 10.0**2), 10.0, np.sqrt(4.0**2 + 10.0**2)])
+def test_geometry_disk_cache(tmp_path):
+    pdc.configure_cache(str(tmp_path / "cache"))
+    dsa._geometry_cache.clear()
+    try:
+        geometry = dsa.read_geometry("tests/TestData/antisite/geometry.in")
+        dsa._geometry_cache.clear()
+        # Second read is loaded (memory-mapped) from the on-disk cache rather than parsed
+        cached_geometry = dsa.read_geometry("tests/TestData/antisite/geometry.in")
+        assert isinstance(cached_geometry.cart_coords, np.memmap)
+        assert cached_geometry.cart_coords == pytest.approx(geometry.cart_coords)
+        assert cached_geometry.species_symbols == geometry.species_symbols
+        assert list(cached_geometry.species_codes) == list(geometry.species_codes)
+    finally:
+        pdc.configure_cache(None)
+        dsa._geometry_cache.clear()
+def test_dataset_sigma(tmp_path):
+    manifest_file = str(tmp_path / "dataset_sigma.json")
+    results = dsa.dataset_sigma("tests/TestData", "tests/TestData/perfect/geometry.in", manifest_file=manifest_file)
+    assert results.sigma == pytest.approx(2.108966292)
+    assert results.cutoff == pytest.approx(6.773799249378561)
+    # Second call is read from the manifest
+    assert dsa.dataset_sigma("tests/TestData", "tests/TestData/perfect/geometry.in", manifest_file=manifest_file) == results
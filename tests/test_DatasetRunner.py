@@ -0,0 +1,41 @@
+import os
+import DatasetRunner as dr
+
+
+def test_write_summary(tmp_path):
+    results = [dr.JobResult("V-Cu_q=-1", True, None, 12.34, "ProcessedDefects/V-Cu_q=-1"),
+               dr.JobResult("Cu_i_q=+1", False, "RuntimeError: cell failed", 1.0, "ProcessedDefects/Cu_i_q=+1")]
+    summary_file = str(tmp_path / "dataset_summary.dat")
+    dr.write_summary(results, summary_file)
+    with open(summary_file) as f:
+        lines = f.read().splitlines()
+    assert lines[1] == "V-Cu_q=-1, OK, 12.3, "
+    assert lines[2] == "Cu_i_q=+1, FAILED, 1.0, RuntimeError: cell failed"
+
+
+def test_run_dataset_pipeline(monkeypatch, tmp_path):
+    # Two defects from TestData and one with a missing defect supercell, run with run_pipeline in two worker processes
+    test_data = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TestData")
+    monkeypatch.chdir(tmp_path)
+    global_configuration = {"dielectric_xx": 7.49, "dielectric_yy": 6.92, "dielectric_zz": 7.19, "FNV": False, "planar_av_pa": False,
+                            "path_to_all_defects": test_data, "path_to_host": os.path.join(test_data, "perfect")}
+    configurations = [{"defect_outputs_dir": name, "defect_charge": 1, "path_to_defect": os.path.join(test_data, defect),
+                       "path_to_neutral": os.path.join(test_data, defect)}
+                      for name, defect in (("antisite_q=+1", "antisite"), ("missing_q=+1", "missing"), ("vacancy_q=+1", "vacancy"))]
+    results = dr.run_dataset(global_configuration, configurations, workers=2, processed_defects_dir="ProcessedDefects", notebook=False)
+    processed_defects_dir = tmp_path / "ProcessedDefects"
+    # Results are in the order of the configurations, whichever finished first
+    assert [result.name for result in results] == ["antisite_q=+1", "missing_q=+1", "vacancy_q=+1"]
+    assert [result.success for result in results] == [True, False, True]
+    assert results[0].error is None and results[1].error
+    for result in (results[0], results[2]):
+        assert os.path.exists(os.path.join(result.outputs_dir, "corrections_summary.dat"))
+    # Working directories are removed for defects that succeeded and kept for those that failed, nothing is written elsewhere
+    assert os.listdir(str(processed_defects_dir / ".work")) == ["missing_q=+1"]
+    assert sorted(os.listdir(str(tmp_path))) == ["ProcessedDefects"]
+    with open(str(processed_defects_dir / "dataset_summary.dat")) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 4
+    assert lines[1].startswith("antisite_q=+1, OK, ")
+    assert lines[2].startswith("missing_q=+1, FAILED, ") and lines[2].endswith(results[1].error)
+    assert lines[3].startswith("vacancy_q=+1, OK, ")
@@ -0,0 +1,37 @@
+import DefectCorrectionsCLI as cli
+import pytest
+
+
+def test_read_dataset_file():
+    defect_dataset = cli.read_dataset_file("sample_data/dataset/dataset.in")
+    assert list(defect_dataset) == ["GaAs_m1", "GaAs_m2", "GaAs_m3"]
+    assert defect_dataset["GaAs_m2"] == ["m0", "m2", -2]
+
+
+def test_read_parameter_file(tmp_path):
+    parameters = cli.read_parameter_file("sample_data/dataset/input_para.in")
+    assert parameters["path_to_host"] == './sample_data/dataset/origin'
+    assert parameters["manual_sigma"] == 2.6
+    assert parameters["atom_centered_pa"] == False
+    assert parameters["IC"] is None
+    parameter_file = tmp_path / "input_para.in"
+    parameter_file.write_text("dielectric_x  12.7\n")
+    with pytest.raises(ValueError):
+        cli.read_parameter_file(str(parameter_file))
+
+
+def test_check_inputs():
+    parameters = cli.read_parameter_file("sample_data/dataset/input_para.in")
+    configurations = cli.defect_configurations(parameters, cli.read_dataset_file("sample_data/dataset/dataset.in"))
+    assert cli.check_inputs(parameters, configurations) == []
+    # No atom potentials in the sample dataset
+    problems = cli.check_inputs(dict(parameters, atom_centered_pa=True), configurations)
+    assert len(problems) == 5
+    assert all("On-site_ESP.dat" in problem for problem in problems)
+
+
+def test_dry_run(capsys):
+    assert cli.main(["sample_data/dataset/dataset.in", "sample_data/dataset/input_para.in", "--only", "GaAs_m1", "--dry-run"]) == 0
+    output = capsys.readouterr().out
+    assert "GaAs_m1 3x3x3: grid 191x191x191" in output
+    assert "GaAs_m2" not in output
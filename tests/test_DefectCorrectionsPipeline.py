@@ -0,0 +1,92 @@
+import DefectCorrectionsPipeline as dcp
+import numpy as np
+import pytest
+
+
+def test_identify_defect():
+    inputs = dcp.input_files("tests/TestData/perfect", "tests/TestData/antisite", "tests/TestData/antisite")
+    host = dcp.read_host(inputs.host_geom)
+    defect = dcp.identify_defect(host, inputs.defect_geom, 1)
+    assert defect.defect_type == 'antisite'
+    assert defect.species == ('As', 'Cu')
+    assert defect.line == 87
+    assert (defect.x, defect.y, defect.z) == pytest.approx((5.58437198, 8.56614992, 6.21005598))
+    assert defect.distances_to_boundary == pytest.approx((5.58437198, 4.34860238, 6.12461284))
+    vacancy = dcp.identify_defect(host, "tests/TestData/vacancy/geometry.in", 1)
+    assert (vacancy.defect_type, vacancy.species) == ('vacancy', 'S')
+    assert (vacancy.x, vacancy.y, vacancy.z) == pytest.approx((5.52373568, 8.61786697, 2.34329588))
+    assert host.coords[vacancy.line][3] == 'S'
+
+
+def test_pipeline_config():
+    with pytest.raises(ValueError):
+        dcp.pipeline_config({"defect_outputs_dir": "antisite_test"})
+    config = {key: 1 for key in dcp.REQUIRED_CONFIG}
+    config["LZ"] = False
+    config = dcp.pipeline_config(config)
+    assert config["LZ"] == False
+    assert config["charge_model_multiples"] == [[1, 1, 1], [2, 2, 2], [3, 3, 3]]
+
+
+def test_write_corrections_summary(tmp_path):
+    outputs = dcp.output_files(str(tmp_path))
+    lattice_energy = dcp.LatticeEnergy([(1, 1, 1), (2, 2, 2)], [0.4, 0.5], None, None, 0.6, float('nan'), 0.2)
+    results = dcp.CorrectionResults(outputs, sigma=2.1, cutoff=6.8, lattice_energy=lattice_energy, pa_atom_FNV=0.0791)
+    dcp.write_corrections_summary(results, LZ=False, planar_av_pa=False)
+    with open(outputs.final_outputs_file) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == "You did not request the LZ scheme."
+    assert lines[5] == "E_q_lat (in eV) = E_m_iso - E_q_per_m = 0.2"
+    assert lines[6] == "FNV potential alignment correction with atom centres: 0.079"
+
+
+def test_fnv_charge_models_workers(monkeypatch, tmp_path, caplog):
+    # Anisotropic multiples are solved in parallel as they are, with the grids of the 1x1x1 charge model kept
+    calls = []
+    monkeypatch.setattr(dcp.ccf, "solve_charge_models", lambda *args, **kwargs: calls.append(kwargs) or {})
+    monkeypatch.setattr(dcp.ccf, "extrapolate_charge_model",
+                        lambda *args, **kwargs: calls.append(kwargs) or dcp.ccf.Extrapolation(0.0, 0.0, None, [], None, None, [], True))
+    inputs = dcp.input_files("tests/TestData/perfect", "tests/TestData/antisite", "tests/TestData/antisite")
+    defect = dcp.identify_defect(dcp.read_host(inputs.host_geom), inputs.defect_geom, 1)
+    multiples = [[1, 1, 1], [1, 1, 2], [2, 2, 2]]
+    dcp.fnv_charge_models(inputs.defect_geom, defect, 2.1, 6.8, 1, 7.5, 6.9, 7.2, str(tmp_path), multiples, charge_model_workers=3)
+    assert calls[-1]["multiples"] == [(1, 1, 1), (1, 1, 2), (2, 2, 2)]
+    assert calls[-1]["keep_grids_for"] == (1, 1, 1)
+    # Supercells are solved in turn until E_q^{iso,m} converges when a tolerance is set, which is logged
+    with caplog.at_level("INFO"):
+        dcp.fnv_charge_models(inputs.defect_geom, defect, 2.1, 6.8, 1, 7.5, 6.9, 7.2, str(tmp_path), multiples, charge_model_workers=3,
+                              E_iso_tolerance=0.01)
+    assert calls[-1]["tolerance"] == 0.01
+    assert "charge_model_workers is ignored" in caplog.text
+
+
+def test_fnv_model_planar_average(tmp_path):
+    # Unit-charge grids of the charge ladder are scaled to the charge of the defect
+    np.save(str(tmp_path / "V_r.npy"), np.arange(8.0).reshape(2, 2, 2))
+    dcp.ccf.write_CoFFEE_in_V_file(10.0, str(tmp_path))
+    plavg_model = dcp.fnv_model_planar_average(str(tmp_path))
+    scaled_plavg_model = dcp.fnv_model_planar_average(str(tmp_path), dcp.model_grid_scale(-2, True))
+    assert dcp.model_grid_scale(-2, False) == 1.0
+    assert scaled_plavg_model[:, 0] == pytest.approx(plavg_model[:, 0])
+    assert scaled_plavg_model[:, 1] == pytest.approx(-2*plavg_model[:, 1])
+
+
+def test_fnv_model_atom_potentials(monkeypatch, tmp_path):
+    # The sum over G-vectors is done over slabs of the solver grids and only the sampled potentials are converted to eV and scaled
+    for name in ("G1", "G2", "G3"):
+        np.save(str(tmp_path / (name+".npy")), np.ones((3, 3, 3)))
+    np.save(str(tmp_path / "V_G-model.npy"), np.ones((3, 3, 3), dtype=complex)/27)
+    slab_sizes = []
+    def model_atomic_pot(defect_type, host_atom_num, defect_line, grid, lattice_vec_array, host_coords, defect_coords, V_G, sigma, G1, G2, G3, site_map=None):
+        assert list(grid) == [3, 3, 3] and V_G.shape == G1.shape == G3.shape
+        slab_sizes.append(V_G.shape[0])
+        return np.column_stack([np.arange(3.0), np.full(3, V_G.real.sum())])
+    monkeypatch.setattr(dcp.apa, "model_atomic_pot", model_atomic_pot)
+    inputs = dcp.input_files("tests/TestData/perfect", "tests/TestData/antisite", "tests/TestData/antisite")
+    host = dcp.read_host(inputs.host_geom)
+    defect = dcp.identify_defect(host, inputs.defect_geom, -2)
+    model_atom_pots = dcp.fnv_model_atom_potentials(host, defect, 2.1, str(tmp_path), dcp.model_grid_scale(-2, True), chunk_bytes=9*(16+3*8))
+    assert slab_sizes == [1, 1, 1]
+    assert model_atom_pots[:, 0] == pytest.approx(np.arange(3.0))
+    assert model_atom_pots[:, 1] == pytest.approx(-2*27.2116*np.ones(3))
+    assert np.loadtxt(str(tmp_path / "atom_potentials_FNV_model.txt"))[:, 1] == pytest.approx(2*27.2116*np.ones(3))
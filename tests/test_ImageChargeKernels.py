@@ -0,0 +1,58 @@
+import ImageChargeKernels as ick
+import DefectCorrectionsPipeline as dcp
+import numpy as np
+import pytest
+
+
+def test_madelung_constants():
+    # E1 = alpha/(2 r_s) e^2/(4 pi epsilon_0) for a unit charge in a neutralising background, r_s the Wigner-Seitz radius
+    a = 5.0
+    fcc = 0.5*a*np.array([[0, 1, 1], [1, 0, 1], [1, 1, 0]]).T
+    bcc = 0.5*a*np.array([[-1, 1, 1], [1, -1, 1], [1, 1, -1]]).T
+    lattices = np.array([a*np.eye(3), fcc, bcc])
+    r_s = (3*np.abs(np.linalg.det(lattices))/(4*np.pi))**(1/3.)
+    E1 = ick.madelung_energies(lattices)
+    assert E1*2*r_s/ick.coulomb == pytest.approx([1.760119, 1.791747, 1.791859], rel=1e-6)
+
+
+def test_third_order_shape_factor():
+    # csh = E3/E1 = -0.369 for a simple cubic cell (LZ 2009)
+    lattice = 7.0*np.eye(3)
+    assert ick.third_order_energy(lattice)/ick.madelung_energy(lattice) == pytest.approx(-0.369, abs=2e-3)
+
+
+def test_batch_and_basis_invariance():
+    host = dcp.read_host(dcp.input_files("tests/TestData/perfect", "tests/TestData/vacancy", "tests/TestData/vacancy").host_geom)
+    lattice = np.transpose(host.lattice_vec_array)
+    # Same lattice with another choice of lattice vectors
+    other_basis = lattice @ np.array([[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+    lattices = np.array([lattice, other_basis, 2*lattice])
+    E1 = ick.madelung_energies(lattices)
+    E3 = ick.third_order_energies(lattices, n=12)
+    assert E1[0] == pytest.approx(ick.madelung_energy(lattice))
+    assert E3[0] == pytest.approx(ick.third_order_energy(lattice, n=12))
+    assert E1[1] == pytest.approx(E1[0])
+    assert E1[2] == pytest.approx(E1[0]/2)
+    assert E3[2] == pytest.approx(E3[0]/2)
+
+
+def test_pylada_reference():
+    pytest.importorskip("pylada")
+    import PyladaDefectsImageCharge as pdic
+    host = dcp.read_host(dcp.input_files("tests/TestData/perfect", "tests/TestData/vacancy", "tests/TestData/vacancy").host_geom)
+    lattice = np.transpose(host.lattice_vec_array)
+    assert ick.madelung_energy(lattice) == pytest.approx(float(pdic.get_madelungenergy(lattice, 1e0, 1e0, 50.)), rel=1e-6)
+    assert ick.third_order_energy(lattice) == pytest.approx(-float(pdic.thirdO(lattice, 1e0, 20)), rel=1e-6)
+
+
+def test_third_order_skewed_cells():
+    # Images that can be nearer than a point itself are kept, so E3 matches a brute-force minimum over a wider set of images
+    lattices = np.array([[[10.0, -5.0, 0.0], [0.0, 5*np.sqrt(3), 0.0], [0.0, 0.0, 16.0]],
+                         [[9.0, 4.0, 3.0], [0.0, 8.0, 2.5], [0.0, 0.0, 7.0]],
+                         8.0*np.eye(3)])
+    n = 6
+    points = np.array(np.meshgrid(*[np.arange(n)/float(n)]*3, indexing='ij')).reshape(3, -1).T
+    images = np.array(np.meshgrid(*[np.arange(-2, 3)]*3, indexing='ij')).reshape(3, -1).T
+    for lattice, E3 in zip(lattices, ick.third_order_energies(lattices, n)):
+        r2 = (np.einsum('ij,pkj->pki', lattice, points[:, None, :] + images[None, :, :])**2).sum(axis=2).min(axis=1)
+        assert E3 == pytest.approx(-ick.coulomb*(2*np.pi/3)*r2.mean()/abs(np.linalg.det(lattice)), rel=1e-12)
@@ -0,0 +1,30 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+# Workflow modules are imported in every worker process of a dataset run, so their own import time (after numpy, which
+# they all need) is kept within a budget and the plotting, solver, scipy and pylada stacks are only imported on first use
+IMPORT_TIME_BUDGET = 0.5
+HEAVY_MODULES = ['matplotlib', 'scipy', 'PoissonSolver', 'mpi4py', 'pylada', 'quantities']
+MODULES = ['DefectSupercellAnalyses', 'CoffeeConvenienceFunctions', 'AtomPotentialAlignment', 'PyladaDefectsImageCharge',
+           'ImageChargeKernels', 'PlottingFunctions', 'PlanarAverage', 'SolverGrids', 'ParsedDataCache', 'LogFileSetup',
+           'DatasetRunner', 'DefectCorrectionsPipeline', 'DefectCorrectionsCLI']
+
+COLD_IMPORT = '''
+import sys, time, json
+import numpy
+start = time.perf_counter()
+import {module}
+print(json.dumps([time.perf_counter() - start, sorted(name for name in {heavy} if name in sys.modules)]))
+'''
+
+
+@pytest.mark.parametrize("module", MODULES)
+def test_cold_import_time(module):
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, "-c", COLD_IMPORT.format(module=module, heavy=HEAVY_MODULES)], cwd=repo_dir)
+    import_time, heavy_imported = json.loads(output.decode().splitlines()[-1])
+    assert heavy_imported == []
+    assert import_time < IMPORT_TIME_BUDGET
@@ -0,0 +1,38 @@
+import ParsedDataCache as pdc
+import numpy as np
+import os
+
+
+def test_file_hash_records(tmp_path):
+    pdc.configure_cache(str(tmp_path / "cache"))
+    try:
+        source_file = tmp_path / "data.txt"
+        source_file.write_text("1 2 3\n")
+        first_hash = pdc.file_hash(str(source_file))
+        assert pdc.file_hash(str(source_file)) == first_hash
+        # A changed file replaces the record for its path instead of adding another one
+        source_file.write_text("1 2 3 4\n")
+        os.utime(str(source_file), ns=(0, 10**9))
+        assert pdc.file_hash(str(source_file)) != first_hash
+        assert len(os.listdir(str(tmp_path / "cache" / pdc._HASHES_DIR))) == 1
+    finally:
+        pdc.configure_cache(None)
+
+
+def test_size_cap(tmp_path):
+    pdc.configure_cache(str(tmp_path / "cache"), max_bytes=3000)
+    try:
+        pdc.store_entry("first", {"a": np.zeros(100)})
+        pdc.store_entry("second", {"a": np.zeros(100)})
+        # Entries over the cap are refused rather than flushing the cache
+        pdc.store_entry("too_large", {"a": np.zeros(1000)})
+        assert pdc.load_entry("too_large") is None
+        assert pdc.load_entry("first") is not None
+        os.utime(str(tmp_path / "cache" / "second"), (0, 0))
+        # The least recently used entry is evicted once the cap is exceeded
+        pdc.store_entry("third", {"a": np.zeros(200)})
+        assert pdc.load_entry("second") is None
+        assert pdc.load_entry("first") is not None
+        assert pdc.load_entry("third") is not None
+    finally:
+        pdc.configure_cache(None)
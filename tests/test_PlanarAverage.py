@@ -0,0 +1,62 @@
+import PlanarAverage as pa
+import numpy as np
+import pytest
+
+
+def test_planar_average():
+    grid = np.arange(4*5*6, dtype=float).reshape(4, 5, 6)
+    z, V_z = pa.planar_average(grid, 'a3', cell_length=12.0)
+    assert z == pytest.approx(np.arange(6)*2.0)
+    assert V_z == pytest.approx(grid.mean(axis=(0, 1)))
+    x, V_x = pa.planar_average(grid, 'a1', factor='Hartree')
+    assert x == pytest.approx(np.arange(4))
+    assert V_x == pytest.approx(grid.mean(axis=(1, 2))*pa.hartree)
+    with pytest.raises(ValueError):
+        pa.planar_average(grid, 'z')
+
+
+def test_planar_average_chunked_file(tmp_path):
+    # Grid is read from a memory-mapped file a few planes at a time
+    grid = np.random.RandomState(0).rand(9, 4, 5)
+    grid_file = str(tmp_path / "V_r.npy")
+    np.save(grid_file, grid)
+    y, V_y = pa.planar_average(grid_file, 'a2', chunk_bytes=2*4*5*8)
+    assert V_y == pytest.approx(grid.mean(axis=(0, 2)))
+
+
+def test_read_planar_pot(tmp_path):
+    planar_pot_file = str(tmp_path / "plane_average_realspace_ESP.out")
+    with open(planar_pot_file, 'w') as f:
+        f.write("#Numerical average free-atom electrostatic potential in [eV]:   -22.63876313\n"
+                "#Average real-space part of the electrostatic  potential in [eV]:     1.19582874\n"
+                "  #z-coordinate (Ang)  plane-average (hartree)\n"
+                "  7.036557155953604E-002  -1.03510158262770     \n"
+                "  0.211096714678607      -0.801235643727483     \n")
+    planar_pot = pa.read_planar_pot(planar_pot_file)
+    assert planar_pot.free_atom_pot == -22.63876313
+    assert planar_pot.average_pot == 1.19582874
+    assert planar_pot.planar_pot == pytest.approx(np.array([[0.07036557155953604, -1.0351015826277], [0.211096714678607, -0.801235643727483]]))
+    assert not planar_pot.planar_pot.flags.writeable
+    # Only read once while the file is unchanged
+    assert pa.read_planar_pot(planar_pot_file) is planar_pot
+    with open(planar_pot_file, 'a') as f:
+        f.write("  0.351636  -0.5\n")
+    assert len(pa.read_planar_pot(planar_pot_file).planar_pot) == 3
+
+
+def test_read_planar_pot_cache_size(monkeypatch, tmp_path):
+    # Only the most recently read files are kept in memory
+    monkeypatch.setattr(pa, "_PLANAR_POT_CACHE_SIZE", 2)
+    monkeypatch.setattr(pa, "_planar_pots", pa.OrderedDict())
+    planar_pot_files = []
+    for i in range(3):
+        planar_pot_files.append(str(tmp_path / ("plane_average_realspace_ESP_%d.out" % i)))
+        with open(planar_pot_files[-1], 'w') as f:
+            f.write("# free-atom: -22.6\n# real-space: 1.2\n  # z  V\n  0.07  %d\n" % i)
+    first = pa.read_planar_pot(planar_pot_files[0])
+    pa.read_planar_pot(planar_pot_files[1])
+    assert pa.read_planar_pot(planar_pot_files[0]) is first
+    pa.read_planar_pot(planar_pot_files[2])
+    assert len(pa._planar_pots) == 2
+    # The least recently used file was dropped
+    assert [key[0] for key in pa._planar_pots] == [planar_pot_files[0], planar_pot_files[2]]
@@ -0,0 +1,45 @@
+import PlottingFunctions as ptt
+import numpy as np
+import os
+import pytest
+
+
+def test_headless_plots(tmp_path):
+    # Figures are queued with their data and only drawn by render_queued_plots
+    ptt.configure_plotting(headless=True, dpi=50)
+    lattice = np.diag([10.0, 10.0, 10.0])
+    distances = np.linspace(1.0, 8.5, 40)
+    aims_atom_pots = np.column_stack([distances, 0.05 - 0.3/distances])
+    atom_file = str(tmp_path / "LZ_atom_pa.png")
+    pa_atom = ptt.plot_atom_average_alignment(lattice, 1, aims_atom_pots, None, False, atom_file)
+    sampled = aims_atom_pots[(distances > (3*1000/(4*np.pi))**(1/3.)) & (distances < 0.5*np.sqrt(300)), 1]
+    assert pa_atom == '%.3f' % -np.mean(sampled)
+    fit_file = str(tmp_path / "E_iso.svg")
+    ptt.plot_lattice_energy_fit([(1, 1, 1), (2, 2, 2), (3, 3, 3)], [1.07, 1.54, 1.70], [0.1, 0.05, 0.033], [-9.8, 20.0, 2.04], 2.04, fit_file)
+    assert not os.path.exists(atom_file) and not os.path.exists(fit_file)
+    assert ptt.render_queued_plots() == [atom_file, fit_file]
+    assert os.path.getsize(atom_file) > 0
+    with open(fit_file) as f:
+        assert "<svg" in f.read()
+    assert ptt.render_queued_plots() == []
+    ptt.configure_plotting()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_render_queued_plots_error(tmp_path, workers):
+    # A figure that cannot be saved does not stop the remaining figures being drawn, and the queue and executor are cleared
+    previous_settings = ptt.configure_plotting(headless=True, dpi=50, workers=workers)
+    assert previous_settings == {"headless": False, "dpi": 600, "workers": 1}
+    fit = ([(1, 1, 1), (2, 2, 2), (3, 3, 3)], [1.07, 1.54, 1.70], [0.1, 0.05, 0.033], [-9.8, 20.0, 2.04], 2.04)
+    ptt.plot_lattice_energy_fit(*fit, str(tmp_path / "missing_dir" / "E_iso_bad.png"))
+    ptt.plot_lattice_energy_fit(*fit, str(tmp_path / "E_iso.png"))
+    with pytest.raises(OSError):
+        ptt.render_queued_plots()
+    assert os.path.getsize(str(tmp_path / "E_iso.png")) > 0
+    assert ptt._plot_queue == [] and ptt._plot_executor is None
+    # Queued figures can also be dropped without drawing them (those already being drawn in the background are finished)
+    ptt.plot_lattice_energy_fit(*fit, str(tmp_path / "E_iso_discarded.png"))
+    ptt.discard_queued_plots()
+    assert ptt._plot_queue == [] and ptt._plot_executor is None
+    assert workers > 1 or not os.path.exists(str(tmp_path / "E_iso_discarded.png"))
+    assert ptt.configure_plotting(**previous_settings) == {"headless": True, "dpi": 50, "workers": workers}
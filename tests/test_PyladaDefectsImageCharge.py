@@ -0,0 +1,37 @@
+import PyladaDefectsImageCharge as pdic
+import ParsedDataCache as pdc
+import numpy as np
+import pytest
+
+
+def test_image_charge_corrections(monkeypatch, tmp_path):
+    # Unit-charge terms are only computed once for each lattice and cutoff, then scaled for each charge and dielectric constant
+    calls = []
+    monkeypatch.setattr(pdic.ick, "madelung_energies", lambda lattices: calls.append(len(lattices)) or -2.0*np.ones(len(lattices)))
+    monkeypatch.setattr(pdic.ick, "third_order_energies", lambda lattices, n: -0.5*np.ones(len(lattices)))
+    monkeypatch.setattr(pdic, "_unit_charge_terms", {})
+    pdc.configure_cache(str(tmp_path / "cache"))
+    try:
+        lattice = np.diag([10.0, 10.0, 12.0])
+        E_ic = pdic.image_charge_corrections(lattice, [-2, -1, 1, 2], 4.0)
+        assert calls == [1]
+        assert E_ic[-2] == pytest.approx((-2.0 - 0.5*(1 - 1/4.0))*4/4.0)
+        assert E_ic[1] == pytest.approx(E_ic[-1])
+        assert isinstance(E_ic[2], float)
+        # Lattices of a dataset that are not known yet are computed in one batch
+        assert pdic.dataset_image_charge_corrections([(lattice, 1), (2*lattice, 1), (3*lattice, -1), (2*lattice, 2)], 4.0) \
+            == [E_ic[1], pytest.approx(E_ic[1]), pytest.approx(E_ic[1]), pytest.approx(E_ic[2])]
+        assert calls == [1, 2]
+        # Stored in the cache for other processes
+        monkeypatch.setattr(pdic, "_unit_charge_terms", {})
+        assert pdic.image_charge_correction(lattice, -1, 4.0) == pytest.approx(E_ic[-1])
+        assert calls == [1, 2]
+    finally:
+        pdc.configure_cache(None)
+
+
+def test_get_imagecharge_reference():
+    # The pylada reference implementation gives the same correction as the numpy kernels
+    pytest.importorskip("pylada")
+    lattice = np.diag([10.0, 10.0, 12.0])
+    assert pdic.get_imagecharge(lattice, 2, 4.0, 50., verbose=False) == pytest.approx(pdic.image_charge_correction(lattice, 2, 4.0), rel=1e-6)
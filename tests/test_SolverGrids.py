@@ -0,0 +1,26 @@
+import SolverGrids as sg
+import numpy as np
+import pytest
+
+
+def test_solver_grids(tmp_path):
+    V_G = np.random.RandomState(0).rand(5, 4, 3) + 1j
+    np.save(str(tmp_path / "V_G-model.npy"), V_G)
+    solver_grids = sg.SolverGrids(str(tmp_path))
+    assert 'V_G-model' in solver_grids and 'G1' not in solver_grids
+    # Metadata is read from the header only
+    info = solver_grids.info('V_G-model')
+    assert info.shape == (5, 4, 3)
+    assert info.dtype == np.complex128
+    assert info.nbytes == V_G.nbytes
+    assert isinstance(solver_grids['V_G-model'], np.memmap)
+    slabs = list(solver_grids.slabs('V_G-model', chunk_bytes=2*4*3*16))
+    assert [start for start, _ in slabs] == [0, 2, 4]
+    assert np.concatenate([slab for _, slab in slabs]) == pytest.approx(V_G)
+    # Matching slabs of grids with different dtypes are read together within chunk_bytes
+    G1 = np.arange(60.0).reshape(5, 4, 3)
+    np.save(str(tmp_path / "G1.npy"), G1)
+    slabs = list(solver_grids.matching_slabs(('V_G-model', 'G1'), chunk_bytes=2*4*3*(16+8)))
+    assert [start for start, _ in slabs] == [0, 2, 4]
+    assert np.concatenate([V_G_slab for _, (V_G_slab, G1_slab) in slabs]) == pytest.approx(V_G)
+    assert np.concatenate([G1_slab for _, (V_G_slab, G1_slab) in slabs]) == pytest.approx(G1)